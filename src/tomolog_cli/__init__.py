@@ -2,6 +2,7 @@ from tomolog_cli.config import *
 from tomolog_cli.log import *
 from tomolog_cli.auth import *
 from tomolog_cli.google_snippets import *
+from tomolog_cli.scan import *
 
 from tomolog_cli.tomolog import *
 from tomolog_cli.tomolog_32id import *
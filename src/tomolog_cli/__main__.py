@@ -9,7 +9,14 @@ from datetime import datetime
 from tomolog_cli import log
 from tomolog_cli import utils
 from tomolog_cli import config
+from tomolog_cli import retry
+from tomolog_cli import offline
+from tomolog_cli import trace
+from tomolog_cli import metrics
+from tomolog_cli import bench
+from tomolog_cli import spool
 from tomolog_cli import TomoLog
+from tomolog_cli.tomolog import GOOGLE_TOKEN
 from tomolog_cli import TomoLog32ID
 from tomolog_cli import TomoLog2BM
 from tomolog_cli import TomoLog7BM
@@ -26,57 +33,118 @@ def run_status(args):
     config.log_values(args)
 
 
+def tomolog_class(args):
+    if args.beamline == '32-id':
+        return TomoLog32ID
+    elif args.beamline == '2-bm':
+        return TomoLog2BM
+    elif args.beamline == '7-bm':
+        return TomoLog7BM
+    else:
+        return TomoLog
+
+
 def run_log(args):
 
     log.warning('Publication start')
+    retry.setup(args)
+    exporter = metrics.start(args)
+    server = None
+    if args.offline:
+        server = offline.start(args)
     log.warning('Slide formatting for beamline: %s', args.beamline)
-    file_path = pathlib.Path(args.file_name)
-    if file_path.is_file():
+    file_names = scan_files(args)
+    if pathlib.Path(args.file_name).is_file():
         log.info("publishing a single file: %s" % args.file_name)
-        if args.beamline == '32-id':
-            TomoLog32ID(args).run_log()
-        elif args.beamline == '2-bm':
-            TomoLog2BM(args).run_log()
-        elif args.beamline == '7-bm':
-            TomoLog7BM(args).run_log()
+        if args.backend == 'async':
+            # httpx is only needed by the async backend
+            from tomolog_cli import async_publish
+            async_publish.run(args, file_names, tomolog_class(args), GOOGLE_TOKEN)
         else:
-            TomoLog(args).run_log()
-    elif file_path.is_dir():
+            tomolog_class(args)(args).run_log()
+    elif file_names:
         log.info("publishing a multiple files in: %s" % args.file_name)
-        top = os.path.join(args.file_name, '')
-        h5_file_list = list(filter(lambda x: x.endswith(('.h5', '.hdf', 'hdf5')), os.listdir(top)))
-        h5_file_list_sorted = sorted(h5_file_list, key = lambda x: x.split('_')[-1])
-        if (h5_file_list):
-            # h5_file_list.sort()
-            log.info("found: %s" % h5_file_list_sorted) 
-            index=0
-            for fname in h5_file_list_sorted:
-                args.file_name = top + fname
-                log.warning("  *** file %d/%d;  %s" % (index, len(h5_file_list_sorted), fname))
-                index += 1
+        log.info("found: %s" % [os.path.basename(f) for f in file_names])
+        if args.backend == 'async':
+            from tomolog_cli import async_publish
+            async_publish.run(args, file_names, tomolog_class(args), GOOGLE_TOKEN)
+        else:
+            pool = None
+            if args.worker_max_scans > 0:
+                from tomolog_cli.workers import WorkerPool
+                pool = WorkerPool(args, tomolog_class(args))
+            for index, file_name in enumerate(file_names):
+                metrics.pending_scans.set(len(file_names)-index)
+                args.file_name = file_name
+                fname = os.path.basename(file_name)
+                log.warning("  *** file %d/%d;  %s" % (index, len(file_names), fname))
                 try:
-                    if args.beamline == '32-id':
-                        TomoLog32ID(args).run_log()
-                    elif args.beamline == '2-bm':
-                        TomoLog2BM(args).run_log()
-                    elif args.beamline == '7-bm':
-                        TomoLog7BM(args).run_log()
+                    if pool is not None:
+                        pool.publish(args)
                     else:
-                        TomoLog(args).run_log()
+                        tomolog_class(args)(args).run_log()
                 except Exception as e:
                     log.error("Failed to publish %s: %s — continuing batch", fname, e)
                 time.sleep(20)
-
-        else:
-            log.error("directory %s does not contain any file" % args.file_name)
-    else:
-        log.error("directory or File Name does not exist: %s" % args.file_name)
+            metrics.pending_scans.set(0)
+            if pool is not None:
+                pool.close()
 
     # args.count = args.count + 1
-    config.write(args.config, args, sections=config.PARAMS)
+    end_run(args, server, exporter)
+
+
+def end_run(args, server, exporter):
+    if server is not None:
+        offline.stop(server)
+    else:
+        config.write(args.config, args, sections=config.PARAMS)
+    retry.report()
+    trace.report()
+    if args.trace_file is not None:
+        trace.write(args.trace_file)
+    metrics.stop(exporter)
     log.warning('publication end')
     log.info('presentation-url: %s' % args.presentation_url)
-    
+
+
+def scan_files(args):
+    # --file-name, or the h5 files of the --file-name directory in acquisition order
+    file_path = pathlib.Path(args.file_name)
+    if file_path.is_file():
+        return [args.file_name]
+    if file_path.is_dir():
+        top = os.path.join(args.file_name, '')
+        h5_file_list = list(filter(lambda x: x.endswith(('.h5', '.hdf', 'hdf5')), os.listdir(top)))
+        if not h5_file_list:
+            log.error("directory %s does not contain any file" % args.file_name)
+        return [top + fname for fname in sorted(h5_file_list, key = lambda x: x.split('_')[-1])]
+    log.error("directory or File Name does not exist: %s" % args.file_name)
+    return []
+
+
+def run_prepare(args):
+
+    log.warning('Preparation start')
+    log.warning('Slide formatting for beamline: %s', args.beamline)
+    spool.prepare(args, scan_files(args), tomolog_class(args))
+    trace.report()
+    if args.trace_file is not None:
+        trace.write(args.trace_file)
+    log.warning('preparation end')
+
+
+def run_publish(args):
+
+    log.warning('Publication start')
+    retry.setup(args)
+    exporter = metrics.start(args)
+    server = None
+    if args.offline:
+        server = offline.start(args)
+    spool.publish(args, GOOGLE_TOKEN)
+    end_run(args, server, exporter)
+
 def main():
 
     # make sure logs directory exists
@@ -90,8 +158,6 @@ def main():
                           datetime.strftime(datetime.now(), "%Y-%m-%d_%H_%M_%S") + '.log')
     # log_level = 'DEBUG' if args.verbose else "INFO"
     log.setup_custom_logger(lfname)
-    log.info("Started tomolog")
-    log.info("Saving log at %s" % lfname)
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--config', **config.SECTIONS['general']['config'])
@@ -101,6 +167,9 @@ def main():
         ('init',        init,            (),     "Create configuration file"),
         ('run',         run_log,         params, "Run data logging to google slides"),
         ('status',      run_status,      params, "Show the tomolog status"),
+        ('prepare',     run_prepare,     params + ('spool',), "Write the slides to the spool directory, without network access"),
+        ('publish',     run_publish,     params + ('spool',), "Publish the slides of the spool directory to google slides"),
+        ('bench',       bench.run_bench, params + ('bench',), "Benchmark the publication of synthetic scans to a local stand-in for Google Slides"),
     ]
 
     subparsers = parser.add_subparsers(title="Commands", metavar='')
@@ -113,6 +182,10 @@ def main():
         cmd_parser.set_defaults(_func=func)
 
     args = config.parse_known_args(parser, subparser=True)
+    # before the first record, so that the whole file has the same format
+    log.set_format(getattr(args, 'log_format', 'text'))
+    log.info("Started tomolog")
+    log.info("Saving log at %s" % lfname)
 
     # make sure token directory exists
     try:
@@ -0,0 +1,302 @@
+# #########################################################################
+# Copyright (c) 2022, UChicago Argonne, LLC. All rights reserved.         #
+#                                                                         #
+# Copyright 2022. UChicago Argonne, LLC. This software was produced       #
+# under U.S. Government contract DE-AC02-06CH11357 for Argonne National   #
+# Laboratory (ANL), which is operated by UChicago Argonne, LLC for the    #
+# U.S. Department of Energy. The U.S. Government has rights to use,       #
+# reproduce, and distribute this software.  NEITHER THE GOVERNMENT NOR    #
+# UChicago Argonne, LLC MAKES ANY WARRANTY, EXPRESS OR IMPLIED, OR        #
+# ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If software is     #
+# modified to produce derivative works, such modified software should     #
+# be clearly marked, so as not to confuse it with the version available   #
+# from ANL.                                                               #
+#                                                                         #
+# Additionally, redistribution and use in source and binary forms, with   #
+# or without modification, are permitted provided that the following      #
+# conditions are met:                                                     #
+#                                                                         #
+#     * Redistributions of source code must retain the above copyright    #
+#       notice, this list of conditions and the following disclaimer.     #
+#                                                                         #
+#     * Redistributions in binary form must reproduce the above copyright #
+#       notice, this list of conditions and the following disclaimer in   #
+#       the documentation and/or other materials provided with the        #
+#       distribution.                                                     #
+#                                                                         #
+#     * Neither the name of UChicago Argonne, LLC, Argonne National       #
+#       Laboratory, ANL, the U.S. Government, nor the names of its        #
+#       contributors may be used to endorse or promote products derived   #
+#       from this software without specific prior written permission.     #
+#                                                                         #
+# THIS SOFTWARE IS PROVIDED BY UChicago Argonne, LLC AND CONTRIBUTORS     #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT       #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS       #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL UChicago     #
+# Argonne, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,        #
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,    #
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;        #
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER        #
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT      #
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN       #
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE         #
+# POSSIBILITY OF SUCH DAMAGE.                                             #
+# #########################################################################
+
+'''
+    Asynchronous publishing backend (--backend async)
+
+    The scans are read and rendered one after the other in a worker thread, as
+    in the synchronous mode, while their uploads and Google Slides requests are
+    sent from an asyncio event loop: the network I/O of a scan overlaps with the
+    reading and rendering of the next ones.
+'''
+
+import os
+import copy
+import json
+import asyncio
+import concurrent.futures
+
+import httpx
+import google.auth.transport.requests
+
+from tomolog_cli import log
+from tomolog_cli import auth
+from tomolog_cli import cloud
+from tomolog_cli import retry
+from tomolog_cli import trace
+from tomolog_cli import metrics
+from tomolog_cli import google_snippets
+from tomolog_cli.google_snippets import SlideRecorder
+
+__all__ = ['AsyncBackend', 'SlideRecorder', 'run']
+
+SLIDES_URL = 'https://slides.googleapis.com/v1/presentations/'
+
+
+class AsyncBackend():
+    '''
+    Sends the uploads and the Slides requests of all the scans of a run over one
+    httpx client: at most --concurrency requests are in flight, started at no more
+    than --rate-limit per second. The slides of a presentation are committed in
+    the order the scans were rendered.
+    '''
+
+    # image services uploaded by the backend (see cloud.upload)
+    services = ('imgur', )
+
+    def __init__(self, args, token_fname, loop):
+        self.args = args
+        self.loop = loop
+        # the blocking services are kept for the rare calls (connection check, rollover)
+        snippets = auth.google_slide(args, token_fname)
+        self.service = snippets.service
+        self.credentials = snippets.credentials
+        self.drive = snippets.drive
+
+        proxy = None
+        if not args.public and not args.offline:
+            proxy = 'socks5://127.0.0.1:%d' % args.port
+        self.client = httpx.AsyncClient(
+            proxy=proxy, timeout=60,
+            limits=httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency))
+        self.slots = asyncio.Semaphore(args.concurrency)
+        self.auth_lock = asyncio.Lock()
+        self.next_start = 0.0
+        self.slides_url = SLIDES_URL
+        if args.offline:
+            self.slides_url = args.offline_url + '/v1/presentations/'
+
+        # slides submitted (concurrent futures), last slide of each presentation
+        self.slides = []
+        self.last = {}
+        # presentation ids replaced by a rollover
+        self.moved = {}
+        metrics.pending_slides.set_function(lambda: sum(not f.done() for f in self.slides))
+
+    def recorder(self, tomolog):
+        return SlideRecorder(self, tomolog)
+
+    def upload(self, args, filename):
+        # called from the rendering thread: the image is read now, so that the
+        # file can be overwritten by the next scan
+        with open(filename, 'rb') as f:
+            content = f.read()
+        self.args.count = self.args.count + 1
+        return asyncio.run_coroutine_threadsafe(
+            self.upload_image(filename, content, trace.current_scan()), self.loop)
+
+    def submit(self, tomolog, presentation_id, page_id, calls):
+        # called from the rendering thread
+        previous = self.last.get(presentation_id)
+        future = asyncio.run_coroutine_threadsafe(
+            self.publish_slide(tomolog, presentation_id, page_id, calls, previous), self.loop)
+        self.last[presentation_id] = future
+        self.slides.append(future)
+
+    async def throttle(self):
+        if self.args.rate_limit <= 0:
+            return
+        now = self.loop.time()
+        start = max(now, self.next_start)
+        self.next_start = start + 1.0/self.args.rate_limit
+        await asyncio.sleep(start-now)
+
+    async def authorization(self):
+        async with self.auth_lock:
+            if not self.credentials.valid:
+                request = google.auth.transport.requests.Request(session=cloud.session(self.args))
+                await asyncio.to_thread(self.credentials.refresh, request)
+        if self.credentials.token is None:
+            # anonymous credentials of --offline
+            return {}
+        return {'Authorization': 'Bearer ' + self.credentials.token}
+
+    async def request(self, method, url, description, google=False, retry_policy=True, **kwargs):
+        # retry_policy=False: a single attempt, for callers running their own retry loop
+        async def send():
+            async with self.slots:
+                await self.throttle()
+                if google:
+                    kwargs['headers'] = await self.authorization()
+                try:
+                    response = await self.client.request(method, url, **kwargs)
+                except httpx.TransportError as e:
+                    # connection resets and timeouts are retried as the synchronous ones
+                    raise ConnectionError(str(e)) from e
+            if response.status_code >= 400:
+                raise retry.ServiceError(response.status_code, '%s: %s %s' % (
+                    description, response.status_code, response.text))
+            return response
+        if not retry_policy:
+            return await send()
+        return await retry.acall(send, description)
+
+    async def upload_image(self, filename, content, scan):
+        url = cloud.imgur_url(self.args)
+        log.info('Uploading image to %s' % url)
+        with trace.span('upload', scan=scan) as span:
+            response = await self.request('POST', url, 'upload of %s' % filename,
+                                          files={'image': (filename, content)})
+            span.add(bytes_sent=len(content))
+        url = response.text.replace('{"link":"', '').replace('"}', '')
+        log.info('*** Image url created %s' % url)
+        return url
+
+    async def get_presentation(self, presentation_id, scan=None):
+        with trace.span('slides.get', scan=scan):
+            response = await self.request('GET', self.slides_url + presentation_id,
+                                          'get of %s' % presentation_id, google=True)
+        return response.json()
+
+    async def batch_update(self, presentation_id, requests, scan=None):
+        with trace.span('slides.batchUpdate', scan=scan) as span:
+            span.add(bytes_sent=len(json.dumps(requests)))
+            return await self.send_batch(presentation_id, requests)
+
+    async def send_batch(self, presentation_id, requests):
+        attempts = []
+
+        async def send():
+            attempts.append(1)
+            try:
+                return await self.request('POST', self.slides_url + presentation_id + ':batchUpdate',
+                                          'batchUpdate of %s' % presentation_id, google=True,
+                                          retry_policy=False, json={'requests': requests})
+            except retry.ServiceError as e:
+                if len(attempts) > 1 and google_snippets.applied_before(e.status, str(e)):
+                    log.warning('Batch update already applied by a previous attempt')
+                    return None
+                raise
+        # the only retry layer of the batch: it detects the replays
+        return await retry.acall(send, 'batchUpdate of %s' % presentation_id)
+
+    async def publish_slide(self, tomolog, presentation_id, page_id, calls, previous):
+        scan = os.path.basename(tomolog.args.file_name)
+        # images of all the pending slides are uploaded concurrently
+        resolved = []
+        for name, args, kwargs in calls:
+            args = [await asyncio.wrap_future(a) if isinstance(a, concurrent.futures.Future) else a
+                    for a in args]
+            resolved.append((name, args, kwargs))
+        if previous is not None:
+            await asyncio.wait([asyncio.wrap_future(previous)])
+
+        presentation_id = self.moved.get(presentation_id, presentation_id)
+        snippets = google_snippets.SlidesSnippets(self.service, self.credentials)
+        snippets.drive = self.drive
+        # the rendering thread may already be using the TomoLog instance for the next update
+        owner = copy.copy(tomolog)
+        owner.google_slide = snippets
+        deck_id = await asyncio.to_thread(owner.published_deck, self.args.presentation_url)
+        if deck_id is not None and not snippets.load_slide(await self.get_presentation(deck_id, scan), page_id):
+            # published before a rollover: updated in its presentation
+            presentation_id = deck_id
+            created = False
+        else:
+            created = snippets.load_slide(await self.get_presentation(presentation_id, scan), page_id)
+        if created and 0 < self.args.max_slides <= snippets.nslides:
+            # drive copy with the blocking client
+            new_id = await asyncio.to_thread(owner.rollover, presentation_id)
+            self.moved[presentation_id] = new_id
+            self.args.presentation_url = owner.args.presentation_url
+            presentation_id = new_id
+            created = snippets.load_slide(await self.get_presentation(presentation_id, scan), page_id)
+        for name, args, kwargs in resolved:
+            getattr(snippets, name)(presentation_id, *args[1:], **kwargs)
+        requests = snippets.commit_requests()
+        await self.batch_update(presentation_id, requests, scan)
+        log.info('Published {0} slide requests in one batch update'.format(len(requests)))
+        if created:
+            owner.save_history(self.args.presentation_url)
+
+    async def wait_below(self, nslides):
+        # back pressure: the rendering stops when too many slides are pending
+        while True:
+            pending = [asyncio.wrap_future(f) for f in self.slides if not f.done()]
+            if len(pending) < nslides:
+                return
+            await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+    async def close(self):
+        failed = 0
+        for future in self.slides:
+            try:
+                await asyncio.wrap_future(future)
+            except Exception as e:
+                log.error('Failed to publish slide: %s' % e)
+                failed += 1
+        await self.client.aclose()
+        cloud.remove_files()
+        log.info('Published %d slides, %d failed' % (len(self.slides)-failed, failed))
+
+
+async def publish(args, file_names, tomolog_class, token_fname):
+    loop = asyncio.get_running_loop()
+    backend = AsyncBackend(args, token_fname, loop)
+    cloud.backend = backend
+    # matplotlib is not thread safe: the scans are rendered by a single thread
+    render = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    try:
+        for index, file_name in enumerate(file_names):
+            await backend.wait_below(args.concurrency)
+            metrics.pending_scans.set(len(file_names)-index)
+            log.warning("  *** file %d/%d;  %s" % (index, len(file_names), file_name))
+            # each scan keeps its own copy of the arguments while its slide is pending
+            scan_args = copy.copy(args)
+            scan_args.file_name = file_name
+            try:
+                await loop.run_in_executor(render, lambda: tomolog_class(scan_args).run_log())
+            except Exception as e:
+                log.error("Failed to publish %s: %s — continuing batch", file_name, e)
+        metrics.pending_scans.set(0)
+        await backend.close()
+    finally:
+        render.shutdown()
+        cloud.backend = None
+        metrics.pending_slides.set_function(None)
+
+
+def run(args, file_names, tomolog_class, token_fname):
+    asyncio.run(publish(args, file_names, tomolog_class, token_fname))
@@ -44,8 +44,6 @@
 # #########################################################################
 
 import re
-import socks
-import socket
 import httplib2
 
 
@@ -53,39 +51,73 @@ import httplib2
 from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
 from google.oauth2 import service_account
+from google.auth.credentials import AnonymousCredentials
 
 from tomolog_cli import log
+from tomolog_cli import retry
 from tomolog_cli import google_snippets
 
+def google_scopes(args):
+    scopes = ['https://www.googleapis.com/auth/presentations']
+    if args.max_slides > 0:
+        # copying a presentation for the rollover goes through google drive
+        scopes.append('https://www.googleapis.com/auth/drive')
+    return scopes
+
+# google services are built once per run and shared by all the scans published
+_services = {}
+
+def proxy_info(args):
+    # SOCKS5 proxy of the SSH tunnel (ssh -D port), host names are resolved on the far side
+    return httplib2.ProxyInfo(httplib2.socks.PROXY_TYPE_SOCKS5, '127.0.0.1', args.port, proxy_rdns=True)
+
 def google_slide(args, token_fname):
 
+    key = (token_fname, args.public, args.port, args.offline, tuple(google_scopes(args)))
+    if key not in _services:
+        _services[key] = connect(args, token_fname)
+    slides, drive, creds = _services[key]
+    snippets = google_snippets.SlidesSnippets(slides, creds)
+    snippets.drive = drive
+    return snippets
+
+def connect(args, token_fname):
+
     log.info('Establishing connection to google')
-    if(args.public):
+    drive = None
+    if args.offline:
+        # local stand-in started by offline.start, see --offline
+        creds = AnonymousCredentials()
+        slides = build('slides', 'v1', credentials=creds, static_discovery=True,
+                       client_options={'api_endpoint': args.offline_url + '/'})
+        if args.max_slides > 0:
+            drive = build('drive', 'v3', credentials=creds, static_discovery=True,
+                          client_options={'api_endpoint': args.offline_url + '/drive/v3/'})
+        return slides, drive, creds
+    elif(args.public):
         log.info('Running from a public network computer')
         try:
-            creds = service_account.Credentials.from_service_account_file(token_fname).with_scopes(['https://www.googleapis.com/auth/presentations'])
+            creds = service_account.Credentials.from_service_account_file(token_fname).with_scopes(google_scopes(args))
             slides = build('slides', 'v1', credentials=creds)
-            snippets = google_snippets.SlidesSnippets(slides, creds)
+            if args.max_slides > 0:
+                drive = build('drive', 'v3', credentials=creds)
             log.info('Connection to google: OK')
-            return snippets
+            return slides, drive, creds
         except FileNotFoundError:
             log.error('Google token file not found at %s' % token_fname)
             exit()
     else:
         log.info('Running from a private network computer')
-        # Monkey-patch socket to route through SOCKS5
-        socks.set_default_proxy(socks.SOCKS5, "127.0.0.1", args.port)
-        socket.socket = socks.socksocket
-
-        # Create an httplib2.Http instance with socks-configured socket
-        http = httplib2.Http()
+        # keep-alive connections through the SOCKS5 tunnel, reused by all the requests of the run
+        http = httplib2.Http(proxy_info=proxy_info(args))
 
-        creds = service_account.Credentials.from_service_account_file(token_fname).with_scopes(['https://www.googleapis.com/auth/presentations'])
+        creds = service_account.Credentials.from_service_account_file(token_fname).with_scopes(google_scopes(args))
         authed_http = AuthorizedHttp(creds, http=http)
         slides = build('slides', 'v1', http=authed_http)
         try:
             # Replace 'YOUR_PRESENTATION_ID' with a valid one if available
-            slides.presentations().get(presentationId=extract_presentation_id(args.presentation_url)).execute()
+            retry.call(slides.presentations().get(presentationId=extract_presentation_id(args.presentation_url)).execute,
+                       'connection check')
             log.info("✅ Google Slides API connection verified.")
             log.info("Presentation URL: %s" % args.presentation_url)
         except Exception as e:
@@ -94,8 +126,9 @@ def google_slide(args, token_fname):
             log.error('If this is a public network computer run tomolog using the --public option!')
             log.error('If this is a private network computer start on it an SSH tunnel: ssh -D %s user@public.machine.ip -N' % args.port)
             exit()
-        snippets = google_snippets.SlidesSnippets(slides, creds)
-        return snippets
+        if args.max_slides > 0:
+            drive = build('drive', 'v3', http=authed_http)
+        return slides, drive, creds
 
 def extract_presentation_id(slide_url):
     match = re.search(r"/presentation/d/([a-zA-Z0-9_-]+)", slide_url)
@@ -0,0 +1,352 @@
+# #########################################################################
+# Copyright (c) 2022, UChicago Argonne, LLC. All rights reserved.         #
+#                                                                         #
+# Copyright 2022. UChicago Argonne, LLC. This software was produced       #
+# under U.S. Government contract DE-AC02-06CH11357 for Argonne National   #
+# Laboratory (ANL), which is operated by UChicago Argonne, LLC for the    #
+# U.S. Department of Energy. The U.S. Government has rights to use,       #
+# reproduce, and distribute this software.  NEITHER THE GOVERNMENT NOR    #
+# UChicago Argonne, LLC MAKES ANY WARRANTY, EXPRESS OR IMPLIED, OR        #
+# ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If software is     #
+# modified to produce derivative works, such modified software should     #
+# be clearly marked, so as not to confuse it with the version available   #
+# from ANL.                                                               #
+#                                                                         #
+# Additionally, redistribution and use in source and binary forms, with   #
+# or without modification, are permitted provided that the following      #
+# conditions are met:                                                     #
+#                                                                         #
+#     * Redistributions of source code must retain the above copyright    #
+#       notice, this list of conditions and the following disclaimer.     #
+#                                                                         #
+#     * Redistributions in binary form must reproduce the above copyright #
+#       notice, this list of conditions and the following disclaimer in   #
+#       the documentation and/or other materials provided with the        #
+#       distribution.                                                     #
+#                                                                         #
+#     * Neither the name of UChicago Argonne, LLC, Argonne National       #
+#       Laboratory, ANL, the U.S. Government, nor the names of its        #
+#       contributors may be used to endorse or promote products derived   #
+#       from this software without specific prior written permission.     #
+#                                                                         #
+# THIS SOFTWARE IS PROVIDED BY UChicago Argonne, LLC AND CONTRIBUTORS     #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT       #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS       #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL UChicago     #
+# Argonne, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,        #
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,    #
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;        #
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER        #
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT      #
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN       #
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE         #
+# POSSIBILITY OF SUCH DAMAGE.                                             #
+# #########################################################################
+
+
+'''
+    Synthetic scans and end-to-end benchmark (tomolog bench)
+'''
+
+import os
+import sys
+import copy
+import json
+import time
+import socket
+import platform
+import datetime
+import h5py
+import tifffile
+import numpy as np
+
+from importlib import metadata
+
+from tomolog_cli import log
+from tomolog_cli import vds
+from tomolog_cli import trace
+from tomolog_cli import retry
+from tomolog_cli import offline
+from tomolog_cli import metrics
+from tomolog_cli import TomoLog
+from tomolog_cli.tomolog import GOOGLE_TOKEN
+
+__all__ = ['generate', 'run_bench']
+
+# layouts of the reconstruction written by tomocupy (--save-format)
+LAYOUTS = ('tiff', 'h5', 'h5nolinks', 'h5sino')
+
+# slices per source file of the h5 virtual dataset
+VDS_CHUNK = 8
+
+
+def phantom_slice(z, height, width, rng):
+    """Slice z of a volume of spheres of different densities"""
+    y, x = np.mgrid[:width, :width].astype('float32') - width/2
+    rec = np.zeros((width, width), dtype='float32')
+    for cx, cy, cz, r, density in ((0, 0, 0, 0.40, 1.0), (-0.15, 0.1, 0.05, 0.12, 2.0),
+                                   (0.12, -0.12, -0.1, 0.08, 3.0), (0.05, 0.2, 0.15, 0.05, -0.5)):
+        dz = (z - height/2)/width - cz
+        r2 = r*r - dz*dz
+        if r2 > 0:
+            rec[(x/width-cx)**2 + (y/width-cy)**2 < r2] += density
+    rec += rng.normal(0, 0.05, rec.shape).astype('float32')
+    return rec*1e-3
+
+
+def write_meta(fid, fname, width, height, nangles):
+    # the dxfile entries read by TomoLog, as 1-element datasets with units
+    entries = {
+        '/measurement/sample/file/full_name':                           (fname, None),
+        '/measurement/instrument/source/beamline':                      ('bench', None),
+        '/measurement/instrument/detector/exposure_time':               (0.1, 's'),
+        '/measurement/instrument/detector/pixel_size':                  (3.45, 'microns'),
+        '/measurement/instrument/detection_system/objective/magnification': ('5x', None),
+        '/measurement/instrument/detection_system/objective/resolution': (0.69, 'microns'),
+        '/measurement/instrument/detector/array_size_x':                (width, 'pixels'),
+        '/measurement/instrument/detector/array_size_y':                (height, 'pixels'),
+        '/measurement/instrument/detector/binning_x':                   (1, 'pixels'),
+        '/measurement/instrument/name':                                 ('bench', None),
+        '/process/acquisition/flat_fields/sample/in_x':                 (0.0, 'mm'),
+        '/process/acquisition/rotation/step':                           (180/nangles, 'degrees'),
+        '/process/acquisition/rotation/num_angles':                     (nangles, None),
+        '/process/acquisition/rotation/start':                          (0.0, 'degrees'),
+        '/process/acquisition/start_date':                              (datetime.datetime.now().isoformat(), None),
+        '/measurement/sample/experiment/proposal':                      ('0', None),
+        '/measurement/sample/experimenter/name':                        ('tomolog bench', None),
+        '/measurement/sample/experimenter/user_id':                     ('0', None),
+    }
+    for key, (value, units) in entries.items():
+        if isinstance(value, str):
+            value = value.encode()
+        dset = fid.create_dataset(key, data=np.array([value]))
+        if units is not None:
+            dset.attrs['units'] = units
+
+
+def generate(data_dir, layout, compression, width, height, nangles, seed=0):
+    """
+    Write a raw scan with flat and dark fields to data_dir and its reconstruction
+    to data_dir_rec in the given layout, gzip (h5) or zlib (tiff) compressed
+    when compression is set.
+
+    Returns
+    -------
+    str
+        Name of the raw file.
+    """
+    rng = np.random.default_rng(seed)
+    name = f'bench_{layout}_{"gzip" if compression else "raw"}_{width}x{height}x{nangles}'
+    fname = os.path.join(data_dir, name + '.h5')
+    rec_dir = data_dir + '_rec'
+    if os.path.exists(fname) and any(dataset_size(fname)[1:]):
+        log.info('Using the existing %s' % fname)
+        return fname
+    os.makedirs(data_dir, exist_ok=True)
+    os.makedirs(rec_dir, exist_ok=True)
+    h5_compression = 'gzip' if compression else None
+    log.info('Generating %s (%d angles, %dx%d, %s reconstruction)' % (fname, nangles, width, height, layout))
+
+    with h5py.File(fname, 'w') as fid:
+        write_meta(fid, fname, width, height, nangles)
+        # projections: the attenuation of the central slice, shifted with the angle
+        column = np.array([phantom_slice(height//2, height, width, rng).sum(axis=0)])
+        base = np.exp(-np.repeat(column, height, axis=0)*20)
+        data = fid.create_dataset('exchange/data', (nangles, height, width), dtype='uint16',
+                                  chunks=(1, height, width), compression=h5_compression)
+        for k in range(nangles):
+            shift = int(width*0.1*np.sin(np.pi*k/nangles))
+            proj = 3000*np.roll(base, shift, axis=1) + rng.normal(100, 10, (height, width))
+            data[k] = np.clip(proj, 0, 65535).astype('uint16')
+        fid.create_dataset('exchange/data_white', data=np.clip(
+            rng.normal(3100, 30, (10, height, width)), 0, 65535).astype('uint16'), compression=h5_compression)
+        fid.create_dataset('exchange/data_dark', data=np.clip(
+            rng.normal(100, 10, (10, height, width)), 0, 65535).astype('uint16'), compression=h5_compression)
+
+    command = f'tomocupy recon --file-name {fname} --save-format {layout}'
+    if layout == 'tiff':
+        top = os.path.join(rec_dir, name + '_rec')
+        os.makedirs(top, exist_ok=True)
+        for z in range(height):
+            tifffile.imwrite(f'{top}/recon_{z:05}.tiff', phantom_slice(z, height, width, rng),
+                             compression='zlib' if compression else None)
+        with open(f'{top}/rec_line.txt', 'w') as f:
+            f.write(command + '\n')
+    elif layout == 'h5sino':
+        # sinogram order (y, z, x): one chunk per row of the slices
+        volume = np.stack([phantom_slice(z, height, width, rng) for z in range(height)], axis=1)
+        with h5py.File(os.path.join(rec_dir, name + '_rec.h5'), 'w') as fid:
+            rec = fid.create_dataset('exchange/data', data=volume, chunks=(1, height, width),
+                                     compression=h5_compression)
+            rec.attrs['axes'] = 'y,z,x'
+            rec.attrs['command'] = command
+    elif layout == 'h5':
+        # one file per chunk of slices, mapped by a virtual dataset
+        top = os.path.join(rec_dir, name + '_rec')
+        os.makedirs(top, exist_ok=True)
+        sources = h5py.VirtualLayout(shape=(height, width, width), dtype='float32')
+        for z0 in range(0, height, VDS_CHUNK):
+            z1 = min(z0+VDS_CHUNK, height)
+            with h5py.File(f'{top}/recon_{z0:05}.h5', 'w') as fid:
+                fid.create_dataset('exchange/data', data=np.stack([phantom_slice(z, height, width, rng) for z in range(z0, z1)]),
+                                   chunks=(1, width, width), compression=h5_compression)
+            sources[z0:z1] = h5py.VirtualSource(f'{name}_rec/recon_{z0:05}.h5', 'exchange/data', shape=(z1-z0, width, width))
+        with h5py.File(os.path.join(rec_dir, name + '_rec.h5'), 'w') as fid:
+            rec = fid.create_virtual_dataset('exchange/data', sources, fillvalue=0)
+            rec.attrs['command'] = command
+            # tomocupy links the metadata of the raw file
+            fid['measurement'] = h5py.ExternalLink(os.path.abspath(fname), '/measurement')
+    else:
+        with h5py.File(os.path.join(rec_dir, name + '_rec.h5'), 'w') as fid:
+            rec = fid.create_dataset('exchange/data', (height, width, width), dtype='float32',
+                                     chunks=(1, width, width), compression=h5_compression)
+            for z in range(height):
+                rec[z] = phantom_slice(z, height, width, rng)
+            rec.attrs['command'] = command
+    return fname
+
+
+def bench_reads(fname, nproc, repeat):
+    """
+    Seconds to read the x, y and z slices of the reconstruction of fname
+    through HDF5 and from the source files of its virtual dataset in
+    parallel (best of repeat), None when it is not a virtual dataset (e.g.
+    a tiff reconstruction).
+    """
+    base = os.path.basename(fname)[:-3]
+    rec = os.path.join(os.path.dirname(fname) + '_rec', base + '_rec.h5')
+    if not os.path.exists(rec):
+        return None
+    with h5py.File(rec, 'r') as fid:
+        blocks = vds.sources(fid['exchange/data'])
+        nz, ny, nx = fid['exchange/data'].shape
+    if not blocks:
+        return None
+    nworkers = vds.workers(nproc)
+    result = {'sources': len(blocks), 'workers': nworkers}
+    slices = {}
+    for mode in ('serial', 'parallel'):
+        times = []
+        # the first read starts the worker processes: not timed
+        for k in range(repeat+1):
+            t = time.perf_counter()
+            # reopened each time: the HDF5 caches are cold, as for a new scan
+            with h5py.File(rec, 'r') as fid:
+                volume = fid['exchange/data']
+                if mode == 'parallel':
+                    volume = vds.VirtualVolume(volume, blocks, nworkers)
+                slices[mode] = [volume[:, :, nx//2], volume[:, ny//2], volume[nz//2]]
+            times.append(time.perf_counter() - t)
+        result[mode + '_s'] = min(times[1:])
+    if not all(np.array_equal(a, b) for a, b in zip(slices['serial'], slices['parallel'])):
+        raise RuntimeError('Parallel reads of %s differ from the HDF5 reads' % fname)
+    return result
+
+
+def dataset_size(fname):
+    # bytes of the raw file and of its reconstruction
+    base = os.path.basename(fname)[:-3]
+    rec_dir = os.path.dirname(fname) + '_rec'
+    rec = os.path.join(rec_dir, base + '_rec')
+    size = 0
+    if os.path.isdir(rec):
+        size = sum(os.path.getsize(os.path.join(rec, f)) for f in os.listdir(rec))
+    elif os.path.exists(rec + '.h5'):
+        size = os.path.getsize(rec + '.h5')
+    return os.path.getsize(fname), size
+
+
+def version():
+    try:
+        return metadata.version('tomolog-cli')
+    except metadata.PackageNotFoundError:
+        return 'unknown'
+
+
+def run_bench(args):
+    """Publish synthetic scans to the offline server and save the timings to --bench-output"""
+    data_dir = os.path.join(os.path.abspath(args.bench_dir), 'data')
+    file_names = []
+    for layout in args.bench_layouts.split(','):
+        layout = layout.strip()
+        if layout not in LAYOUTS:
+            raise RuntimeError('Unknown reconstruction layout %s, use %s' % (layout, ', '.join(LAYOUTS)))
+        for compression in (False, True):
+            file_names.append(generate(data_dir, layout, compression, args.bench_size,
+                                       args.bench_height, args.bench_angles))
+
+    args.offline = True
+    args.beamline = 'None'
+    server = offline.start(args)
+    retry.setup(args)
+    exporter = metrics.start(args)
+    walls = []
+    try:
+        for repeat in range(args.bench_repeat):
+            log.warning('Benchmark run %d/%d' % (repeat+1, args.bench_repeat))
+            t = time.perf_counter()
+            if args.backend == 'async':
+                from tomolog_cli import async_publish
+                async_publish.run(args, file_names, TomoLog, GOOGLE_TOKEN)
+            else:
+                for file_name in file_names:
+                    scan_args = copy.copy(args)
+                    scan_args.file_name = file_name
+                    # the slice positions are chosen again for each scan
+                    scan_args.idx = scan_args.idy = scan_args.idz = -1
+                    TomoLog(scan_args).run_log()
+            walls.append(time.perf_counter() - t)
+    finally:
+        offline.stop(server)
+        metrics.stop(exporter)
+
+    datasets = []
+    for file_name in file_names:
+        name = os.path.basename(file_name)
+        stages = trace.stages(scan=name)
+        scan = stages.get('scan', {'count': 0, 'total': 0.0, 'mean': 0.0, 'max': 0.0})
+        read = sum(row['bytes_read'] for key, row in stages.items() if key.startswith('read_'))
+        raw_size, rec_size = dataset_size(file_name)
+        datasets.append({
+            'name': name,
+            'layout': name.split('_')[1],
+            'compression': name.split('_')[2],
+            'raw_mb': raw_size/2**20,
+            'recon_mb': rec_size/2**20,
+            'latency_s': {'mean': scan['mean'], 'max': scan['max'], 'count': scan['count']},
+            'read_mb_s': read/2**20/scan['total'] if scan['total'] > 0 else 0.0,
+            'vds_reads': bench_reads(file_name, args.nproc, max(1, args.bench_repeat)),
+            'stages': stages,
+        })
+    result = {
+        'tomolog_version': version(),
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'host': socket.gethostname(),
+        'platform': platform.platform(),
+        'python': sys.version.split()[0],
+        'parameters': {key: getattr(args, key) for key in (
+            'bench_size', 'bench_height', 'bench_angles', 'bench_repeat', 'backend', 'concurrency',
+            'rate_limit', 'offline_latency', 'offline_throttle', 'image_format', 'display_dpi',
+            'flat_field', 'recon_projection', 'animation')},
+        'runs_s': walls,
+        'scans_per_s': len(file_names)*len(walls)/sum(walls) if sum(walls) > 0 else 0.0,
+        'datasets': datasets,
+        'stages': trace.stages(),
+    }
+    with open(args.bench_output, 'w') as f:
+        json.dump(result, f, indent=2)
+
+    lines = ['  %-36s %9s %9s %9s %9s' % ('dataset', 'raw MB', 'recon MB', 'latency s', 'read MB/s')]
+    for d in datasets:
+        lines.append('  %-36s %9.1f %9.1f %9.2f %9.1f' % (
+            d['name'], d['raw_mb'], d['recon_mb'], d['latency_s']['mean'], d['read_mb_s']))
+    log.info('Benchmark (%.2f scans/s):\n%s' % (result['scans_per_s'], '\n'.join(lines)))
+    lines = ['  %-36s %9s %9s %10s %10s' % ('virtual dataset', 'sources', 'workers', 'serial s', 'parallel s')]
+    for d in datasets:
+        if d['vds_reads'] is not None:
+            r = d['vds_reads']
+            lines.append('  %-36s %9d %9d %10.4f %10.4f' % (d['name'], r['sources'], r['workers'], r['serial_s'], r['parallel_s']))
+    if len(lines) > 1:
+        log.info('Orthoslice reads of the virtual reconstructions:\n%s' % '\n'.join(lines))
+    log.info('Stages:\n%s' % trace.table(result['stages']))
+    log.info('Benchmark results saved to %s' % args.bench_output)
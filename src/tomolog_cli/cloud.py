@@ -43,8 +43,6 @@
 # POSSIBILITY OF SUCH DAMAGE.                                             #
 # #########################################################################
 
-import socks
-import socket
 import requests
 import subprocess
 import os
@@ -55,40 +53,70 @@ import uuid
 
 from time import sleep
 from tomolog_cli import log
+from tomolog_cli import retry
+from tomolog_cli import trace
+
+IMGUR_URL = 'https://uploadimgur.com/api/upload'
 
 _remote_files = []
 
+# publishing backend of the run (--backend async, tomolog prepare), None when publishing synchronously
+backend = None
+
+# keep-alive session shared by all the uploads of a run
+_session = None
+
+def session(args):
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        if not args.public and not args.offline:
+            log.info("Running from a private network computer, using SOCKS5 proxy ...")
+            # socks5h: host names are resolved on the far side of the tunnel
+            proxy = 'socks5h://127.0.0.1:%d' % args.port
+            _session.proxies = {'http': proxy, 'https': proxy}
+        else:
+            log.info("Running from a public network computer ...")
+    return _session
+
+def imgur_url(args):
+    if args.offline:
+        return args.offline_url + '/api/upload'
+    return IMGUR_URL
+
 def upload(args, filename):
 
-    if not args.public:
-        log.info("Running from a private network computer, using SOCKS5 proxy ...")
-        # Monkey-patch socket to route through SOCKS5
-        socks.set_default_proxy(socks.SOCKS5, "127.0.0.1", args.port)
-        # Upload the file through the SOCKS5 proxy
-        socket.socket = socks.socksocket
-    else:
-        log.info("Running from a public network computer ...")
-
-    if args.cloud_service == 'imgur':
-        cloud_url = 'https://uploadimgur.com/api/upload'
+    # --offline uploads to the imgur-like endpoint of the local server
+    service = 'imgur' if args.offline else args.cloud_service
+    if backend is not None and service in backend.services:
+        # returns a placeholder of the url (async: a future), resolved when the slide is published
+        return backend.upload(args, filename)
+    if service == 'imgur':
+        cloud_url = imgur_url(args)
         log.info('Uploading image to %s' % cloud_url)
-        with open(filename, "rb") as f:
-            response = requests.post(
-                cloud_url,
-                files={"image": f}
-            )
         headers = {
             "User-Agent": "curl/7.79.1"
         }
 
-        if (response.status_code == 200):
-            url = response.text.replace('{"link":"', '').replace('"}', '')
-            log.info('*** Image url created %s' % url)
-        else:
-            log.error('*** An error occurred creating the image url. Error %s' % response.status_code)
-            exit()
+        def post():
+            with open(filename, "rb") as f:
+                response = session(args).post(
+                    cloud_url,
+                    files={"image": f}
+                )
+            if (response.status_code != 200):
+                response.close()
+                raise retry.ServiceError(response.status_code,
+                    '*** An error occurred creating the image url. Error %s' % response.status_code)
+            return response
+
+        with trace.span('upload') as span:
+            response = retry.call(post, 'upload of %s' % filename)
+            span.add(bytes_sent=os.path.getsize(filename))
+        url = response.text.replace('{"link":"', '').replace('"}', '')
+        log.info('*** Image url created %s' % url)
         response.close()  # prevent downloading the content
-    elif args.cloud_service == 'aps':
+    elif service == 'aps':
         log.info('Uploading image to aps web service')
         cloud_url = 'https://www3.xray.aps.anl.gov/tomolog'
         log.info('Uploading image to %s' % cloud_url)
@@ -114,6 +142,14 @@ def upload(args, filename):
 
 
 def cleanup(args):
+    if backend is not None:
+        # the slides referencing the files may not be committed yet: the backend
+        # removes them at the end of the run
+        return
+    remove_files()
+
+
+def remove_files():
     for f in _remote_files:
         try:
             os.remove(f)
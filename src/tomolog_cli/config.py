@@ -122,6 +122,11 @@ SECTIONS['general'] = {
         'default': False,
         'help': 'Verbose output',
         'action': 'store_true'},
+    'log-format': {
+        'default': 'text',
+        'type': str,
+        'help': "Format of the log file saved in logs-home: text, or json with one object per line carrying the scan file and stage of each message",
+        'choices': ['text', 'json']},
     'config-update': {
         'default': False,
         'help': 'When set, the content of the config file is updated using the current params values',
@@ -134,6 +139,34 @@ SECTIONS['general'] = {
         'default': 1080,
         'type': int,
         'help': 'Port for tunneling'},
+    'trace-file': {
+        'default': None,
+        'type': str,
+        'help': "Save the timing spans of the run to this file: Chrome trace format (chrome://tracing, Perfetto) if it ends with .json, JSON lines otherwise"},
+    'metrics-file': {
+        'default': None,
+        'type': str,
+        'help': "Write Prometheus metrics (scans, stage durations, bytes, API calls, retries, 429s) to this file, e.g. in the node exporter textfile collector directory"},
+    'metrics-port': {
+        'type': int,
+        'default': 0,
+        'help': "Serve Prometheus metrics on http://127.0.0.1:<port>/metrics (0: disabled)"},
+    'metrics-interval': {
+        'type': float,
+        'default': 15,
+        'help': "Time (s) between two writes of --metrics-file"},
+    'offline': {
+        'default': False,
+        'help': 'Publish to a local stand-in for Google Slides and the image upload service instead of the real ones, e.g. to test or time the pipeline without credentials. The config file is not updated',
+        'action': 'store_true'},
+    'offline-latency': {
+        'type': float,
+        'default': 150,
+        'help': "With --offline, mean response time (ms) of the local server"},
+    'offline-throttle': {
+        'type': float,
+        'default': 0,
+        'help': "With --offline, fraction of the requests answered with a rate limit error (HTTP 429)"},
     'idx': {
         'type': int,
         'default': -1,
@@ -146,15 +179,25 @@ SECTIONS['general'] = {
         'type': int,
         'default': -1,
         'help': "Id of z slice for reconstruction visualization"},    
+    'slice-select': {
+        'default': 'center',
+        'type': str,
+        'help': "How slices left at -1 by --idx/--idy/--idz are chosen: the volume center, or the planes with the highest variance or entropy in a sparse sample (<5%%) of the reconstruction",
+        'choices': ['center', 'variance', 'entropy']},
     'nproc': {
         'type': int,
         'default': 8,
-        'help': "Number of threads to read tiff"},
+        'help': "Number of threads to read tiff and zarr chunks, and of processes to read the source files of a virtual h5 reconstruction"},
+    'vds-read': {
+        'default': 'parallel',
+        'type': str,
+        'help': "Reading of a reconstruction stored as an h5 virtual dataset: 'parallel' reads its source files concurrently (--nproc), 'serial' through HDF5",
+        'choices': ['parallel', 'serial']},
     'save-format': {
         'default': 'auto',
         'type': str,
-        'help': "Reconstruction save format. 'auto' picks based on what's on disk: single-file h5 if <base>_rec.h5 exists, else tiff folder. Set explicitly to force a layout.",
-        'choices': ['auto', 'tiff', 'h5', 'h5nolinks']},
+        'help': "Reconstruction save format. 'auto' picks based on what's on disk: single-file h5 if <base>_rec.h5 exists (h5sino when its volume is in sinogram order), else zarr store if <base>_rec.zarr exists (zarr or OME-Zarr, needs the zarr package), else tiff folder. Set explicitly to force a layout.",
+        'choices': ['auto', 'tiff', 'h5', 'h5nolinks', 'h5sino', 'zarr']},
     'analysis-path': {
         'default': None,
         'type': Path,
@@ -193,6 +236,44 @@ SECTIONS['file-reading'] = {
         'type': str,
         'default': '.',
         'help': "sphinx/readthedocs documentation directory where the meta data table extracted from the hdf5 file should be saved, e.g. docs/source/..."},
+    'live': {
+        'default': False,
+        'help': 'Preview a scan while it is being written: open the raw file in SWMR mode, publish a provisional slide as soon as the first projection is flushed and update it when the scan completes',
+        'action': 'store_true'},
+    'live-interval': {
+        'type': float,
+        'default': 10,
+        'help': "Polling interval (s) of the raw file in --live mode"},
+    'live-timeout': {
+        'type': float,
+        'default': 3600,
+        'help': "Maximum time (s) to wait for the scan to complete in --live mode"},
+    'h5-cache': {
+        'type': float,
+        'default': 64,
+        'help': "Size (MB) of the HDF5 chunk cache of the raw and reconstruction files, each opened once per scan"},
+    'proj-downsample': {
+        'type': int,
+        'default': 1,
+        'help': "Downsampling factor applied while reading the published projections"},
+    'scan-memory': {
+        'type': float,
+        'default': 4096,
+        'help': "Memory (MB) a scan may use for reading its data, estimated from the dataset shapes before reading. Projections of larger scans are read with a larger step than --proj-downsample (0: no limit)"},
+    'flat-field': {
+        'default': 'none',
+        'type': str,
+        'help': "Projection preview correction. 'normalize' publishes (data-dark)/(flat-dark), 'log' publishes -log of the normalized projection",
+        'choices': ['none', 'normalize', 'log']},
+    'flat-frames': {
+        'type': int,
+        'default': 10,
+        'help': "Maximum number of frames read from exchange/data_white and exchange/data_dark for the flat/dark-field correction"},
+    'flat-average': {
+        'default': 'median',
+        'type': str,
+        'help': "How the flat and dark frames are averaged",
+        'choices': ['median', 'mean']},
 }
 
 SECTIONS['parameters'] = {
@@ -208,6 +289,14 @@ SECTIONS['parameters'] = {
         'default': None,
         'type': str,
         'help': "Google presention. Create a public google slide presentation."},
+    'max-slides': {
+        'type': int,
+        'default': 0,
+        'help': "When larger than 0, once --presentation-url holds this many slides publishing continues in a new presentation created from --template-url. The new url is saved in the config file and in the history"},
+    'template-url': {
+        'default': None,
+        'type': str,
+        'help': "Google presentation copied when --max-slides is reached. Defaults to the current presentation, in which case only its first slide is kept in the copy"},
     'cloud-service': {
         'default': 'imgur',
         'type': str,
@@ -219,8 +308,127 @@ SECTIONS['parameters'] = {
         'help': "counter is incremented at each google slide generated. Conter is appended to the url to generate a unique url as required by some service"}
 }
 
-PARAMS = ('file-reading', 'parameters')
-NICE_NAMES = ('General', 'File reading', 'Parameters')
+SECTIONS['rendering'] = {
+    'display-dpi': {
+        'type': float,
+        'default': 144,
+        'help': "Target display density (pixels per inch) of the images placed on the slide. The output pixel size of each image is computed from its slide box (1 pt = 1/72 inch) and this density"},
+    'image-format': {
+        'default': 'jpeg',
+        'type': str,
+        'help': "Encoding of the images uploaded to the cloud service. Google Slides only accepts PNG, JPEG and GIF images",
+        'choices': ['jpeg', 'png']},
+    'image-quality': {
+        'type': int,
+        'default': 85,
+        'help': "JPEG quality (1-95) of the images uploaded to the cloud service"},
+    'image-progressive': {
+        'default': False,
+        'help': 'When set, JPEG images are saved as progressive JPEG',
+        'action': 'store_true'},
+    'recon-projection': {
+        'default': 'none',
+        'type': str,
+        'help': "Add maximum and/or mean intensity projections of the reconstruction along x, y and z next to the orthoslices",
+        'choices': ['none', 'max', 'mean', 'both']},
+    'block-memory': {
+        'type': float,
+        'default': 512,
+        'help': "Memory cap (MB) for the reconstruction blocks processed in parallel when computing --recon-projection"},
+    'animation': {
+        'type': int,
+        'default': 0,
+        'help': "Number of evenly spaced projections used to build a rotation animation (GIF) published next to the projection. 0 disables the animation"},
+    'animation-frame-time': {
+        'type': int,
+        'default': 100,
+        'help': "Display time of each animation frame in milliseconds"},
+}
+
+SECTIONS['publishing'] = {
+    'retries': {
+        'type': int,
+        'default': 5,
+        'help': "Number of times a Google Slides call or an image upload failing with a transient error (rate limit, 5xx, connection reset) is retried"},
+    'retry-budget': {
+        'type': float,
+        'default': 300,
+        'help': "Maximum total time (s) spent waiting between retries during a run"},
+    'backend': {
+        'default': 'sync',
+        'type': str,
+        'help': "sync: publish the scans one after the other; async: send the uploads and slide updates from an event loop while the next scans are rendered (requires httpx)",
+        'choices': ['sync', 'async']},
+    'concurrency': {
+        'type': int,
+        'default': 8,
+        'help': "With --backend async, maximum number of uploads and Google Slides requests in flight"},
+    'rate-limit': {
+        'type': float,
+        'default': 2,
+        'help': "With --backend async, maximum number of requests started per second (0: no limit)"},
+    'worker-max-scans': {
+        'type': int,
+        'default': 0,
+        'help': "Publish the scans of a directory in a worker process replaced after this many scans (0: publish in the main process)"},
+    'worker-max-rss': {
+        'type': float,
+        'default': 4096,
+        'help': "Replace the worker process when its resident memory exceeds this size in MB (0: no limit)"},
+}
+
+SECTIONS['spool'] = {
+    'spool-dir': {
+        'default': os.path.join(str(pathlib.Path.home()), 'tomolog_spool'),
+        'type': str,
+        'help': "Directory of the slide bundles written by tomolog prepare and published by tomolog publish"},
+    'spool-batch': {
+        'type': int,
+        'default': 10,
+        'help': "Number of slide bundles sent by tomolog publish in one batch update"},
+    'spool-poll': {
+        'type': float,
+        'default': 0,
+        'help': "Interval in s at which tomolog publish checks the spool for new bundles (0: publish the bundles found and exit)"},
+    'spool-attempts': {
+        'type': int,
+        'default': 5,
+        'help': "Number of failed publications after which a slide bundle is moved to the failed/ directory of the spool"},
+}
+
+SECTIONS['bench'] = {
+    'bench-dir': {
+        'default': os.path.join(str(pathlib.Path.home()), 'tomolog_bench'),
+        'type': str,
+        'help': "Directory of the synthetic scans generated by tomolog bench (data/ and data_rec/), reused when they exist"},
+    'bench-size': {
+        'type': int,
+        'default': 256,
+        'help': "Width in pixels of the synthetic projections and reconstruction slices"},
+    'bench-height': {
+        'type': int,
+        'default': 128,
+        'help': "Height in pixels of the synthetic projections, i.e. number of reconstructed slices"},
+    'bench-angles': {
+        'type': int,
+        'default': 181,
+        'help': "Number of projections of the synthetic scans"},
+    'bench-layouts': {
+        'default': 'tiff,h5,h5nolinks',
+        'type': str,
+        'help': "Comma separated reconstruction layouts to benchmark, each uncompressed and compressed"},
+    'bench-repeat': {
+        'type': int,
+        'default': 2,
+        'help': "Number of times the synthetic scans are published"},
+    'bench-output': {
+        'default': 'tomolog_bench.json',
+        'type': str,
+        'help': "JSON file receiving the benchmark results"},
+}
+
+PARAMS = ('file-reading', 'parameters', 'rendering', 'publishing')
+NICE_NAMES = ('General', 'File reading', 'Parameters', 'Rendering', 'Publishing', 'Spool', 'Bench')
 
 
 def get_config_name():
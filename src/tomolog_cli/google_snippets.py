@@ -43,135 +43,352 @@
 # POSSIBILITY OF SUCH DAMAGE.                                             #
 # #########################################################################
 
+import re
+import json
 import uuid
 
+from googleapiclient.errors import HttpError
 from googleapiclient.http import MediaFileUpload
 
 from tomolog_cli import log
+from tomolog_cli import retry
+from tomolog_cli import trace
+
+
+def applied_before(status, message):
+    """
+    True if the error of a replayed batchUpdate shows that a previous attempt was
+    applied and only its reply was lost: object IDs are deterministic, so its
+    objects are already there and the stale objects it deleted are gone.
+    """
+    return status == 400 and ('should be unique' in message or 'could not be found' in message)
 
 
 class SlidesSnippets(object):
     def __init__(self, service, credentials):
         self.service = service
         self.credentials = credentials
+        # requests queued between open_slide and commit, None when not batching
+        self.pending = None
+        # elements of the slide being updated, by object ID
+        self.existing = {}
+        self.touched = set()
+        # number of slides and title of the presentation seen by open_slide
+        self.nslides = 0
+        self.title = ''
+        # Google Drive service, needed to copy presentations (see --max-slides)
+        self.drive = None
 
-    def create_slide(self, presentation_id, page_id):
-        slides_service = self.service
-        # take the current number of slides
-        presentation = slides_service.presentations().get(
-            presentationId=presentation_id).execute()
-        nslides = len(presentation.get('slides'))
-        # insert a slide at the end
-        requests = [
-            {
-                'createSlide': {
-                    'objectId': page_id,
-                    'insertionIndex': nslides,#-1tmp for Julie
-                    'slideLayoutReference': {
-                        'predefinedLayout': 'BLANK'
-                    }
-                }
-            }
-        ]
-        # Execute the request.
+    def execute(self, presentation_id, requests):
+        # queue the requests when batching, otherwise send them right away
+        if self.pending is not None:
+            self.pending.extend(requests)
+            return None
+        return self.send(presentation_id, requests)
+
+    def send(self, presentation_id, requests):
+        # batchUpdate sent right away, also while batching (e.g. on another presentation)
         body = {
             'requests': requests
         }
-        response = slides_service.presentations().batchUpdate(presentationId=presentation_id, body=body).execute()
-        create_slide_response = response.get('replies')[0].get('createSlide')
-        log.info('Created slide with ID: {0}'.format(
-            create_slide_response.get('objectId')))
+        request = self.service.presentations() \
+            .batchUpdate(presentationId=presentation_id, body=body)
+        attempts = []
+
+        def send():
+            attempts.append(1)
+            try:
+                return request.execute()
+            except HttpError as e:
+                if len(attempts) > 1 and applied_before(e.resp.status, str(e)):
+                    log.warning('Batch update already applied by a previous attempt')
+                    return None
+                raise
+        with trace.span('slides.batchUpdate') as span:
+            span.add(bytes_sent=len(json.dumps(body)))
+            return retry.call(send, 'batchUpdate of {0}'.format(presentation_id))
+
+    def get_presentation(self, presentation_id):
+        with trace.span('slides.get'):
+            return retry.call(self.service.presentations().get(presentationId=presentation_id).execute,
+                              'get of {0}'.format(presentation_id))
+
+    def open_slide(self, presentation_id, page_id):
+        """
+        Start a batch of requests for slide page_id, creating the slide at the end
+        of the presentation when it does not exist yet.
+
+        All the following calls are queued and sent by commit in a single
+        batchUpdate. When the slide exists its elements are updated in place.
+
+        Returns
+        -------
+        bool
+            True if the slide is created, False if it is updated.
+        """
+        return self.load_slide(self.get_presentation(presentation_id), page_id)
+
+    def load_slide(self, presentation, page_id):
+        # open_slide on an already fetched presentation resource
+        slides = presentation.get('slides', [])
+        self.nslides = len(slides)
+        self.title = presentation.get('title', '')
+        self.pending = []
+        self.existing = {}
+        self.touched = set()
+        for slide in slides:
+            if slide.get('objectId') == page_id:
+                self.existing = {element['objectId']: element for element in slide.get('pageElements', [])}
+                log.info('Updating slide with ID: {0}'.format(page_id))
+                return False
+        self.pending.append(self.create_slide_request(page_id, len(slides)))
+        log.info('Creating slide with ID: {0}'.format(page_id))
+        return True
+
+    def commit(self, presentation_id):
+        requests = self.commit_requests()
+        if not requests:
+            return None
+        response = self.execute(presentation_id, requests)
+        log.info('Published {0} slide requests in one batch update'.format(len(requests)))
         return response
-    
-    def create_textbox_with_text(self, presentation_id, page_id, text, magnitude_width, magnitude_height, posx, posy, fontsize, fontcolor):
+
+    def commit_requests(self):
+        # requests queued since open_slide, closing the batch
+        # elements of an updated slide that were not published again are stale
+        stale = [object_id for object_id in self.existing if object_id not in self.touched]
+        requests = self.pending + [{'deleteObject': {'objectId': object_id}} for object_id in stale]
+        self.pending = None
+        self.existing = {}
+        self.touched = set()
+        return requests
+
+    def copy_presentation(self, template_id, title, keep=None):
+        """
+        Copy presentation template_id to a new presentation sharing the same
+        permissions. When keep is set only the first keep slides are kept.
+
+        Returns
+        -------
+        str
+            ID of the new presentation.
+        """
+        attempts = []
+
+        def copy():
+            if attempts:
+                # a failed attempt may still have created the copy: not copied twice
+                found = self.find_file(title)
+                if found is not None:
+                    log.warning('Copy {0} already created by a previous attempt'.format(title))
+                    return found
+            attempts.append(1)
+            return self.drive.files().copy(
+                fileId=template_id, body={'name': title}, supportsAllDrives=True).execute()['id']
+        new_id = retry.call(copy, 'copy of {0}'.format(template_id))
+        log.info('Created presentation {0} from {1}'.format(new_id, template_id))
+        permissions = retry.call(self.drive.permissions().list(
+            fileId=template_id, supportsAllDrives=True,
+            fields='permissions(type,role,emailAddress,domain)').execute, 'permissions of {0}'.format(template_id))
+        for permission in permissions.get('permissions', []):
+            if permission['role'] == 'owner':
+                continue
+            retry.call(self.drive.permissions().create(
+                fileId=new_id, body=permission, supportsAllDrives=True,
+                sendNotificationEmail=False).execute, 'permission of {0}'.format(new_id))
+        if keep is not None:
+            presentation = self.get_presentation(new_id)
+            requests = [{'deleteObject': {'objectId': slide['objectId']}}
+                        for slide in presentation.get('slides', [])[keep:]]
+            if requests:
+                self.send(new_id, requests)
+        return new_id
+
+    def find_file(self, name):
+        # id of the last modified Drive file called name, None when there is none
+        query = "name = '{0}' and trashed = false".format(name.replace('\\', '\\\\').replace("'", "\\'"))
+        files = self.drive.files().list(
+            q=query, orderBy='modifiedTime desc', fields='files(id)', pageSize=1,
+            supportsAllDrives=True, includeItemsFromAllDrives=True).execute().get('files', [])
+        return files[0]['id'] if files else None
+
+    def next_title(self):
+        # 'Title' -> 'Title - part 2' -> 'Title - part 3' ...
+        match = re.match(r'(.*) - part (\d+)$', self.title)
+        if match:
+            return '{0} - part {1}'.format(match.group(1), int(match.group(2))+1)
+        return '{0} - part 2'.format(self.title)
+
+    def create_slide_request(self, page_id, insertion_index):
+        return {
+            'createSlide': {
+                'objectId': page_id,
+                'insertionIndex': insertion_index,
+                'slideLayoutReference': {
+                    'predefinedLayout': 'BLANK'
+                }
+            }
+        }
+
+    def create_slide(self, presentation_id, page_id, insertion_index=None):
         slides_service = self.service
+        if insertion_index is None:
+            # take the current number of slides
+            presentation = self.get_presentation(presentation_id)
+            nslides = len(presentation.get('slides'))
+            insertion_index = nslides #-1tmp for Julie
+        # insert a slide at the end
+        requests = [self.create_slide_request(page_id, insertion_index)]
+        # Execute the request.
+        response = self.execute(presentation_id, requests)
+        if response is not None:
+            create_slide_response = response.get('replies')[0].get('createSlide')
+            log.info('Created slide with ID: {0}'.format(
+                create_slide_response.get('objectId')))
+        return response
+
+    def text_style_request(self, element_id, fontsize, fontcolor, fields):
+        return {
+            'updateTextStyle': {
+                'objectId': element_id,
+                'style': {
+                    'fontFamily': 'Times New Roman',
+                    'fontSize': {
+                        'magnitude': fontsize,
+                        'unit': 'PT'
+                    },
+                    'foregroundColor': {
+                        'opaqueColor': {
+                            'rgbColor': {
+                                'blue': 0.0,
+                                'green': 0.0,
+                                'red': fontcolor
+                            }
+                        }
+                    }
+                },
+                'fields': fields
+            }
+        }
+
+    def textbox_requests(self, page_id, element_id, text, magnitude_width, magnitude_height, posx, posy):
         # [START slides_create_textbox_with_text]
-        # Create a new square textbox, using the supplied element ID.
-        element_id = str(uuid.uuid4())
-        requests = [
-            {
-                'createShape': {
-                    'objectId': element_id,
-                    'shapeType': 'TEXT_BOX',
-                    'elementProperties': {
-                        'pageObjectId': page_id,
-                        'size': {
-                            'height': {'magnitude': magnitude_height, 'unit': 'PT'},
-                            'width': {'magnitude': magnitude_width, 'unit': 'PT'}
-                        },
-                        'transform': {
-                            'scaleX': 1,
-                            'scaleY': 1,
-                            'translateX': posx,
-                            'translateY': posy,
-                            'unit': 'PT'
+        if element_id in self.existing:
+            # Replace the text of the existing box
+            requests = []
+            if 'text' in self.existing[element_id].get('shape', {}):
+                requests.append({
+                    'deleteText': {
+                        'objectId': element_id,
+                        'textRange': {
+                            'type': 'ALL'
                         }
                     }
-                }
-            },
-
-            # Insert text into the box, using the supplied element ID.
-            {
-                'insertText': {
-                    'objectId': element_id,
-                    'insertionIndex': 0,
-                    'text': text
-                }
-            },
-            
-            {
-                'updateTextStyle': {
-                    'objectId': element_id,
-                    'style': {
-                        'fontFamily': 'Times New Roman',
-                        'fontSize': {
-                            'magnitude': fontsize,
-                            'unit': 'PT'
-                        },
-                        'foregroundColor': {
-                            'opaqueColor': {
-                                'rgbColor': {
-                                    'blue': 0.0,
-                                    'green': 0.0,
-                                    'red': fontcolor
-                                }
+                })
+        else:
+            # Create a new square textbox, using the supplied element ID.
+            requests = [
+                {
+                    'createShape': {
+                        'objectId': element_id,
+                        'shapeType': 'TEXT_BOX',
+                        'elementProperties': {
+                            'pageObjectId': page_id,
+                            'size': {
+                                'height': {'magnitude': magnitude_height, 'unit': 'PT'},
+                                'width': {'magnitude': magnitude_width, 'unit': 'PT'}
+                            },
+                            'transform': {
+                                'scaleX': 1,
+                                'scaleY': 1,
+                                'translateX': posx,
+                                'translateY': posy,
+                                'unit': 'PT'
                             }
-                        }                        
-                    },
-                    'fields': 'fontSize'
+                        }
+                    }
                 }
-            }            
-        ]
+            ]
+        self.touched.add(element_id)
+
+        # Insert text into the box, using the supplied element ID.
+        requests.append({
+            'insertText': {
+                'objectId': element_id,
+                'insertionIndex': 0,
+                'text': text
+            }
+        })
+        return requests
+
+    def create_textbox_with_text(self, presentation_id, page_id, text, magnitude_width, magnitude_height, posx, posy, fontsize, fontcolor, element_id=None):
+        if element_id is None:
+            element_id = str(uuid.uuid4())
+        requests = self.textbox_requests(
+            page_id, element_id, text, magnitude_width, magnitude_height, posx, posy)
+        requests.append(self.text_style_request(element_id, fontsize, fontcolor, 'fontSize'))
 
         # Execute the request.
-        body = {
-            'requests': requests
-        }
-        response = slides_service.presentations() \
-            .batchUpdate(presentationId=presentation_id, body=body).execute()
-        create_shape_response = response.get('replies')[0].get('createShape')
-        log.info('Created google slide textbox with ID: {0}'.format(
-            create_shape_response.get('objectId')))
+        response = self.execute(presentation_id, requests)
+        if response is not None:
+            create_shape_response = response.get('replies')[0].get('createShape')
+            log.info('Created google slide textbox with ID: {0}'.format(
+                create_shape_response.get('objectId')))
         # [END slides_create_textbox_with_text]
         return response    
 
-    def create_textbox_with_bullets(self, presentation_id, page_id, text, magnitude_width, magnitude_height, posx, posy, fontsize, fontcolor):
-        slides_service = self.service
-        # [START slides_create_textbox_with_text]
-        # Create a new square textbox, using the supplied element ID.
+    def create_textbox_with_bullets(self, presentation_id, page_id, text, magnitude_width, magnitude_height, posx, posy, fontsize, fontcolor, element_id=None):
         if text=="":
             return
-        element_id = str(uuid.uuid4())
-        requests = [
-            {
-                'createShape': {
-                    'objectId': element_id,
-                    'shapeType': 'TEXT_BOX',
+        if element_id is None:
+            element_id = str(uuid.uuid4())
+        requests = self.textbox_requests(
+            page_id, element_id, text, magnitude_width, magnitude_height, posx, posy)
+        requests.append(self.text_style_request(element_id, fontsize, fontcolor, 'foregroundColor,fontSize'))
+        requests.append({
+            'createParagraphBullets': {
+                'objectId': element_id,
+                'textRange': {
+                    'type': 'ALL'
+                },
+                'bulletPreset': 'BULLET_DISC_CIRCLE_SQUARE'
+            }
+        })
+
+        # Execute the request.
+        response = self.execute(presentation_id, requests)
+        if response is not None:
+            create_shape_response = response.get('replies')[0].get('createShape')
+            log.info('Created google slide textbox bullets with ID: {0}'.format(
+                create_shape_response.get('objectId')))
+        return response            
+    
+    def create_image(self, presentation_id, page_id, IMAGE_URL, magnitude_width, magnitude_height, posx, posy, image_id=None):
+        # [START slides_create_image]
+        if image_id is None:
+            image_id = str(uuid.uuid4())
+        requests = []
+        if image_id in self.existing:
+            # Replace the content of the existing image, keeping its size and position
+            requests.append({
+                'replaceImage': {
+                    'imageObjectId': image_id,
+                    'url': IMAGE_URL,
+                    'imageReplaceMethod': 'CENTER_INSIDE'
+                }
+            })
+        else:
+            # Create a new image, using the supplied object ID,
+            # with content downloaded from IMAGE_URL.
+            requests.append({
+                'createImage': {
+                    'objectId': image_id,
+                    'url': IMAGE_URL,
                     'elementProperties': {
                         'pageObjectId': page_id,
                         'size': {
                             'height': {'magnitude': magnitude_height, 'unit': 'PT'},
-                            'width': {'magnitude': magnitude_width, 'unit': 'PT'}
+                            'width': {'magnitude': magnitude_width, 'unit': 'PT'},
                         },
                         'transform': {
                             'scaleX': 1,
@@ -182,96 +399,47 @@ class SlidesSnippets(object):
                         }
                     }
                 }
-            },
-
-            # Insert text into the box, using the supplied element ID.
-            {
-                'insertText': {
-                    'objectId': element_id,
-                    'insertionIndex': 0,
-                    'text': text
-                }
-            },
-            
-            {
-                'updateTextStyle': {
-                    'objectId': element_id,
-                    'style': {
-                        'fontFamily': 'Times New Roman',
-                        'fontSize': {
-                            'magnitude': fontsize,
-                            'unit': 'PT'
-                        },
-                        'foregroundColor': {
-                            'opaqueColor': {
-                                'rgbColor': {
-                                    'blue': 0.0,
-                                    'green': 0.0,
-                                    'red': fontcolor
-                                }
-                            }
-                        }
-                    },
-                    'fields': 'foregroundColor,fontSize'
-                }
-            },
-            {
-                'createParagraphBullets': {
-                    'objectId': element_id,
-                    'textRange': {
-                        'type': 'ALL'
-                    },
-                    'bulletPreset': 'BULLET_DISC_CIRCLE_SQUARE'
-                }
-            }
-        ]
-
-        # Execute the request.
-        body = {
-            'requests': requests
-        }
-        response = slides_service.presentations() \
-            .batchUpdate(presentationId=presentation_id, body=body).execute()
-        create_shape_response = response.get('replies')[0].get('createShape')
-        log.info('Created google slide textbox bullets with ID: {0}'.format(
-            create_shape_response.get('objectId')))
-        return response            
-    
-    def create_image(self, presentation_id, page_id, IMAGE_URL, magnitude_width, magnitude_height, posx, posy):
-        slides_service = self.service
-        # [START slides_create_image]
-        # Create a new image, using the supplied object ID,
-        # with content downloaded from IMAGE_URL.
-        requests = []
-        image_id = str(uuid.uuid4())
-        requests.append({
-            'createImage': {
-                'objectId': image_id,
-                'url': IMAGE_URL,
-                'elementProperties': {
-                    'pageObjectId': page_id,
-                    'size': {
-                        'height': {'magnitude': magnitude_height, 'unit': 'PT'},
-                        'width': {'magnitude': magnitude_width, 'unit': 'PT'},
-                    },
-                    'transform': {
-                        'scaleX': 1,
-                        'scaleY': 1,
-                        'translateX': posx,
-                        'translateY': posy,
-                        'unit': 'PT'
-                    }
-                }
-            }
-        })
+            })
+        self.touched.add(image_id)
 
         # Execute the request.
-        body = {
-            'requests': requests
-        }
-        response = slides_service.presentations() \
-            .batchUpdate(presentationId=presentation_id, body=body).execute()
-        create_image_response = response.get('replies')[0].get('createImage')
-        log.info('Created google slide image with ID: {0}'.format(
-        create_image_response.get('objectId')))        
+        response = self.execute(presentation_id, requests)
+        if response is not None:
+            create_image_response = response.get('replies')[0].get('createImage')
+            log.info('Created google slide image with ID: {0}'.format(
+            create_image_response.get('objectId')))        
         return response
+
+
+class SlideRecorder():
+    '''
+    Stand-in for SlidesSnippets used while a scan is rendered by a publishing
+    backend (see cloud.backend): the calls building the slide are recorded and
+    handed to the backend when the slide is committed, to be replayed once the
+    presentation has been fetched and the images uploaded.
+    '''
+
+    def __init__(self, backend, tomolog):
+        self.backend = backend
+        self.tomolog = tomolog
+        self.page_id = None
+        self.calls = []
+        # the presentation is fetched at commit: the rollover is checked by the backend
+        self.nslides = 0
+        self.title = ''
+
+    def open_slide(self, presentation_id, page_id):
+        self.page_id = page_id
+        self.calls = []
+        # whether the slide is created is only known at commit, the history is saved then
+        return False
+
+    def commit(self, presentation_id):
+        self.backend.submit(self.tomolog, presentation_id, self.page_id, self.calls)
+        self.calls = []
+
+    def __getattr__(self, name):
+        # create_textbox_with_text, create_image, ...
+        def record(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+        return record
@@ -47,10 +47,20 @@
     tomolog-cli custom logger
     
 '''
+import json
+import atexit
 import logging
+import logging.handlers
+import multiprocessing
+
+from tomolog_cli import trace
 
 logger = logging.getLogger(__name__)
 
+# records are queued by the logging threads and processes and written by a single listener thread
+_queue = None
+_listener = None
+
 def info(msg, *args, **kwargs):
     logger.info(msg, *args, **kwargs)
 
@@ -65,18 +75,77 @@ def debug(msg, *args, **kwargs):
 
 def setup_custom_logger(lfname=None, stream_to_console=True):
 
+    global _queue, _listener
     logger.setLevel(logging.DEBUG)
 
+    handlers = []
     if (lfname != None):
         fHandler = logging.FileHandler(lfname)
         file_formatter = logging.Formatter('%(asctime)s - %(levelname)s: %(message)s')
         fHandler.setFormatter(file_formatter)
-        logger.addHandler(fHandler)
+        handlers.append(fHandler)
     if stream_to_console:
         ch = logging.StreamHandler()
         ch.setFormatter(ColoredLogFormatter('%(asctime)s - %(message)s'))
         ch.setLevel(logging.DEBUG)
-        logger.addHandler(ch)
+        handlers.append(ch)
+
+    # a multiprocessing queue, so that worker processes log through the same listener
+    # (spawn context, as the worker processes of the workers module)
+    _queue = multiprocessing.get_context('spawn').Queue(-1)
+    _listener = logging.handlers.QueueListener(_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logger)
+    setup_worker_logger(_queue)
+
+def setup_worker_logger(queue):
+    """Send the records of this process to the listener of the main process"""
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.setLevel(logging.DEBUG)
+    qHandler = logging.handlers.QueueHandler(queue)
+    qHandler.addFilter(ContextFilter())
+    logger.addHandler(qHandler)
+
+def queue():
+    """Queue of the log listener, to pass to setup_worker_logger in worker processes"""
+    return _queue
+
+def set_format(fmt):
+    """Format of the log file: 'text' or 'json' (one object per line)"""
+    if _listener is None or fmt != 'json':
+        return
+    for handler in _listener.handlers:
+        if isinstance(handler, logging.FileHandler):
+            handler.setFormatter(JsonLogFormatter())
+
+def stop_logger():
+    # write the queued records before exiting
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+class ContextFilter(logging.Filter):
+    # scan file and stage of the span the record is logged from, see trace.span
+    def filter(self, record):
+        record.scan = trace.current_scan()
+        record.stage = trace.current_stage()
+        return True
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'message': record.getMessage(),
+            'scan': getattr(record, 'scan', None),
+            'stage': getattr(record, 'stage', None),
+            'process': record.processName,
+            'thread': record.threadName,
+        }
+        # no exception field: QueueHandler.prepare already folds the traceback into the message
+        return json.dumps(entry)
 
 class ColoredLogFormatter(logging.Formatter):
     def __init__(self, fmt, datefmt=None, style='%'):
@@ -0,0 +1,259 @@
+# #########################################################################
+# Copyright (c) 2022, UChicago Argonne, LLC. All rights reserved.         #
+#                                                                         #
+# Copyright 2022. UChicago Argonne, LLC. This software was produced       #
+# under U.S. Government contract DE-AC02-06CH11357 for Argonne National   #
+# Laboratory (ANL), which is operated by UChicago Argonne, LLC for the    #
+# U.S. Department of Energy. The U.S. Government has rights to use,       #
+# reproduce, and distribute this software.  NEITHER THE GOVERNMENT NOR    #
+# UChicago Argonne, LLC MAKES ANY WARRANTY, EXPRESS OR IMPLIED, OR        #
+# ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If software is     #
+# modified to produce derivative works, such modified software should     #
+# be clearly marked, so as not to confuse it with the version available   #
+# from ANL.                                                               #
+#                                                                         #
+# Additionally, redistribution and use in source and binary forms, with   #
+# or without modification, are permitted provided that the following      #
+# conditions are met:                                                     #
+#                                                                         #
+#     * Redistributions of source code must retain the above copyright    #
+#       notice, this list of conditions and the following disclaimer.     #
+#                                                                         #
+#     * Redistributions in binary form must reproduce the above copyright #
+#       notice, this list of conditions and the following disclaimer in   #
+#       the documentation and/or other materials provided with the        #
+#       distribution.                                                     #
+#                                                                         #
+#     * Neither the name of UChicago Argonne, LLC, Argonne National       #
+#       Laboratory, ANL, the U.S. Government, nor the names of its        #
+#       contributors may be used to endorse or promote products derived   #
+#       from this software without specific prior written permission.     #
+#                                                                         #
+# THIS SOFTWARE IS PROVIDED BY UChicago Argonne, LLC AND CONTRIBUTORS     #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT       #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS       #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL UChicago     #
+# Argonne, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,        #
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,    #
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;        #
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER        #
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT      #
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN       #
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE         #
+# POSSIBILITY OF SUCH DAMAGE.                                             #
+# #########################################################################
+
+
+'''
+    Prometheus metrics of a publication run, written to a textfile for the
+    node exporter textfile collector (--metrics-file) or served on
+    http://127.0.0.1:<--metrics-port>/metrics
+'''
+
+import os
+import time
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from tomolog_cli import log
+from tomolog_cli import trace
+from tomolog_cli import retry
+
+__all__ = ['Counter', 'Gauge', 'Histogram', 'render', 'start', 'stop']
+
+# seconds, from a Slides call to a full scan
+BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_registry = []
+_lock = threading.Lock()
+
+
+def labels_text(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in labels) + '}'
+
+
+class Counter():
+    '''Monotonic value for each set of labels'''
+
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        return [(self.name, key, value) for key, value in self.values.items()]
+
+
+class Gauge(Counter):
+    '''Value that can go up and down, or computed when the metrics are rendered'''
+
+    kind = 'gauge'
+
+    def __init__(self, name, help):
+        super().__init__(name, help)
+        self.function = None
+
+    def set(self, value, **labels):
+        with _lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+    def set_function(self, function):
+        self.function = function
+
+    def samples(self):
+        if self.function is not None:
+            return [(self.name, (), self.function())]
+        return super().samples()
+
+
+class Histogram(Counter):
+    '''Cumulative bucket counts, sum and count of the observed values'''
+
+    kind = 'histogram'
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            buckets, total, count = self.values.get(key, ([0]*len(BUCKETS), 0.0, 0))
+            buckets = [n + (value <= le) for n, le in zip(buckets, BUCKETS)]
+            self.values[key] = (buckets, total + value, count + 1)
+
+    def samples(self):
+        samples = []
+        for key, (buckets, total, count) in self.values.items():
+            for n, le in zip(buckets, BUCKETS):
+                samples.append((self.name + '_bucket', key + (('le', str(le)),), n))
+            samples.append((self.name + '_bucket', key + (('le', '+Inf'),), count))
+            samples.append((self.name + '_sum', key, total))
+            samples.append((self.name + '_count', key, count))
+        return samples
+
+
+scans = Counter('tomolog_scans_total', 'Scans processed, by status (ok, error)')
+stage_seconds = Histogram('tomolog_stage_duration_seconds', 'Duration of the publication stages')
+read_bytes = Counter('tomolog_read_bytes_total', 'Bytes of data read, by stage')
+sent_bytes = Counter('tomolog_sent_bytes_total', 'Bytes sent to the image host and to Google Slides, by stage')
+pending_scans = Gauge('tomolog_pending_scans', 'Scans of the batch not processed yet')
+pending_slides = Gauge('tomolog_pending_slides', 'Rendered slides waiting for their uploads and commit (--backend async)')
+last_scan = Gauge('tomolog_last_scan_timestamp_seconds', 'Time the last scan was processed')
+
+
+def observe(span):
+    # trace listener
+    stage_seconds.observe(span.duration, stage=span.name)
+    if span.bytes_read:
+        read_bytes.inc(span.bytes_read, stage=span.name)
+    if span.bytes_sent:
+        sent_bytes.inc(span.bytes_sent, stage=span.name)
+    if span.name == 'scan':
+        scans.inc(status='error' if span.error else 'ok')
+        last_scan.set(time.time())
+
+
+trace.subscribe(observe)
+
+
+def render():
+    """Metrics in the Prometheus text exposition format"""
+    lines = []
+    with _lock:
+        for metric in _registry:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for name, key, value in metric.samples():
+                lines.append('%s%s %s' % (name, labels_text(key), value))
+    # calls of the retry policy shared by all the uploads and Slides calls
+    counters = retry.counters()
+    for name, kind, help, value in (
+            ('tomolog_api_calls_total', 'counter', 'Upload and Google API calls', counters['calls']),
+            ('tomolog_api_retries_total', 'counter', 'Retried upload and Google API calls', counters['retries']),
+            ('tomolog_api_throttled_total', 'counter', 'Calls retried after a rate limit error (HTTP 429)', counters['throttled']),
+            ('tomolog_api_retry_wait_seconds_total', 'counter', 'Time spent waiting between retries', counters['waited'])):
+        lines += ['# HELP %s %s' % (name, help), '# TYPE %s %s' % (name, kind), '%s %s' % (name, value)]
+    lines += ['# HELP tomolog_api_errors_total Failed upload and Google API attempts, by HTTP status or exception',
+              '# TYPE tomolog_api_errors_total counter']
+    for error, count in counters['errors'].items():
+        lines.append('tomolog_api_errors_total%s %s' % (labels_text((('error', error),)), count))
+    return '\n'.join(lines) + '\n'
+
+
+def write(fname):
+    # written aside and renamed: the collector never reads a partial file
+    tmp = fname + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(render())
+    os.replace(tmp, fname)
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        data = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class Exporter():
+    '''Background writer of --metrics-file and server of --metrics-port'''
+
+    def __init__(self, args):
+        self.fname = args.metrics_file
+        self.interval = args.metrics_interval
+        self.server = None
+        self.done = threading.Event()
+        if args.metrics_port > 0:
+            self.server = ThreadingHTTPServer(('127.0.0.1', args.metrics_port), Handler)
+            self.server.daemon_threads = True
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+            log.info('Serving metrics at http://127.0.0.1:%d/metrics' % args.metrics_port)
+        if self.fname is not None:
+            threading.Thread(target=self.write_loop, daemon=True).start()
+            log.info('Writing metrics to %s every %.0f s' % (self.fname, self.interval))
+
+    def write_loop(self):
+        while not self.done.wait(self.interval):
+            try:
+                write(self.fname)
+            except OSError as e:
+                log.warning('Could not write metrics to %s: %s' % (self.fname, e))
+
+    def stop(self):
+        self.done.set()
+        if self.fname is not None:
+            write(self.fname)
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+def start(args):
+    """Export the metrics as set by --metrics-file and --metrics-port, None when disabled"""
+    if args.metrics_file is None and args.metrics_port <= 0:
+        return None
+    return Exporter(args)
+
+
+def stop(exporter):
+    if exporter is not None:
+        exporter.stop()
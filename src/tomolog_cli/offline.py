@@ -0,0 +1,290 @@
+# #########################################################################
+# Copyright (c) 2022, UChicago Argonne, LLC. All rights reserved.         #
+#                                                                         #
+# Copyright 2022. UChicago Argonne, LLC. This software was produced       #
+# under U.S. Government contract DE-AC02-06CH11357 for Argonne National   #
+# Laboratory (ANL), which is operated by UChicago Argonne, LLC for the    #
+# U.S. Department of Energy. The U.S. Government has rights to use,       #
+# reproduce, and distribute this software.  NEITHER THE GOVERNMENT NOR    #
+# UChicago Argonne, LLC MAKES ANY WARRANTY, EXPRESS OR IMPLIED, OR        #
+# ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If software is     #
+# modified to produce derivative works, such modified software should     #
+# be clearly marked, so as not to confuse it with the version available   #
+# from ANL.                                                               #
+#                                                                         #
+# Additionally, redistribution and use in source and binary forms, with   #
+# or without modification, are permitted provided that the following      #
+# conditions are met:                                                     #
+#                                                                         #
+#     * Redistributions of source code must retain the above copyright    #
+#       notice, this list of conditions and the following disclaimer.     #
+#                                                                         #
+#     * Redistributions in binary form must reproduce the above copyright #
+#       notice, this list of conditions and the following disclaimer in   #
+#       the documentation and/or other materials provided with the        #
+#       distribution.                                                     #
+#                                                                         #
+#     * Neither the name of UChicago Argonne, LLC, Argonne National       #
+#       Laboratory, ANL, the U.S. Government, nor the names of its        #
+#       contributors may be used to endorse or promote products derived   #
+#       from this software without specific prior written permission.     #
+#                                                                         #
+# THIS SOFTWARE IS PROVIDED BY UChicago Argonne, LLC AND CONTRIBUTORS     #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT       #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS       #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL UChicago     #
+# Argonne, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,        #
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,    #
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;        #
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER        #
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT      #
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN       #
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE         #
+# POSSIBILITY OF SUCH DAMAGE.                                             #
+# #########################################################################
+
+
+'''
+    Local stand-in for Google Slides, Google Drive and the imgur upload service (--offline)
+
+    Serves the subset of the APIs used by tomolog on 127.0.0.1, keeping the
+    presentations in memory, so that the whole pipeline can be run and timed
+    without credentials, network access or SSH tunnel. Latency and rate limit
+    (HTTP 429) errors can be injected with --offline-latency and --offline-throttle.
+'''
+
+import re
+import copy
+import json
+import time
+import uuid
+import random
+import threading
+import urllib.parse
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from tomolog_cli import log
+
+__all__ = ['FakeGoogle', 'start', 'stop']
+
+
+class RequestError(Exception):
+    '''Invalid request, answered with HTTP 400'''
+
+
+class FakeGoogle():
+    '''
+    In memory presentations and the batchUpdate requests tomolog sends to them.
+    Like the real service, a batch update is applied entirely or not at all.
+    '''
+
+    def __init__(self, latency=0.0, throttle=0.0):
+        self.latency = latency
+        self.throttle = throttle
+        self.presentations = {}
+        self.lock = threading.Lock()
+
+        self.requests = 0
+        self.throttled = 0
+        self.uploads = 0
+        self.uploaded = 0
+
+    def presentation(self, presentation_id):
+        # presentations are created on first access, with the empty first slide of a new presentation
+        if presentation_id not in self.presentations:
+            self.presentations[presentation_id] = {
+                'presentationId': presentation_id,
+                'title': 'Offline presentation',
+                'slides': [{'objectId': 'p', 'pageElements': []}],
+            }
+        return self.presentations[presentation_id]
+
+    def get(self, presentation_id):
+        with self.lock:
+            return copy.deepcopy(self.presentation(presentation_id))
+
+    def batch_update(self, presentation_id, requests):
+        with self.lock:
+            presentation = copy.deepcopy(self.presentation(presentation_id))
+            replies = []
+            for k, request in enumerate(requests):
+                (kind, body), = request.items()
+                try:
+                    replies.append(self.apply(presentation, kind, body))
+                except RequestError as e:
+                    raise RequestError('Invalid requests[%d].%s: %s' % (k, kind, e))
+            self.presentations[presentation_id] = presentation
+        return {'presentationId': presentation_id, 'replies': replies}
+
+    def find(self, title):
+        with self.lock:
+            return [i for i, p in self.presentations.items() if p['title'] == title]
+
+    def copy(self, presentation_id, title):
+        with self.lock:
+            new_id = uuid.uuid4().hex
+            presentation = copy.deepcopy(self.presentation(presentation_id))
+            presentation['presentationId'] = new_id
+            presentation['title'] = title
+            self.presentations[new_id] = presentation
+        return new_id
+
+    def apply(self, presentation, kind, body):
+        slides = presentation['slides']
+        objects = {slide['objectId']: slide for slide in slides}
+        for slide in slides:
+            for element in slide['pageElements']:
+                objects[element['objectId']] = element
+
+        def new_object():
+            object_id = body.get('objectId') or uuid.uuid4().hex
+            if object_id in objects:
+                raise RequestError('The object ID (%s) should be unique.' % object_id)
+            return object_id
+
+        def existing(object_id):
+            if object_id not in objects:
+                raise RequestError('The object (%s) could not be found.' % object_id)
+            return objects[object_id]
+
+        if kind == 'createSlide':
+            object_id = new_object()
+            index = body.get('insertionIndex', len(slides))
+            if index > len(slides):
+                raise RequestError('The insertion index (%d) is out of range.' % index)
+            slides.insert(index, {'objectId': object_id, 'pageElements': []})
+            return {'createSlide': {'objectId': object_id}}
+        if kind in ('createShape', 'createImage'):
+            object_id = new_object()
+            page = existing(body['elementProperties']['pageObjectId'])
+            if kind == 'createShape':
+                element = {'objectId': object_id, 'shape': {'shapeType': body['shapeType']}}
+            else:
+                element = {'objectId': object_id, 'image': {'sourceUrl': body['url']}}
+            page['pageElements'].append(element)
+            return {kind: {'objectId': object_id}}
+        if kind == 'insertText':
+            shape = existing(body['objectId']).setdefault('shape', {})
+            content = shape.get('text', {}).get('textElements', [{}])[-1].get('textRun', {}).get('content', '')
+            shape['text'] = {'textElements': [{'textRun': {'content': content + body['text']}}]}
+            return {}
+        if kind == 'deleteText':
+            existing(body['objectId']).get('shape', {}).pop('text', None)
+            return {}
+        if kind == 'replaceImage':
+            existing(body['imageObjectId'])['image'] = {'sourceUrl': body['url']}
+            return {}
+        if kind == 'deleteObject':
+            object_id = body['objectId']
+            existing(object_id)
+            presentation['slides'] = slides = [slide for slide in slides if slide['objectId'] != object_id]
+            for slide in slides:
+                slide['pageElements'] = [e for e in slide['pageElements'] if e['objectId'] != object_id]
+            return {}
+        # style requests (updateTextStyle, createParagraphBullets, ...) only need an existing target
+        if 'objectId' in body:
+            existing(body['objectId'])
+        return {}
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        log.debug('offline: ' + format % args)
+
+    def reply(self, status, content, content_type='application/json'):
+        data = content.encode() if isinstance(content, str) else json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def error(self, status, message, reason):
+        self.reply(status, {'error': {'code': status, 'message': message, 'status': reason}})
+
+    def body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def delay(self):
+        # True when the request is answered with a rate limit error
+        google = self.server.google
+        if google.latency > 0:
+            time.sleep(google.latency*random.uniform(0.5, 1.5))
+        with google.lock:
+            google.requests += 1
+            if random.random() < google.throttle:
+                google.throttled += 1
+                self.error(429, 'Quota exceeded (offline throttling)', 'RESOURCE_EXHAUSTED')
+                return True
+        return False
+
+    def do_GET(self):
+        body = self.body()
+        if self.delay():
+            return
+        path = self.path.split('?')[0]
+        match = re.fullmatch(r'/v1/presentations/([^/:]+)', path)
+        if match:
+            return self.reply(200, self.server.google.get(match.group(1)))
+        if path == '/drive/v3/files':
+            # files().list(q="name = '...'"), used to find a copy made by a failed attempt
+            query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query).get('q', [''])[0]
+            match = re.search(r"name = '((?:[^'\\]|\\.)*)'", query)
+            name = re.sub(r'\\(.)', r'\1', match.group(1)) if match else None
+            return self.reply(200, {'files': [{'id': i} for i in self.server.google.find(name)]})
+        match = re.fullmatch(r'/drive/v3/files/([^/]+)/permissions', path)
+        if match:
+            return self.reply(200, {'permissions': [{'type': 'user', 'role': 'owner', 'emailAddress': 'offline@localhost'}]})
+        self.error(404, 'Not found: %s' % path, 'NOT_FOUND')
+
+    def do_POST(self):
+        body = self.body()
+        if self.delay():
+            return
+        google = self.server.google
+        path = self.path.split('?')[0]
+        if path == '/api/upload':
+            # imgur-like upload: the image is counted, not kept
+            match = re.search(rb'filename="[^"]*?(\.\w+)"', body)
+            ext = match.group(1).decode() if match else ''
+            with google.lock:
+                google.uploads += 1
+                google.uploaded += len(body)
+            link = 'http://%s:%d/images/%s%s' % (*self.server.server_address[:2], uuid.uuid4().hex, ext)
+            return self.reply(200, '{"link":"%s"}' % link, 'text/plain')
+        match = re.fullmatch(r'/v1/presentations/([^/:]+):batchUpdate', path)
+        if match:
+            try:
+                return self.reply(200, google.batch_update(match.group(1), json.loads(body)['requests']))
+            except RequestError as e:
+                return self.error(400, str(e), 'INVALID_ARGUMENT')
+        match = re.fullmatch(r'/drive/v3/files/([^/]+)/copy', path)
+        if match:
+            return self.reply(200, {'id': google.copy(match.group(1), json.loads(body or b'{}').get('name', ''))})
+        match = re.fullmatch(r'/drive/v3/files/([^/]+)/permissions', path)
+        if match:
+            return self.reply(200, {})
+        self.error(404, 'Not found: %s' % path, 'NOT_FOUND')
+
+
+def start(args):
+    """Start the local server in a background thread and point args at it"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    server.google = FakeGoogle(args.offline_latency/1000, args.offline_throttle)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    args.offline_url = 'http://127.0.0.1:%d' % server.server_address[1]
+    if args.presentation_url is None:
+        args.presentation_url = 'https://docs.google.com/presentation/d/offline/edit'
+    log.warning('Publishing offline to %s' % args.offline_url)
+    return server
+
+
+def stop(server):
+    google = server.google
+    server.shutdown()
+    server.server_close()
+    log.info('Offline server: %d requests (%d throttled), %d uploads (%.1f MB), %d presentations' % (
+        google.requests, google.throttled, google.uploads, google.uploaded/2**20, len(google.presentations)))
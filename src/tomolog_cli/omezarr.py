@@ -0,0 +1,161 @@
+# #########################################################################
+# Copyright (c) 2022, UChicago Argonne, LLC. All rights reserved.         #
+#                                                                         #
+# Copyright 2022. UChicago Argonne, LLC. This software was produced       #
+# under U.S. Government contract DE-AC02-06CH11357 for Argonne National   #
+# Laboratory (ANL), which is operated by UChicago Argonne, LLC for the    #
+# U.S. Department of Energy. The U.S. Government has rights to use,       #
+# reproduce, and distribute this software.  NEITHER THE GOVERNMENT NOR    #
+# UChicago Argonne, LLC MAKES ANY WARRANTY, EXPRESS OR IMPLIED, OR        #
+# ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If software is     #
+# modified to produce derivative works, such modified software should     #
+# be clearly marked, so as not to confuse it with the version available   #
+# from ANL.                                                               #
+#                                                                         #
+# Additionally, redistribution and use in source and binary forms, with   #
+# or without modification, are permitted provided that the following      #
+# conditions are met:                                                     #
+#                                                                         #
+#     * Redistributions of source code must retain the above copyright    #
+#       notice, this list of conditions and the following disclaimer.     #
+#                                                                         #
+#     * Redistributions in binary form must reproduce the above copyright #
+#       notice, this list of conditions and the following disclaimer in   #
+#       the documentation and/or other materials provided with the        #
+#       distribution.                                                     #
+#                                                                         #
+#     * Neither the name of UChicago Argonne, LLC, Argonne National       #
+#       Laboratory, ANL, the U.S. Government, nor the names of its        #
+#       contributors may be used to endorse or promote products derived   #
+#       from this software without specific prior written permission.     #
+#                                                                         #
+# THIS SOFTWARE IS PROVIDED BY UChicago Argonne, LLC AND CONTRIBUTORS     #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT       #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS       #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL UChicago     #
+# Argonne, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,        #
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,    #
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;        #
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER        #
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT      #
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN       #
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE         #
+# POSSIBILITY OF SUCH DAMAGE.                                             #
+# #########################################################################
+
+
+'''
+    Zarr and OME-Zarr reconstructions (--save-format zarr)
+
+    The reconstruction is a chunked zarr store, <base>_rec.zarr, holding the
+    (z, y, x) volume as an array, as exchange/data, or as the pyramid of a
+    multiscale OME-Zarr image. The zarr package is optional: it is imported
+    when the first store is opened.
+'''
+
+import itertools
+import concurrent.futures
+
+import numpy as np
+
+from tomolog_cli import log
+from tomolog_cli.volume import BlockVolume, selection
+
+__all__ = ['ZarrVolume', 'open_volume', 'levels']
+
+
+def _zarr():
+    try:
+        import zarr
+    except ImportError:
+        raise ImportError('Reading a zarr reconstruction needs the zarr package (pip install zarr)') from None
+    return zarr
+
+
+def levels(group):
+    """
+    Paths and axis names of the levels of an OME-Zarr multiscale image, from
+    the highest resolution on, or None when group is not multiscale.
+    """
+    attrs = dict(group.attrs)
+    # OME-Zarr 0.5 nests the metadata under 'ome'
+    multiscales = attrs.get('ome', attrs).get('multiscales')
+    if not multiscales:
+        return None
+    image = multiscales[0]
+    axes = [a['name'] if isinstance(a, dict) else a for a in image.get('axes', ['z', 'y', 'x'])]
+    return [(dataset['path'], axes) for dataset in image['datasets']]
+
+
+def open_volume(path, width=None, nthreads=8):
+    """
+    Open the zarr store path as a (z, y, x) ZarrVolume.
+
+    For a multiscale store the level read is the lowest resolution at least
+    width pixels wide in x, the highest one when width is None or no level
+    is wide enough. Its scale is the ratio of the level shapes.
+    """
+    zarr = _zarr()
+    root = zarr.open(path, mode='r')
+    attrs = dict(root.attrs)
+    if not hasattr(root, 'arrays'):
+        return ZarrVolume(root, nthreads, attrs=attrs)
+    multiscale = levels(root)
+    if multiscale is None:
+        if 'exchange/data' in root:
+            array = root['exchange/data']
+        else:
+            # first volume of the store
+            array = next(a for name, a in root.arrays() if a.ndim == 3)
+        attrs.update(array.attrs)
+        return ZarrVolume(array, nthreads, attrs=attrs)
+    arrays = [root[p] for p, axes in multiscale]
+    axes = multiscale[0][1]
+    # leading axes (t, c) are read at index 0
+    prefix = (0, )*(len(axes)-3)
+    if tuple(axes[-3:]) != ('z', 'y', 'x'):
+        raise KeyError(f'{path}: unsupported OME-Zarr axes {axes}')
+    level = 0
+    if width is not None:
+        wide = [k for k, a in enumerate(arrays) if a.shape[-1] >= width]
+        level = wide[-1] if wide else 0
+    array = arrays[level]
+    log.info(f'Reading level {multiscale[level][0]} {array.shape[-3:]} of the {len(arrays)} levels of {path}')
+    attrs.update(array.attrs)
+    scale = [n0/n for n0, n in zip(arrays[0].shape[-3:], array.shape[-3:])]
+    return ZarrVolume(array, nthreads, prefix, attrs, scale)
+
+
+class ZarrVolume(BlockVolume):
+    '''
+    (z, y, x) volume of a zarr array, indexed with integers, slices and id
+    lists. Each read fetches only the chunks intersecting the selection,
+    nthreads at a time (the zarr codecs release the GIL). scale is the size
+    of its pixels in pixels of the full resolution level, per axis.
+    '''
+
+    def __init__(self, array, nthreads=8, prefix=(), attrs=None, scale=(1, 1, 1)):
+        self.array = array
+        self.nthreads = nthreads
+        self.prefix = tuple(prefix)
+        self.shape = tuple(array.shape[len(self.prefix):])
+        self.dtype = array.dtype
+        self.attrs = dict(array.attrs) if attrs is None else attrs
+        self.chunks = tuple(array.chunks[len(self.prefix):])
+        self.fillvalue = array.fill_value if array.fill_value is not None else 0
+        self.scale = tuple(scale)
+
+    def block_reads(self, ids):
+        # ids of the selection in each chunk, per axis
+        axes = []
+        for i, c in zip(ids, self.chunks):
+            chunk = i//c
+            axes.append([(np.nonzero(chunk == j)[0], i[chunk == j]) for j in np.unique(chunk)])
+        return [([p for p, s in parts], self.prefix + tuple(selection(s) for p, s in parts))
+                for parts in itertools.product(*axes)]
+
+    def read_blocks(self, reads):
+        if len(reads) > 1 and self.nthreads > 1:
+            with concurrent.futures.ThreadPoolExecutor(self.nthreads) as executor:
+                return list(executor.map(lambda read: self.array.oindex[read[1]], reads))
+        return [self.array.oindex[read] for positions, read in reads]
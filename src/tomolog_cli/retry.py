@@ -0,0 +1,200 @@
+# #########################################################################
+# Copyright (c) 2022, UChicago Argonne, LLC. All rights reserved.         #
+#                                                                         #
+# Copyright 2022. UChicago Argonne, LLC. This software was produced       #
+# under U.S. Government contract DE-AC02-06CH11357 for Argonne National   #
+# Laboratory (ANL), which is operated by UChicago Argonne, LLC for the    #
+# U.S. Department of Energy. The U.S. Government has rights to use,       #
+# reproduce, and distribute this software.  NEITHER THE GOVERNMENT NOR    #
+# UChicago Argonne, LLC MAKES ANY WARRANTY, EXPRESS OR IMPLIED, OR        #
+# ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If software is     #
+# modified to produce derivative works, such modified software should     #
+# be clearly marked, so as not to confuse it with the version available   #
+# from ANL.                                                               #
+#                                                                         #
+# Additionally, redistribution and use in source and binary forms, with   #
+# or without modification, are permitted provided that the following      #
+# conditions are met:                                                     #
+#                                                                         #
+#     * Redistributions of source code must retain the above copyright    #
+#       notice, this list of conditions and the following disclaimer.     #
+#                                                                         #
+#     * Redistributions in binary form must reproduce the above copyright #
+#       notice, this list of conditions and the following disclaimer in   #
+#       the documentation and/or other materials provided with the        #
+#       distribution.                                                     #
+#                                                                         #
+#     * Neither the name of UChicago Argonne, LLC, Argonne National       #
+#       Laboratory, ANL, the U.S. Government, nor the names of its        #
+#       contributors may be used to endorse or promote products derived   #
+#       from this software without specific prior written permission.     #
+#                                                                         #
+# THIS SOFTWARE IS PROVIDED BY UChicago Argonne, LLC AND CONTRIBUTORS     #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT       #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS       #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL UChicago     #
+# Argonne, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,        #
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,    #
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;        #
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER        #
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT      #
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN       #
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE         #
+# POSSIBILITY OF SUCH DAMAGE.                                             #
+# #########################################################################
+
+'''
+    Retry policy shared by the Google Slides and image upload calls
+'''
+
+import time
+import socket
+import random
+import asyncio
+
+import socks
+import httplib2
+import requests
+
+from googleapiclient.errors import HttpError
+
+from tomolog_cli import log
+
+__all__ = ['RetryPolicy', 'ServiceError', 'setup', 'call', 'acall', 'counters', 'merge', 'report']
+
+# HTTP status codes worth retrying: rate limiting and server side errors
+TRANSIENT_STATUS = (408, 429, 500, 502, 503, 504)
+
+
+class ServiceError(RuntimeError):
+    '''Request rejected by a web service (image upload, Google Slides)'''
+
+    def __init__(self, status, msg):
+        super().__init__(msg)
+        self.status = status
+
+
+def status_code(e):
+    """HTTP status of an exception raised by an API call, None when there is none"""
+    if isinstance(e, HttpError):
+        return int(e.resp.status)
+    if isinstance(e, ServiceError):
+        return e.status
+    return None
+
+
+def is_transient(e):
+    """True for failures that may succeed when the call is repeated"""
+    status = status_code(e)
+    if status is not None:
+        return status in TRANSIENT_STATUS
+    # connection resets and timeouts, including the ones through the SOCKS tunnel,
+    # and the proxy and name resolution failures of the httplib2 client of googleapiclient
+    return isinstance(e, (requests.ConnectionError, requests.Timeout, socket.timeout,
+                          ConnectionError, TimeoutError, socks.ProxyError,
+                          httplib2.ServerNotFoundError))
+
+
+class RetryPolicy():
+    '''
+    Jittered exponential backoff: the n-th retry waits a random time between 0
+    and min(cap, base*2**n) seconds. A call gives up after `retries` retries, and
+    all the calls of a run together stop retrying after waiting `budget` seconds.
+    '''
+
+    def __init__(self, retries=5, base=1.0, cap=32.0, budget=300.0):
+        self.retries = retries
+        self.base = base
+        self.cap = cap
+        self.budget = budget
+
+        self.calls = 0
+        self.count = 0
+        self.throttled = 0
+        self.waited = 0.0
+        # failed attempts, by HTTP status or exception name
+        self.errors = {}
+
+    def backoff(self, e, attempt, description):
+        # time to wait before retrying a failed call, None when the failure is final
+        status = status_code(e)
+        key = str(status) if status is not None else type(e).__name__
+        self.errors[key] = self.errors.get(key, 0) + 1
+        if not is_transient(e) or attempt >= self.retries or self.waited >= self.budget:
+            return None
+        delay = min(random.uniform(0, min(self.cap, self.base*2**attempt)),
+                    self.budget-self.waited)
+        log.warning('%s failed (%s): retry %d/%d in %.1f s' % (
+            description, e, attempt+1, self.retries, delay))
+        if status == 429:
+            self.throttled += 1
+        self.count += 1
+        self.waited += delay
+        return delay
+
+    def call(self, func, description):
+        self.calls += 1
+        attempt = 0
+        while True:
+            try:
+                return func()
+            except Exception as e:
+                delay = self.backoff(e, attempt, description)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+
+    async def acall(self, func, description):
+        # same as call for a coroutine function, waiting without blocking the event loop
+        self.calls += 1
+        attempt = 0
+        while True:
+            try:
+                return await func()
+            except Exception as e:
+                delay = self.backoff(e, attempt, description)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+
+
+_policy = RetryPolicy()
+
+
+def setup(args):
+    global _policy
+    _policy = RetryPolicy(retries=args.retries, budget=args.retry_budget)
+
+
+def call(func, description):
+    """Call func(), retrying transient failures with the shared policy"""
+    return _policy.call(func, description)
+
+
+async def acall(func, description):
+    """Await func(), retrying transient failures with the shared policy"""
+    return await _policy.acall(func, description)
+
+
+def counters():
+    """Calls, retries, rate limited retries, waiting time and errors of the shared policy"""
+    return {'calls': _policy.calls, 'retries': _policy.count, 'throttled': _policy.throttled,
+            'waited': _policy.waited, 'errors': dict(_policy.errors)}
+
+
+def merge(counts):
+    """Add the counters of a worker process to the shared policy"""
+    _policy.calls += counts['calls']
+    _policy.count += counts['retries']
+    _policy.throttled += counts['throttled']
+    _policy.waited += counts['waited']
+    for key, n in counts['errors'].items():
+        _policy.errors[key] = _policy.errors.get(key, 0) + n
+
+
+def report():
+    if _policy.calls > 0:
+        log.info('Network calls: %d, retries: %d (%d rate limited), time spent waiting: %.1f s' % (
+            _policy.calls, _policy.count, _policy.throttled, _policy.waited))
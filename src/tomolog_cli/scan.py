@@ -0,0 +1,267 @@
+# #########################################################################
+# Copyright (c) 2022, UChicago Argonne, LLC. All rights reserved.         #
+#                                                                         #
+# Copyright 2022. UChicago Argonne, LLC. This software was produced       #
+# under U.S. Government contract DE-AC02-06CH11357 for Argonne National   #
+# Laboratory (ANL), which is operated by UChicago Argonne, LLC for the    #
+# U.S. Department of Energy. The U.S. Government has rights to use,       #
+# reproduce, and distribute this software.  NEITHER THE GOVERNMENT NOR    #
+# UChicago Argonne, LLC MAKES ANY WARRANTY, EXPRESS OR IMPLIED, OR        #
+# ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If software is     #
+# modified to produce derivative works, such modified software should     #
+# be clearly marked, so as not to confuse it with the version available   #
+# from ANL.                                                               #
+#                                                                         #
+# Additionally, redistribution and use in source and binary forms, with   #
+# or without modification, are permitted provided that the following      #
+# conditions are met:                                                     #
+#                                                                         #
+#     * Redistributions of source code must retain the above copyright    #
+#       notice, this list of conditions and the following disclaimer.     #
+#                                                                         #
+#     * Redistributions in binary form must reproduce the above copyright #
+#       notice, this list of conditions and the following disclaimer in   #
+#       the documentation and/or other materials provided with the        #
+#       distribution.                                                     #
+#                                                                         #
+#     * Neither the name of UChicago Argonne, LLC, Argonne National       #
+#       Laboratory, ANL, the U.S. Government, nor the names of its        #
+#       contributors may be used to endorse or promote products derived   #
+#       from this software without specific prior written permission.     #
+#                                                                         #
+# THIS SOFTWARE IS PROVIDED BY UChicago Argonne, LLC AND CONTRIBUTORS     #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT       #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS       #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL UChicago     #
+# Argonne, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,        #
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,    #
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;        #
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER        #
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT      #
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN       #
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE         #
+# POSSIBILITY OF SUCH DAMAGE.                                             #
+# #########################################################################
+
+import os
+import time
+import h5py
+import numpy as np
+
+from tomolog_cli import log
+from tomolog_cli import vds
+from tomolog_cli import omezarr
+
+__author__ = "Viktor Nikitin,  Francesco De Carlo"
+__copyright__ = "Copyright (c) 2022, UChicago Argonne, LLC."
+__docformat__ = 'restructuredtext en'
+__all__ = ['ScanFiles', 'TransposedVolume']
+
+# axis order of the h5sino volume when its dataset has no 'axes' attribute
+SINO_AXES = ('y', 'z', 'x')
+
+
+class ScanFiles():
+    '''
+    Raw and reconstruction files of one scan. Each file is opened at most once
+    and the handles are shared by all the publishing stages, so a scan costs
+    one open (one metadata-server round trip on Lustre/GPFS) per file.
+    '''
+
+    def __init__(self, args, rec_dir):
+        self.args = args
+        self.file_name = str(args.file_name)
+        self.basename = os.path.basename(self.file_name)[:-3]
+        self.rec_dir = rec_dir
+        self.h5_path = f'{rec_dir}/{self.basename}_rec.h5'
+        self.tiff_dir = f'{rec_dir}/{self.basename}_rec'
+        self.zarr_path = f'{rec_dir}/{self.basename}_rec.zarr'
+
+        self._raw = None
+        self._recon = None
+        self._volume = None
+        self.layout = self._resolve_layout()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _open(self, fname, swmr=False):
+        # a larger chunk cache keeps the chunks shared by successive slice reads
+        return h5py.File(fname, 'r', libver='latest', swmr=swmr,
+                         rdcc_nbytes=int(self.args.h5_cache*2**20))
+
+    def _resolve_layout(self):
+        """Resolve the reconstruction layout — 'h5', 'h5sino', 'zarr', 'tiff', or None.
+
+        If --save-format is 'auto' (default), inspect the filesystem and pick:
+          - 'h5'     when <rec_dir>/<base>_rec.h5 exists (h5/h5nolinks output)
+          - 'h5sino' when that file holds a volume in sinogram order (see recon_volume)
+          - 'zarr'   when the <rec_dir>/<base>_rec.zarr store exists (zarr or OME-Zarr)
+          - 'tiff'   when <rec_dir>/<base>_rec/ directory exists
+          - None     when neither is present (caller logs a warning)
+        If --save-format is set explicitly, honor it. 'h5' and 'h5nolinks'
+        both map to the single-h5-file reader (h5py reads them identically).
+        """
+        if self.args.save_format == 'auto':
+            if os.path.exists(self.h5_path):
+                if self._sino_ordered():
+                    log.info(f'Detected reconstruction layout: h5sino ({self.h5_path})')
+                    return 'h5sino'
+                log.info(f'Detected reconstruction layout: h5 ({self.h5_path})')
+                return 'h5'
+            if os.path.isdir(self.zarr_path):
+                log.info(f'Detected reconstruction layout: zarr ({self.zarr_path})')
+                return 'zarr'
+            if os.path.isdir(self.tiff_dir):
+                log.info(f'Detected reconstruction layout: tiff ({self.tiff_dir})')
+                return 'tiff'
+            log.warning(f'No reconstruction found at {self.h5_path}, {self.zarr_path} or {self.tiff_dir}')
+            return None
+        if self.args.save_format in ('h5', 'h5nolinks'):
+            return 'h5'
+        if self.args.save_format in ('h5sino', 'zarr'):
+            return self.args.save_format
+        return 'tiff'
+
+    def _sino_ordered(self):
+        # no (z, y, x) /exchange/data: the volume is stored in another axis order
+        try:
+            if 'exchange/data' not in self.recon:
+                return True
+            return self._axes(self.recon['exchange/data']) not in (None, ('z', 'y', 'x'))
+        except OSError:
+            return False
+
+    @staticmethod
+    def _axes(dset):
+        axes = dset.attrs.get('axes')
+        if axes is None:
+            return None
+        if isinstance(axes, bytes):
+            axes = axes.decode()
+        return tuple(a.strip() for a in axes.split(','))
+
+    def recon_volume(self, width=None):
+        """
+        Reconstructed volume of the h5 and zarr layouts, indexed in (z, y, x) order.
+
+        A virtual dataset is read from its source files in parallel (see vds),
+        unless --vds-read is serial. h5sino stores the volume in sinogram
+        order, (y, z, x) unless the dataset has an 'axes' attribute (e.g.
+        'y,z,x'): it is returned as a TransposedVolume, read in its native order.
+        A zarr store is read by chunks, --nproc threads at a time; of a
+        multiscale OME-Zarr store, the level read is the lowest resolution at
+        least width pixels wide (see omezarr.open_volume).
+        """
+        if self._volume is None:
+            if self.layout == 'zarr':
+                self._volume = omezarr.open_volume(self.zarr_path, width, self.args.nproc)
+            else:
+                self._volume = self._open_volume()
+        return self._volume
+
+    def _open_volume(self):
+        dset = self.recon.get('exchange/data')
+        if dset is None and self.layout == 'h5sino':
+            # first volume of /exchange
+            dset = next(d for d in self.recon['exchange'].values()
+                        if isinstance(d, h5py.Dataset) and d.ndim == 3)
+        elif dset is None:
+            raise KeyError('exchange/data')
+        axes = self._axes(dset) or SINO_AXES
+        nworkers = vds.workers(self.args.nproc)
+        if self.args.vds_read == 'parallel' and nworkers > 1:
+            # on a single CPU HDF5 reads the virtual dataset faster
+            blocks = vds.sources(dset)
+            if blocks:
+                log.info(f'Reading the {len(blocks)} source blocks of {self.h5_path} with {nworkers} processes')
+                dset = vds.VirtualVolume(dset, blocks, nworkers, int(self.args.h5_cache*2**20))
+        if self.layout != 'h5sino':
+            return dset
+        return TransposedVolume(dset, axes)
+
+    @property
+    def raw(self):
+        """Raw data file, opened on first use"""
+        if self._raw is None:
+            # in --live mode the file may still be open for writing
+            self._raw = self._open(self.file_name, swmr=self.args.live)
+        return self._raw
+
+    @property
+    def recon(self):
+        """Reconstruction h5 file, opened on first use"""
+        if self._recon is None:
+            self._recon = self._open(self.h5_path)
+        return self._recon
+
+    def refresh(self, name='exchange/data'):
+        """Dataset of the raw file, refreshed to the size flushed by a SWMR writer"""
+        dset = self.raw[name]
+        if self.args.live:
+            dset.refresh()
+        return dset
+
+    def wait_for_frames(self, nframes, name='exchange/data'):
+        """
+        Wait until nframes frames of the raw dataset have been flushed.
+
+        Returns
+        -------
+        bool
+            False when --live-timeout expires first.
+        """
+        t = time.time()
+        while True:
+            n = self.refresh(name).shape[0]
+            if n >= nframes:
+                return True
+            if time.time()-t > self.args.live_timeout:
+                log.warning(f'{self.file_name}: {n}/{nframes} frames written after {self.args.live_timeout} s')
+                return False
+            log.info(f'{self.file_name}: {n}/{nframes} frames written, waiting')
+            time.sleep(self.args.live_interval)
+
+    def close(self):
+        for fid in (self._raw, self._recon):
+            if fid is not None:
+                fid.close()
+        self._raw = None
+        self._recon = None
+        if isinstance(self._volume, vds.VirtualVolume):
+            # the source files of its parallel reads
+            vds.release()
+        self._volume = None
+
+
+class TransposedVolume():
+    '''
+    (z, y, x) view of a volume stored with another axis order, e.g. the
+    (y, z, x) sinogram order of h5sino. Each read is made in the native order
+    of the dataset, so only the chunks of the requested slices are read, and
+    only its result is transposed: the volume is never copied.
+    '''
+
+    def __init__(self, dset, axes):
+        self.dset = dset
+        # axis of the dataset holding z, y and x
+        self.order = [axes.index(a) for a in ('z', 'y', 'x')]
+        self.shape = tuple(dset.shape[axis] for axis in self.order)
+        self.dtype = dset.dtype
+        self.attrs = dset.attrs
+        self.chunks = None if dset.chunks is None else tuple(dset.chunks[axis] for axis in self.order)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key, )
+        key = key + (slice(None), )*(3-len(key))
+        native = [None]*3
+        for index, axis in zip(key, self.order):
+            native[axis] = index
+        data = self.dset[tuple(native)]
+        # axes left in the result, in dataset order, put back in (z, y, x) order
+        kept = [axis for axis in range(3) if not isinstance(native[axis], (int, np.integer))]
+        return np.transpose(data, [kept.index(axis) for axis in self.order if axis in kept])
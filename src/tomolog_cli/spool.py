@@ -0,0 +1,363 @@
+# #########################################################################
+# Copyright (c) 2022, UChicago Argonne, LLC. All rights reserved.         #
+#                                                                         #
+# Copyright 2022. UChicago Argonne, LLC. This software was produced       #
+# under U.S. Government contract DE-AC02-06CH11357 for Argonne National   #
+# Laboratory (ANL), which is operated by UChicago Argonne, LLC for the    #
+# U.S. Department of Energy. The U.S. Government has rights to use,       #
+# reproduce, and distribute this software.  NEITHER THE GOVERNMENT NOR    #
+# UChicago Argonne, LLC MAKES ANY WARRANTY, EXPRESS OR IMPLIED, OR        #
+# ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If software is     #
+# modified to produce derivative works, such modified software should     #
+# be clearly marked, so as not to confuse it with the version available   #
+# from ANL.                                                               #
+#                                                                         #
+# Additionally, redistribution and use in source and binary forms, with   #
+# or without modification, are permitted provided that the following      #
+# conditions are met:                                                     #
+#                                                                         #
+#     * Redistributions of source code must retain the above copyright    #
+#       notice, this list of conditions and the following disclaimer.     #
+#                                                                         #
+#     * Redistributions in binary form must reproduce the above copyright #
+#       notice, this list of conditions and the following disclaimer in   #
+#       the documentation and/or other materials provided with the        #
+#       distribution.                                                     #
+#                                                                         #
+#     * Neither the name of UChicago Argonne, LLC, Argonne National       #
+#       Laboratory, ANL, the U.S. Government, nor the names of its        #
+#       contributors may be used to endorse or promote products derived   #
+#       from this software without specific prior written permission.     #
+#                                                                         #
+# THIS SOFTWARE IS PROVIDED BY UChicago Argonne, LLC AND CONTRIBUTORS     #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT       #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS       #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL UChicago     #
+# Argonne, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,        #
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,    #
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;        #
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER        #
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT      #
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN       #
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE         #
+# POSSIBILITY OF SUCH DAMAGE.                                             #
+# #########################################################################
+
+
+'''
+    Slide spool: tomolog prepare and tomolog publish
+
+    tomolog prepare reads and renders the scans next to the storage, without
+    network access: the content of each slide (images, description, command
+    line and layout) is written to a bundle directory in --spool-dir.
+    tomolog publish, run on a computer with internet access, uploads the images
+    and sends the slides of --spool-batch bundles in one batchUpdate.
+
+    A bundle holds the images and bundle.json: the slide calls of the scan
+    recorded by SlideRecorder, with {"image": name} in place of the image urls.
+    Bundles are written under a hidden name and renamed when complete, so that
+    the publisher never sees a partial bundle.
+'''
+
+import os
+import json
+import time
+import shutil
+import datetime
+import tempfile
+
+from tomolog_cli import log
+from tomolog_cli import auth
+from tomolog_cli import cloud
+from tomolog_cli import trace
+from tomolog_cli import tomolog
+from tomolog_cli.google_snippets import SlideRecorder
+
+__all__ = ['SpoolBackend', 'Publisher', 'bundles', 'prepare', 'publish']
+
+BUNDLE = 'bundle.json'
+VERSION = 1
+# failed publications of a bundle, and where it goes after --spool-attempts
+ATTEMPTS = 'attempts'
+FAILED = 'failed'
+
+
+def _json_default(value):
+    # numpy scalars in the slide geometry
+    if hasattr(value, 'item'):
+        return value.item()
+    raise TypeError('%s is not JSON serializable' % type(value).__name__)
+
+
+class SpoolBackend():
+    '''
+    Publishing backend of tomolog prepare: the images and the slide calls of
+    each scan are written to a bundle instead of being sent.
+    '''
+
+    # all the image services: the publisher uploads with its own --cloud-service
+    services = ('imgur', 'aps')
+
+    def __init__(self, args):
+        self.args = args
+        self.spool_dir = args.spool_dir
+        os.makedirs(self.spool_dir, exist_ok=True)
+        # bundle being written, hidden until complete
+        self.staging = None
+        self.nimages = 0
+        self.written = 0
+
+    def recorder(self, tomolog):
+        return SlideRecorder(self, tomolog)
+
+    def stage(self):
+        if self.staging is None:
+            self.staging = tempfile.mkdtemp(prefix='.prepare-', dir=self.spool_dir)
+            self.nimages = 0
+        return self.staging
+
+    def upload(self, args, filename):
+        # the image is copied now: the file is overwritten by the next scan
+        staging = self.stage()
+        name = 'image-%02d%s' % (self.nimages, os.path.splitext(filename)[1])
+        shutil.copyfile(filename, os.path.join(staging, name))
+        self.nimages += 1
+        args.count = args.count + 1
+        return {'image': name}
+
+    def submit(self, tomolog, presentation_id, page_id, calls):
+        # the presentation is the one of the publisher: presentation_id is dropped
+        bundle = {
+            'version': VERSION,
+            'file_name': tomolog.args.file_name,
+            'page_id': page_id,
+            'history': tomolog.history_entry(None),
+            'calls': [[name, list(args[1:]), kwargs] for name, args, kwargs in calls],
+        }
+        staging = self.stage()
+        with open(os.path.join(staging, BUNDLE), 'w') as f:
+            json.dump(bundle, f, default=_json_default)
+        # named by creation time: the bundles are published in the order they were prepared
+        basename = os.path.basename(tomolog.args.file_name)[:-3]
+        path = os.path.join(self.spool_dir, '%d_%s' % (time.time_ns(), basename))
+        os.rename(staging, path)
+        self.staging = None
+        self.written += 1
+        log.info('Slide of %s written to %s' % (basename, path))
+
+    def discard(self):
+        # leftovers of a scan that failed before its commit
+        if self.staging is not None:
+            shutil.rmtree(self.staging, ignore_errors=True)
+            self.staging = None
+
+
+def bundles(spool_dir):
+    """Complete bundles of spool_dir, oldest first"""
+    if not os.path.isdir(spool_dir):
+        return []
+    names = sorted(name for name in os.listdir(spool_dir)
+                   if not name.startswith('.') and os.path.exists(os.path.join(spool_dir, name, BUNDLE)))
+    return [os.path.join(spool_dir, name) for name in names]
+
+
+def attempts(path):
+    """Number of failed publications of the bundle path"""
+    try:
+        with open(os.path.join(path, ATTEMPTS)) as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return 0
+
+
+def load(path):
+    with open(os.path.join(path, BUNDLE)) as f:
+        bundle = json.load(f)
+    if bundle.get('version') != VERSION:
+        raise ValueError('bundle version %s, expected %d' % (bundle.get('version'), VERSION))
+    return bundle
+
+
+class Publisher():
+    '''
+    Publishes the bundles of the spool to --presentation-url. The slides of a
+    batch are sent in one batchUpdate, following a --max-slides rollover; a
+    bundle is removed once its slide is published.
+    '''
+
+    def __init__(self, args, token_fname):
+        self.args = args
+        self.google_slide = auth.google_slide(args, token_fname)
+        # TomoLog used for the rollovers, created on the first one
+        self.owner = None
+        self.published = 0
+        self.failed = 0
+
+    def resolve(self, path, value):
+        if isinstance(value, dict) and set(value) == {'image'}:
+            return cloud.upload(self.args, os.path.join(path, value['image']))
+        return value
+
+    def upload(self, path, bundle):
+        calls = []
+        for name, args, kwargs in bundle['calls']:
+            args = [self.resolve(path, a) for a in args]
+            kwargs = {key: self.resolve(path, value) for key, value in kwargs.items()}
+            calls.append((name, args, kwargs))
+        return calls
+
+    def rollover(self, presentation_id):
+        if self.owner is None:
+            self.owner = tomolog.TomoLog(self.args)
+        self.owner.google_slide = self.google_slide
+        return self.owner.rollover(presentation_id)
+
+    def publish_batch(self, paths):
+        try:
+            self._publish_batch(paths)
+        finally:
+            # the images of the whole batch, once all its slides are sent (--cloud-service aps)
+            cloud.remove_files()
+
+    def _publish_batch(self, paths):
+        # a scan prepared again (e.g. --live updates) supersedes its earlier bundles
+        latest = {}
+        for path in paths:
+            try:
+                bundle = load(path)
+            except (OSError, ValueError) as e:
+                # unreadable: not retried
+                self.fail(path, e, final=True)
+                continue
+            previous = latest.pop(bundle['page_id'], None)
+            if previous is not None:
+                log.info('Bundle %s superseded by %s' % (previous[0], path))
+                shutil.rmtree(previous[0])
+            latest[bundle['page_id']] = (path, bundle)
+
+        slides = []
+        for path, bundle in latest.values():
+            try:
+                with trace.span('upload_bundle', scan=os.path.basename(bundle['file_name'])):
+                    slides.append((path, bundle, self.upload(path, bundle)))
+            except Exception as e:
+                self.fail(path, 'upload of the images: %s' % e)
+        if not slides:
+            return
+
+        presentation_id = auth.extract_presentation_id(self.args.presentation_url)
+        presentation = self.google_slide.get_presentation(presentation_id)
+        requests = []
+        done = []
+        for path, bundle, calls in slides:
+            page_id = bundle['page_id']
+            if self.publish_earlier(path, bundle, calls):
+                continue
+            created = self.google_slide.load_slide(presentation, page_id)
+            if created and 0 < self.args.max_slides <= self.google_slide.nslides:
+                self.send(presentation_id, requests, done)
+                requests, done = [], []
+                presentation_id = self.rollover(presentation_id)
+                presentation = self.google_slide.get_presentation(presentation_id)
+                created = self.google_slide.load_slide(presentation, page_id)
+            for name, args, kwargs in calls:
+                getattr(self.google_slide, name)(presentation_id, *args, **kwargs)
+            requests += self.google_slide.commit_requests()
+            if created:
+                # the next new slide of the batch is inserted after this one
+                presentation.setdefault('slides', []).append({'objectId': page_id})
+            done.append((path, bundle, created))
+        self.send(presentation_id, requests, done)
+
+    def fail(self, path, error, final=False):
+        # kept for the next publish, moved to failed/ after --spool-attempts
+        self.failed += 1
+        n = attempts(path) + 1
+        if not final and n < self.args.spool_attempts:
+            log.error('Failed to publish %s (attempt %d/%d): %s' % (path, n, self.args.spool_attempts, error))
+            with open(os.path.join(path, ATTEMPTS), 'w') as f:
+                f.write(str(n))
+            return
+        failed_dir = os.path.join(self.args.spool_dir, FAILED)
+        os.makedirs(failed_dir, exist_ok=True)
+        shutil.move(path, os.path.join(failed_dir, os.path.basename(path)))
+        log.error('Failed to publish %s after %d attempts, moved to %s: %s' % (path, n, failed_dir, error))
+
+    def publish_earlier(self, path, bundle, calls):
+        # a slide published before a rollover is updated in its presentation, in its own batch
+        if self.args.offline:
+            return False
+        url = tomolog.published_deck(bundle['file_name'], self.args.presentation_url)
+        if url is None:
+            return False
+        presentation_id = auth.extract_presentation_id(url)
+        if self.google_slide.load_slide(self.google_slide.get_presentation(presentation_id), bundle['page_id']):
+            # no longer there: published in the current presentation
+            return False
+        for name, args, kwargs in calls:
+            getattr(self.google_slide, name)(presentation_id, *args, **kwargs)
+        requests = self.google_slide.commit_requests()
+        self.send(presentation_id, requests, [(path, bundle, False)])
+        return True
+
+    def send(self, presentation_id, requests, done):
+        if not done:
+            return
+        try:
+            self.google_slide.send(presentation_id, requests)
+        except Exception as e:
+            # the batch is atomic: its bundles are kept for the next publish
+            log.error('Failed to publish %d slides: %s' % (len(done), e))
+            for path, bundle, created in done:
+                self.fail(path, e)
+            return
+        log.info('Published %d slides in one batch update of %d requests' % (len(done), len(requests)))
+        for path, bundle, created in done:
+            if created and not self.args.offline:
+                entry = bundle['history']
+                entry['date'] = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                entry['presentation_url'] = str(self.args.presentation_url)
+                if self.owner is not None and self.owner.rolled_over_from is not None:
+                    entry['rolled_over_from'] = str(self.owner.rolled_over_from)
+                tomolog.save_history(entry)
+            shutil.rmtree(path)
+            self.published += 1
+
+
+def prepare(args, file_names, tomolog_class):
+    backend = SpoolBackend(args)
+    cloud.backend = backend
+    if args.presentation_url is None:
+        # only needed to name the slide calls: tomolog publish sends them to its own --presentation-url
+        args.presentation_url = 'https://docs.google.com/presentation/d/spool/edit'
+    try:
+        for index, file_name in enumerate(file_names):
+            log.warning("  *** file %d/%d;  %s" % (index, len(file_names), file_name))
+            args.file_name = file_name
+            try:
+                tomolog_class(args).run_log()
+            except Exception as e:
+                log.error("Failed to prepare %s: %s — continuing batch", file_name, e)
+            finally:
+                backend.discard()
+    finally:
+        cloud.backend = None
+    log.info('Wrote %d slide bundles to %s' % (backend.written, args.spool_dir))
+
+
+def publish(args, token_fname):
+    publisher = Publisher(args, token_fname)
+    while True:
+        paths = bundles(args.spool_dir)
+        if paths:
+            log.info('Publishing %d slide bundles from %s' % (len(paths), args.spool_dir))
+        # the bundles that failed before are sent alone: they do not fail the batches of the others
+        for path in [path for path in paths if attempts(path) > 0]:
+            publisher.publish_batch([path])
+        paths = [path for path in paths if attempts(path) == 0 and os.path.exists(path)]
+        for start in range(0, len(paths), args.spool_batch):
+            publisher.publish_batch(paths[start:start+args.spool_batch])
+        if args.spool_poll <= 0:
+            break
+        time.sleep(args.spool_poll)
+    log.info('Published %d slides, %d failed' % (publisher.published, publisher.failed))
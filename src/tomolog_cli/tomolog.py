@@ -44,11 +44,11 @@
 # #########################################################################
 
 import os
-import uuid
+import time
+import hashlib
 import pathlib
 import datetime
 import yaml
-import h5py
 import matplotlib.pyplot as plt
 import numpy as np
 
@@ -63,6 +63,8 @@ from tomolog_cli import log
 from tomolog_cli import auth
 from tomolog_cli import utils
 from tomolog_cli import cloud
+from tomolog_cli import scan
+from tomolog_cli import trace
 
 __author__ = "Viktor Nikitin,  Francesco De Carlo"
 __copyright__ = "Copyright (c) 2022, UChicago Argonne, LLC."
@@ -72,11 +74,61 @@ __all__ = ['TomoLog', ]
 # Temporary local files to be uploaded to the url service. Google API retrieves images by url before publishing on slides
 FILE_NAME_PROJ  = 'projection'
 FILE_NAME_RECON = 'reconstruction'
+FILE_NAME_ANIM  = 'animation.gif'
 
 # Credentials of the Google service that will create the slides
 # For details see: https://tomologcli.readthedocs.io/en/latest/source/install.html#google
 GOOGLE_TOKEN = os.path.join(str(pathlib.Path.home()), 'tokens', 'google_token.json')
 
+
+def save_history(entry):
+    # append a published slide to the YAML history log
+    history_file = pathlib.Path.home() / '.tomolog'
+    history = []
+    if history_file.exists():
+        try:
+            with open(history_file) as f:
+                history = yaml.safe_load(f) or []
+        except yaml.YAMLError:
+            log.warning('Could not parse existing %s, starting fresh' % history_file)
+            history = []
+    history.append(entry)
+    with open(history_file, 'w') as f:
+        yaml.safe_dump(history, f, default_flow_style=False, allow_unicode=True)
+    log.info('History saved to %s' % history_file)
+
+
+def published_deck(file_name, presentation_url):
+    """
+    Url of the presentation holding the slide of file_name among the ones
+    presentation_url was rolled over from (see TomoLog.rollover), found in
+    the history log. None when the slide is not in an earlier presentation.
+    """
+    history_file = pathlib.Path.home() / '.tomolog'
+    if not history_file.exists():
+        return None
+    try:
+        with open(history_file) as f:
+            history = yaml.safe_load(f) or []
+    except yaml.YAMLError:
+        return None
+    history = [entry for entry in history if isinstance(entry, dict) and entry.get('presentation_url')]
+    previous = {auth.extract_presentation_id(entry['presentation_url']):
+                auth.extract_presentation_id(entry['rolled_over_from'])
+                for entry in history if entry.get('rolled_over_from')}
+    chain = []
+    presentation_id = previous.get(auth.extract_presentation_id(presentation_url))
+    while presentation_id is not None and presentation_id not in chain:
+        chain.append(presentation_id)
+        presentation_id = previous.get(presentation_id)
+    path = os.path.abspath(str(file_name))
+    for entry in reversed(history):
+        if (auth.extract_presentation_id(entry['presentation_url']) in chain
+                and os.path.abspath(str(entry.get('file', ''))) == path):
+            return entry['presentation_url']
+    return None
+
+
 class TomoLog():
     '''
     Class to publish experiment meta data, tomography projection and reconstruction on a 
@@ -84,12 +136,34 @@ class TomoLog():
     '''
 
     def __init__(self, args):
-        self.google_slide = auth.google_slide(args, GOOGLE_TOKEN)
+        if cloud.backend is not None:
+            # --backend async: the slide is recorded and committed by the backend
+            self.google_slide = cloud.backend.recorder(self)
+        else:
+            self.google_slide = auth.google_slide(args, GOOGLE_TOKEN)
 
         self.args = args
 
-        self.file_name_proj0 = FILE_NAME_PROJ  + '.jpg'
-        self.file_name_recon = FILE_NAME_RECON + '.jpg'
+        self.file_name_proj0 = FILE_NAME_PROJ  + utils.image_ext(args)
+        self.file_name_recon = FILE_NAME_RECON + utils.image_ext(args)
+        self.file_name_anim  = FILE_NAME_ANIM
+
+        # averaged flat and dark fields, read once per scan when --flat-field is set
+        self.flat = None
+        self.dark = None
+        # projection read step: --proj-downsample, increased to fit --scan-memory
+        self.proj_step = args.proj_downsample
+        # set by the beamline classes when the scan is a 0-360 (double field of view)
+        self.double_fov = False
+        # maximum/mean intensity projections of the reconstruction, see --recon-projection
+        self.recon_proj = None
+        # True when the slide of the scan is created, False when it is updated
+        self.created = False
+        self.provisional = False
+        # presentation url used before a --max-slides rollover
+        self.rolled_over_from = None
+        # reconstruction command line, read from the reconstruction files when None
+        self.rec_line = None
 
         # add here beamline independent keys
         self.full_file_name_key = '/measurement/sample/file/full_name'
@@ -137,7 +211,7 @@ class TomoLog():
         if (self.args.beamline == "None"):
             descr = descr[:-1]
             self.google_slide.create_textbox_with_bullets(
-                presentation_id, page_id, descr, 240, 120, 0, 18, 8, 0)
+                presentation_id, page_id, descr, 240, 120, 0, 18, 8, 0, self.object_id('descr'))
         
         return descr
 
@@ -146,8 +220,7 @@ class TomoLog():
         if self.args.note != None:
             log.info('Publish note')
             self.google_slide.create_textbox_with_text(
-                presentation_id, page_id, note, 300,100, 10, 320, 10, 0
-                )
+                presentation_id, page_id, note, 300,100, 10, 320, 10, 0, self.object_id('note'))
         else:
             pass
 
@@ -163,43 +236,20 @@ class TomoLog():
         return os.path.dirname(self.args.file_name) + '_rec'
 
     def _recon_layout(self):
-        """Resolve the reconstruction layout — 'h5', 'tiff', or None.
-
-        If --save-format is 'auto' (default), inspect the filesystem and pick:
-          - 'h5'   when <rec_dir>/<base>_rec.h5 exists (h5/h5nolinks output)
-          - 'tiff' when <rec_dir>/<base>_rec/ directory exists
-          - None   when neither is present (caller logs a warning)
-        If --save-format is set explicitly, honor it. 'h5' and 'h5nolinks'
-        both map to the single-h5-file reader (h5py reads them identically).
-        """
-        basename = os.path.basename(self.args.file_name)[:-3]
-        rec_dir = self._rec_dir()
-        h5_path = f'{rec_dir}/{basename}_rec.h5'
-        tiff_dir = f'{rec_dir}/{basename}_rec'
-
-        if self.args.save_format == 'auto':
-            if os.path.exists(h5_path):
-                log.info(f'Detected reconstruction layout: h5 ({h5_path})')
-                return 'h5'
-            if os.path.isdir(tiff_dir):
-                log.info(f'Detected reconstruction layout: tiff ({tiff_dir})')
-                return 'tiff'
-            log.warning(f'No reconstruction found at {h5_path} or {tiff_dir}')
-            return None
-        if self.args.save_format in ('h5', 'h5nolinks'):
-            return 'h5'
-        return 'tiff'
+        """Reconstruction layout — 'h5', 'h5sino', 'zarr', 'tiff', or None — resolved once per scan."""
+        return self.scan.layout
 
     def read_rec_line(self):
+        if self.rec_line is not None:
+            return self.rec_line
         line = ''
         try:
             log.info('Publish reconstruction command line')
             basename = os.path.basename(self.args.file_name)[:-3]
             rec_dir = self._rec_dir()
             layout = self._recon_layout()
-            if layout == 'h5':
+            if layout in ('h5', 'h5sino', 'zarr'):
                 txt_path = f'{rec_dir}/{basename}_rec_line.txt'
-                h5_path = f'{rec_dir}/{basename}_rec.h5'
                 if os.path.exists(txt_path):
                     with open(txt_path, 'r') as fid:
                         line = fid.readlines()[0]
@@ -207,13 +257,12 @@ class TomoLog():
                     # Newer tomocupy runs no longer write the sidecar txt for h5
                     # output: the command line is stored as an attribute of
                     # /exchange/data. Fall back to reading it from the h5 file.
-                    with h5py.File(h5_path, 'r') as fid:
-                        cmd = fid['exchange/data'].attrs.get('command', '')
-                        if isinstance(cmd, bytes):
-                            cmd = cmd.decode('utf-8')
-                        elif hasattr(cmd, 'decode'):
-                            cmd = cmd.decode('utf-8')
-                        line = str(cmd)
+                    cmd = self.scan.recon_volume(self.recon_width()).attrs.get('command', '')
+                    if isinstance(cmd, bytes):
+                        cmd = cmd.decode('utf-8')
+                    elif hasattr(cmd, 'decode'):
+                        cmd = cmd.decode('utf-8')
+                    line = str(cmd)
             else:
                 path = f'{rec_dir}/{basename}_rec/rec_line.txt'
                 with open(path, 'r') as fid:
@@ -224,11 +273,95 @@ class TomoLog():
         return line
 
     def run_log(self):
+        # open the raw and reconstruction files once and share them across all stages
+        with trace.span('scan', scan=os.path.basename(self.args.file_name)), \
+                scan.ScanFiles(self.args, self._rec_dir()) as self.scan:
+            if self.args.live:
+                self.publish_live()
+            else:
+                self.publish_scan()
+
+    def publish_live(self):
+        # publish a provisional slide from the first flushed projection, then
+        # update it once all the projections have been written
+        if not self.scan.wait_for_frames(1):
+            log.error('No projection written to %s' % self.args.file_name)
+            return
+        self.provisional = True
+        self.publish_scan()
+        num_angles = int(self.meta[self.num_angle_key][0])
+        if not self.scan.wait_for_frames(num_angles):
+            log.warning('Scan not completed: leaving the provisional slide')
+            return
+        log.info('Scan completed: updating the slide')
+        self.provisional = False
+        self.flat = None
+        self.dark = None
+        self.publish_scan()
+
+    def read_meta(self):
+        try:
+            # h5py.File accepts the id of an open file and wraps it without
+            # reopening: the metadata reader shares the raw file handle
+            mp = meta.read_meta.Hdf5MetadataReader(self.scan.raw.id)
+            self.meta = mp.readMetadata()
+        except TypeError:
+            mp = meta.read_meta.Hdf5MetadataReader(self.args.file_name)
+            self.meta = mp.readMetadata()
+            mp.close()
+
+    def publish_scan(self):
         # read meta, calculate resolutions
-        mp = meta.read_meta.Hdf5MetadataReader(self.args.file_name)
-        self.meta = mp.readMetadata()
-        mp.close()
+        with trace.span('read_meta'):
+            self.read_meta()
+        self.check_memory()
+        self.setup_meta()
+        self.publish_slide(self.read_raw, self.read_animation, self.read_recon)
 
+    def publish_arrays(self, meta, proj, recon=None, frames=None, file_name=None, rec_line='', proj_step=1):
+        """
+        Publish the slide of a scan from arrays in memory, e.g. at the end of a
+        reconstruction, without reading the raw or reconstruction files. The
+        arrays are not modified: views of the pipeline data can be passed.
+
+        Parameters
+        ----------
+        meta : dict
+            Scan metadata as read by meta, {key: [value, unit]}, with the keys set in __init__
+        proj : ndarray or list of ndarray
+            Projection, or the images returned by read_raw for the beamline
+        recon : ndarray or list of ndarray, optional
+            Reconstructed volume (z, y, x), read only at the selected slices, or its [x, y, z] orthoslices
+        frames : ndarray, optional
+            Projections of the rotation animation, published with --animation
+        file_name : str, optional
+            Scan file name, for the slide title and ID (default: --file-name)
+        rec_line : str
+            Command line of the reconstruction
+        proj_step : int
+            Downsampling step of proj, for its scale bar
+        """
+        if file_name is not None:
+            self.args.file_name = file_name
+        self.meta = meta
+        self.rec_line = rec_line
+        self.proj_step = proj_step
+        if isinstance(proj, np.ndarray):
+            proj = [proj]
+
+        def read_recon():
+            if recon is None:
+                return []
+            if isinstance(recon, np.ndarray) and recon.ndim == 3:
+                return self.recon_orthoslices(recon)
+            self.binning_rec = self.recon_binning(recon[2].shape[1])
+            return list(recon)
+
+        with trace.span('scan', scan=os.path.basename(self.args.file_name)):
+            self.setup_meta()
+            self.publish_slide(lambda: proj, None if frames is None else lambda width, height: frames, read_recon)
+
+    def setup_meta(self):
         if (self.meta[self.sample_in_x_key][0] != 0) and self.args.beamline == '2-bm':
             self.double_fov = True
             log.warning('Sample in x is off center: %s. Handling the data set as a double FOV' %
@@ -250,17 +383,49 @@ class TomoLog():
 
         self.setup_resolutions()
 
-        presentation_id, page_id = self.init_slide()
-        self.save_history(self.args.presentation_url)
+    def publish_slide(self, read_raw, read_animation, read_recon):
+        # the slice ids chosen for this scan (-1 options) are not kept for the next one
+        ids = self.args.idx, self.args.idy, self.args.idz
+        try:
+            self._publish_slide(read_raw, read_animation, read_recon)
+        finally:
+            self.args.idx, self.args.idy, self.args.idz = ids
+
+    def _publish_slide(self, read_raw, read_animation, read_recon):
+        # the images are read from the scan files or given as arrays (publish_arrays)
+        with trace.span('init_slide'):
+            presentation_id, page_id = self.init_slide()
+        if self.created:
+            self.save_history(self.args.presentation_url)
         self.publish_descr(presentation_id, page_id)
         self.publish_note(presentation_id, page_id)
-        proj = self.read_raw()
-        self.publish_proj(presentation_id, page_id, proj)
-        recon = self.read_recon()
+        with trace.span('read_raw') as span:
+            proj = read_raw()
+            span.add(bytes_read=trace.nbytes(proj))
+        with trace.span('publish_proj'):
+            self.publish_proj(presentation_id, page_id, proj)
+        if self.args.animation > 0 and read_animation is not None:
+            with trace.span('read_animation') as span:
+                frames = read_animation(60, 60)
+                span.add(bytes_read=trace.nbytes(frames))
+            with trace.span('publish_animation'):
+                self.publish_animation(presentation_id, page_id, frames, 60, 60, 170, 160)
+        with trace.span('read_recon') as span:
+            recon = read_recon()
+            span.add(bytes_read=trace.nbytes(recon))
         #print(recon)
-        self.publish_recon(presentation_id, page_id, recon)
+        with trace.span('publish_recon'):
+            self.publish_recon(presentation_id, page_id, recon)
+        with trace.span('commit'):
+            self.google_slide.commit(presentation_id)
         cloud.cleanup(self.args)
 
+    def object_id(self, role):
+        # object IDs derived from the scan identity, so that republishing a scan
+        # updates its slide instead of creating a new one
+        digest = hashlib.sha1(os.path.abspath(self.args.file_name).encode()).hexdigest()[:20]
+        return f'tomolog_{digest}_{role}'
+
     def setup_resolutions(self):
         pass
 
@@ -273,15 +438,55 @@ class TomoLog():
             log.error(
                 "Set --presentation-url to point to a valid Google slide location")
             exit()
-        # Create a new Google slide
-        page_id = str(uuid.uuid4())
-        self.google_slide.create_slide(presentation_id, page_id)
-        self.google_slide.create_textbox_with_text(presentation_id, page_id, os.path.basename(
-            self.args.file_name)[:-3], 400, 50, 0, 0, 13, 1)
+        # Create the Google slide of the scan, or update it in place when it
+        # was already published. The slide content is sent in one batch update
+        page_id = self.object_id('page')
+        # the publishing backends look for the earlier presentation themselves
+        deck_id = self.published_deck() if cloud.backend is None else None
+        if deck_id is not None and not self.google_slide.open_slide(deck_id, page_id):
+            # published before a rollover: updated in its presentation
+            presentation_id = deck_id
+            self.created = False
+        else:
+            self.created = self.google_slide.open_slide(presentation_id, page_id)
+        if self.created and 0 < self.args.max_slides <= self.google_slide.nslides:
+            # nothing is sent before commit: the slide goes entirely to the new presentation
+            presentation_id = self.rollover(presentation_id)
+            self.created = self.google_slide.open_slide(presentation_id, page_id)
+        title = os.path.basename(self.args.file_name)[:-3]
+        if self.provisional:
+            title += ' (acquisition in progress)'
+        self.google_slide.create_textbox_with_text(presentation_id, page_id, title, 400, 50, 0, 0, 13, 1, self.object_id('title'))
         return presentation_id, page_id
 
+    def rollover(self, presentation_id):
+        log.warning('Presentation %s holds %d slides: continuing in a new presentation' % (
+            presentation_id, self.google_slide.nslides))
+        if self.args.template_url is not None:
+            new_id = self.google_slide.copy_presentation(
+                auth.extract_presentation_id(self.args.template_url), self.google_slide.next_title())
+        else:
+            new_id = self.google_slide.copy_presentation(
+                presentation_id, self.google_slide.next_title(), keep=1)
+        self.rolled_over_from = self.args.presentation_url
+        self.args.presentation_url = f'https://docs.google.com/presentation/d/{new_id}/edit'
+        log.warning('New presentation-url: %s' % self.args.presentation_url)
+        return new_id
+
+    def published_deck(self, presentation_url=None):
+        # id of a presentation rolled over to presentation_url (default --presentation-url) holding the slide of the scan
+        if self.args.offline:
+            return None
+        url = published_deck(self.args.file_name, presentation_url or self.args.presentation_url)
+        return None if url is None else auth.extract_presentation_id(url)
+
     def save_history(self, presentation_url):
-        history_file = pathlib.Path.home() / '.tomolog'
+        if self.args.offline:
+            # the offline presentations are discarded at the end of the run
+            return
+        save_history(self.history_entry(presentation_url))
+
+    def history_entry(self, presentation_url):
         entry = {
             'date':             datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
             'presentation_url': str(presentation_url),
@@ -291,18 +496,9 @@ class TomoLog():
             'beamline':         str(self.meta.get(self.beamline_key,  [None])[0]),
             'file':             str(self.args.file_name),
         }
-        history = []
-        if history_file.exists():
-            try:
-                with open(history_file) as f:
-                    history = yaml.safe_load(f) or []
-            except yaml.YAMLError:
-                log.warning('Could not parse existing %s, starting fresh' % history_file)
-                history = []
-        history.append(entry)
-        with open(history_file, 'w') as f:
-            yaml.safe_dump(history, f, default_flow_style=False, allow_unicode=True)
-        log.info('History saved to %s' % history_file)
+        if self.rolled_over_from is not None:
+            entry['rolled_over_from'] = str(self.rolled_over_from)
+        return entry
 
     def read_meta_item(self, template):
         try:
@@ -312,14 +508,75 @@ class TomoLog():
             str = ""
         return str
 
+    def check_memory(self):
+        """
+        Estimate from the dataset shapes the memory needed to read the scan and,
+        when it is above --scan-memory, read the projections with a larger step.
+        """
+        self.proj_step = self.args.proj_downsample
+        if self.args.scan_memory <= 0:
+            return
+        data = self.scan.raw['exchange/data']
+        nflat = 2*self.args.flat_frames if self.args.flat_field != 'none' else 0
+        recon = 0
+        if self.scan.layout in ('h5', 'h5sino', 'zarr'):
+            # three float32 planes of the volume and their zoomed copies
+            try:
+                shape = self.scan.recon_volume(self.recon_width()).shape
+                recon = 6*max(shape[0], shape[1])*shape[2]*4
+            except (KeyError, StopIteration, OSError, ImportError):
+                pass
+        def estimate(step):
+            # flat and dark stacks, averaged fields, projection and corrected/rendered copies
+            raw = utils.frame_bytes(data.shape, data.dtype.itemsize, step)
+            corrected = utils.frame_bytes(data.shape, 4, step)
+            return nflat*raw + 6*corrected
+        max_memory = self.args.scan_memory*2**20
+        if estimate(self.proj_step) + recon <= max_memory:
+            return
+        if recon < max_memory:
+            self.proj_step = utils.fit_step(estimate, max_memory-recon, self.proj_step)
+        log.warning('Reading the scan needs about %.1f MB, above --scan-memory %.1f MB: reading every %d-th projection pixel' % (
+            (estimate(self.args.proj_downsample)+recon)/2**20, self.args.scan_memory, self.proj_step))
+
+    def read_flat_dark(self):
+        log.info('Reading flat and dark fields')
+        step = self.proj_step
+        # refreshed: in --live mode the fields may not be written yet
+        flat = utils.read_leading_frames(self.scan.refresh('exchange/data_white'), self.args.flat_frames, step)
+        dark = utils.read_leading_frames(self.scan.refresh('exchange/data_dark'), self.args.flat_frames, step)
+        if len(flat) == 0 or len(dark) == 0:
+            raise KeyError('empty flat or dark fields')
+        self.flat = utils.average_frames(flat, self.args.flat_average)
+        self.dark = utils.average_frames(dark, self.args.flat_average)
+
+    def read_frame(self, fid, index):
+        # read one projection, flat/dark-field corrected when requested
+        data = utils.read_frame(fid['exchange/data'], index, self.proj_step)
+        if self.args.flat_field != 'none':
+            try:
+                if self.flat is None:
+                    self.read_flat_dark()
+                data = utils.flat_field(data, self.flat, self.dark, self.args.flat_field)
+            except KeyError:
+                log.warning('Flat or dark fields missing: publishing the raw projection')
+        return data
+
     def read_raw(self):
         log.info('Reading CT projection')
         proj = []
-        with h5py.File(self.args.file_name) as fid:
-            data = fid['exchange/data'][0][:]
-            proj.append(data)
+        data = self.read_frame(self.scan.raw, 0)
+        proj.append(data)
         return proj
 
+    def read_animation(self, width, height):
+        log.info('Reading projections for the rotation animation')
+        data = self.scan.raw['exchange/data']
+        # downsample at read time to the pixel size of the slide box
+        w_px, h_px = utils.layout_pixels(width, height, self.args.display_dpi)
+        step = max(1, min(data.shape[2]//w_px, data.shape[1]//h_px))
+        return utils.read_strided(data, self.args.animation, step)
+
     def read_recon(self):
         log.info('Read reconstruction')
         width = int(self.meta[self.width_key][0])
@@ -331,33 +588,18 @@ class TomoLog():
         if layout is None:
             return recon
 
-        if layout == 'h5':
-            basename = os.path.basename(self.args.file_name)[:-3]
-            fname = f'{self._rec_dir()}/{basename}_rec.h5'
+        if layout in ('h5', 'h5sino', 'zarr'):
+            fname = self.scan.zarr_path if layout == 'zarr' else self.scan.h5_path
             try:
-                with h5py.File(fname, 'r') as fid:
-                    data = fid['exchange/data']
-                    h, w = data.shape[:2]
-                    if self.args.idz == -1:
-                        self.args.idz = int(h//2)
-                    if self.args.idy == -1:
-                        self.args.idy = int(w//2)
-                    if self.args.idx == -1:
-                        self.args.idx = int(w//2)
-                    if self.double_fov == True:
-                        binning_rec = np.log2(width//(w//2))
-                    else:
-                        binning_rec = np.log2(width//(w))
-                    x = data[:, :, self.args.idx]
-                    y = data[:, self.args.idy]
-                    z = data[self.args.idz]
-                recon = [x, y, z]
-                self.binning_rec = binning_rec
+                recon = self.recon_orthoslices(self.scan.recon_volume(self.recon_width()))
             except FileNotFoundError:
-                log.error(f'Reconstruction h5 file missing: {fname}')
+                log.error(f'Reconstruction {layout} file missing: {fname}')
                 log.warning('Skipping reconstruction')
-            except KeyError:
-                log.error(f'/exchange/data not found in {fname} (h5sino is not supported for slicing)')
+            except (KeyError, StopIteration):
+                log.error(f'No reconstructed volume found in {fname}')
+                log.warning('Skipping reconstruction')
+            except ImportError as e:
+                log.error(str(e))
                 log.warning('Skipping reconstruction')
         else:
             try:
@@ -384,6 +626,8 @@ class TomoLog():
 
                 w = width//binning_rec
                 h = height
+                self.select_slices(lambda ids: np.stack([utils.read_tiff(
+                    f'{top}/{rec_prefix}_{z_start+j:05}.tiff') for j in ids]), h)
                 if self.args.idz == -1:
                     self.args.idz = int(h//2)
                 if self.args.idy == -1:
@@ -408,6 +652,11 @@ class TomoLog():
                     read_proc.start()
                 for th in threads:
                     th.join()
+
+                if self.args.recon_projection != 'none':
+                    fname = f'{rec_dir}/{basename}_rec/{rec_prefix}'
+                    self.project_recon(lambda z0, z1: utils.read_tiff_block(fname, z_start+z0, z_start+z1),
+                                       (h,)+tmp.shape, tmp.dtype.itemsize)
                 
                 recon = [x, y, z]
 
@@ -424,10 +673,89 @@ class TomoLog():
         return recon
 
 
-    def plot_projection(self, proj, fname):
+    def recon_width(self):
+        # x width (pixels) of the slices shown at the largest zoom in the slide box at --display-dpi
+        zooms = literal_eval(self.args.zoom)
+        zoom = max(zooms) if isinstance(zooms, (list, tuple)) else zooms
+        w_px, h_px = utils.layout_pixels(470, 336, self.args.display_dpi)
+        return int(w_px/3*zoom)
+
+    def recon_orthoslices(self, data):
+        # x, y, z slices of a (z, y, x) volume, h5 dataset or array, read at the selected ids
+        h, w = data.shape[:2]
+        scale = getattr(data, 'scale', None)
+        if scale is not None:
+            # --idz/--idy/--idx are full resolution ids, the volume may be a coarser level
+            for name, s, n in zip(('idz', 'idy', 'idx'), scale, data.shape):
+                if getattr(self.args, name) != -1:
+                    setattr(self.args, name, min(int(getattr(self.args, name)/s), n-1))
+        self.select_slices(lambda ids: data[ids], h)
+        if self.args.idz == -1:
+            self.args.idz = int(h//2)
+        if self.args.idy == -1:
+            self.args.idy = int(w//2)
+        if self.args.idx == -1:
+            self.args.idx = int(w//2)
+        x = data[:, :, self.args.idx]
+        y = data[:, self.args.idy]
+        z = data[self.args.idz]
+        if self.args.recon_projection != 'none':
+            self.project_recon(lambda z0, z1: data[z0:z1], data.shape,
+                               data.dtype.itemsize, (getattr(data, 'chunks', None) or [1])[0])
+        self.binning_rec = self.recon_binning(w)
+        return [x, y, z]
+
+    def recon_binning(self, w):
+        # binning (log2) of a reconstruction w pixels wide
+        width = int(self.meta[self.width_key][0])
+        if self.double_fov == True:
+            return np.log2(width//(w//2))
+        return np.log2(width//(w))
+
+    def select_slices(self, read_planes, nz):
+        # replace the slice ids left at -1 by the most informative planes of a sparse sample
+        if self.args.slice_select == 'center' or -1 not in (self.args.idx, self.args.idy, self.args.idz):
+            return
+        t = time.time()
+        ids = utils.sample_planes(nz)
+        if len(ids) == 0:
+            log.info('%d planes: too few to sample, slices selected at the volume center' % nz)
+            return
+        samples = read_planes(ids)
+        idx, idy, idz = utils.select_slices(samples, ids, self.args.slice_select)
+        if self.args.idx == -1:
+            self.args.idx = idx
+        if self.args.idy == -1:
+            self.args.idy = idy
+        if self.args.idz == -1:
+            self.args.idz = idz
+        log.info('Selected slices x=%d y=%d z=%d by %s from %d of %d planes (%.1f%% of the volume) in %.2f s' % (
+            self.args.idx, self.args.idy, self.args.idz, self.args.slice_select,
+            len(ids), nz, 100*len(ids)/nz, time.time()-t))
+
+    def project_recon(self, read_block, shape, itemsize, chunk=1):
+        log.info('Computing %s intensity projections of the reconstruction' % self.args.recon_projection)
+        methods = ['max', 'mean'] if self.args.recon_projection == 'both' else [self.args.recon_projection]
+        self.recon_proj = utils.project_volume(read_block, shape, itemsize, methods,
+                                               self.args.block_memory, self.args.nproc, chunk)
+
+    def plot_recon_projections(self, fig, grid, col, pixel_size):
+        # add one column per intensity projection next to the orthoslices
+        for j, (method, projs) in enumerate(self.recon_proj.items()):
+            for k in range(3):
+                mmin, mmax = utils.find_min_max(projs[k])
+                ax = fig.add_subplot(grid[k, col+j])
+                ax.imshow(np.clip(projs[k], mmin, mmax), cmap='gray')
+                ax.add_artist(ScaleBar(pixel_size, "um", length_fraction=0.25))
+                if k == 0:
+                    ax.set_title(f'{method} projection', fontsize=18)
+
+    def plot_projection(self, proj, fname, width=150, height=150):
         log.info('Plot microCT projection')
         # auto-adjust colorbar values according to a histogram
         mmin, mmax = utils.find_min_max(proj)
+        # clipped on a copy: proj may be a view of the caller's data (see publish_arrays)
+        proj = proj.copy()
         proj[proj > mmax] = mmax
         proj[proj < mmin] = mmin
 
@@ -436,19 +764,20 @@ class TomoLog():
         ax = fig.add_subplot()
         im = ax.imshow(proj, cmap='gray')
         # Create scale bar
-        scalebar = ScaleBar(self.mct_resolution, "um", length_fraction=0.25)
+        scalebar = ScaleBar(self.mct_resolution*self.proj_step, "um", length_fraction=0.25)
         ax.add_artist(scalebar)
         divider = make_axes_locatable(ax)
         cax = divider.append_axes("right", size="5%", pad=0.1)
         plt.colorbar(im, cax=cax, format='%.1e')
-        plt.savefig(fname, bbox_inches='tight', pad_inches=0, dpi=300)
+        utils.save_figure(fig, fname, width, height, self.args, legacy_dpi=300)
         plt.cla()
         plt.close(fig)
 
-    def plot_recon(self, recon, fname):
+    def plot_recon(self, recon, fname, width=470, height=336):
         log.info('Plot reconstruction')
-        fig = plt.figure(constrained_layout=True, figsize=(14, 12))
-        grid = fig.add_gridspec(3, 3, height_ratios=[1, 1, 1])
+        nproj = len(self.recon_proj) if self.recon_proj is not None else 0
+        fig = plt.figure(constrained_layout=True, figsize=(14*(3+nproj)/3, 12))
+        grid = fig.add_gridspec(3, 3+nproj, height_ratios=[1, 1, 1])
         slices = ['x', 'y', 'z']
         # autoadjust colorbar values according to a histogram
 
@@ -467,12 +796,13 @@ class TomoLog():
             for k in range(3):
                 [s0,s1] = recon[k].shape
                 recon0 = recon[k][s0//2-s0//2//zooms[j]:s0//2+s0//2//zooms[j],s1//2-s1//2//zooms[j]:s1//2+s1//2//zooms[j]]
-                
+                # a copy: the slices may be views of the volume (see publish_arrays)
+                recon0 = recon0.copy()
                 recon0[0, 0] = self.args.max
                 recon0[0, 1] = self.args.min
                 recon0[recon0 > self.args.max] = self.args.max
                 recon0[recon0 < self.args.min] = self.args.min
-                ax = fig.add_subplot(grid[3*k+j])
+                ax = fig.add_subplot(grid[k, j])
                 im = ax.imshow(recon0, cmap='gray')
                 # Create scale bar
                 scalebar = ScaleBar(self.mct_resolution *
@@ -485,31 +815,40 @@ class TomoLog():
                     cb.remove()
                 if j==0:
                     ax.set_ylabel(f'slice {slices[k]}={sl[k]}', fontsize=18)
-        plt.savefig(fname, bbox_inches='tight', pad_inches=0, dpi=150)
+        if nproj > 0:
+            self.plot_recon_projections(fig, grid, 3, self.mct_resolution*self.binning_rec)
+        utils.save_figure(fig, fname, width, height, self.args, legacy_dpi=150)
         plt.cla()
         plt.close(fig)
 
     def publish_proj(self, presentation_id, page_id, proj, resolution=1):
         self.google_slide.create_textbox_with_text(
-            presentation_id, page_id, 'Projection', 90, 20, 50, 163, 8, 0)        
-        self.plot_projection(proj[0], self.file_name_proj0)
+            presentation_id, page_id, 'Projection', 90, 20, 50, 163, 8, 0, self.object_id('proj_label'))        
+        self.plot_projection(proj[0], self.file_name_proj0, 150, 150)
         proj_url = cloud.upload(self.args, self.file_name_proj0)
         log.info('Publish projection')
         self.google_slide.create_image(
-            presentation_id, page_id, proj_url, 150, 150, 10, 157)
+            presentation_id, page_id, proj_url, 150, 150, 10, 157, self.object_id('proj'))
+
+    def publish_animation(self, presentation_id, page_id, frames, width, height, posx, posy):
+        utils.save_animation(frames, self.file_name_anim, width, height, self.args)
+        anim_url = cloud.upload(self.args, self.file_name_anim)
+        log.info('Publish rotation animation')
+        self.google_slide.create_image(
+            presentation_id, page_id, anim_url, width, height, posx, posy, self.object_id('anim'))
 
     def publish_recon(self, presentation_id, page_id, recon):
         if len(recon) == 3:
             # publish reconstructions
             self.google_slide.create_textbox_with_text(
-                presentation_id, page_id, f'Reconstruction                                   Zoom {self.args.zoom}', 430, 14, 270, 2, 10, 0)
-            self.plot_recon(recon, self.file_name_recon)
+                presentation_id, page_id, f'Reconstruction                                   Zoom {self.args.zoom}', 430, 14, 270, 2, 10, 0, self.object_id('recon_label'))
+            self.plot_recon(recon, self.file_name_recon, 470, 336)
             recon_url = cloud.upload(self.args, self.file_name_recon)
             log.info('Publish reconstruction')
             self.google_slide.create_image(
-                presentation_id, page_id, recon_url, 470, 336, 230, 21)
+                presentation_id, page_id, recon_url, 470, 336, 230, 21, self.object_id('recon'))
 
             rec_line = self.read_rec_line()
             self.google_slide.create_textbox_with_text(
-                presentation_id, page_id, rec_line, 710, 43, 5, 360, 6, 0)
+                presentation_id, page_id, rec_line, 710, 43, 5, 360, 6, 0, self.object_id('rec_line'))
 
@@ -51,6 +51,7 @@ import matplotlib
 matplotlib.use('Agg')  # use non-GUI backend before importing pyplot
 import matplotlib.pyplot as plt
 
+from PIL import Image
 from matplotlib_scalebar.scalebar import ScaleBar
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 
@@ -66,7 +67,7 @@ __copyright__ = "Copyright (c) 2022, UChicago Argonne, LLC."
 __docformat__ = 'restructuredtext en'
 __all__ = ['TomoLog2BM', ]
 
-FILE_NAME_WEBCAM = 'web_cam.jpg'
+FILE_NAME_WEBCAM = 'web_cam'
 
 
 class TomoLog2BM(TomoLog):
@@ -90,7 +91,7 @@ class TomoLog2BM(TomoLog):
         self.binning_rec = -1
         self.mct_resolution = -1
         self.double_fov = False
-        self.file_name_webcam = FILE_NAME_WEBCAM
+        self.file_name_webcam = FILE_NAME_WEBCAM + utils.image_ext(args)
 
     def publish_descr(self, presentation_id, page_id):
         descr = super().publish_descr(presentation_id, page_id)
@@ -121,46 +122,53 @@ class TomoLog2BM(TomoLog):
                 descr += "Pitch angle: " + str(pitch_angle) + pitch_angle_units
         descr = descr[:-1]
         self.google_slide.create_textbox_with_bullets(
-            presentation_id, page_id, descr, 240, 120, 0, 18, 8, 0)
+            presentation_id, page_id, descr, 240, 120, 0, 18, 8, 0, self.object_id('descr'))
 
     def read_raw(self):
         log.info('Reading microCT projection')
         proj = []
-        with h5py.File(self.args.file_name) as fid:
-            if self.double_fov == True:
-                log.warning('Data read: Handling the data set as a double FOV')
-                image_0 = np.flip(fid['exchange/data'][0][:], axis=1)
-                image_1 = fid['exchange/data'][-1][:]
-                data = np.hstack((image_0, image_1))
+        fid = self.scan.raw
+        if self.double_fov == True:
+            log.warning('Data read: Handling the data set as a double FOV')
+            image_0 = np.flip(self.read_frame(fid, 0), axis=1)
+            image_1 = self.read_frame(fid, -1)
+            data = np.hstack((image_0, image_1))
+        else:
+            data = self.read_frame(fid, 0)
+        proj.append(data)
+        if 'exchange/web_camera_frame' in fid:
+            log.info('Reading camera frame')
+            frame = fid['exchange/web_camera_frame']
+            if frame.ndim == 4:
+                # multi-frame dataset: read only the latest frame
+                proj.append(frame[frame.shape[0]-1])
             else:
-                data = fid['exchange/data'][0][:]
-            proj.append(data)
-            try:
-                proj.append(fid['exchange/web_camera_frame'][:])
-                log.info('Reading camera frame')
-            except:
-                pass
+                proj.append(frame[()])
         return proj
 
     def publish_proj(self, presentation_id, page_id, proj):
         # 2-BM datasets may include both microCT data and a web camera image
         self.google_slide.create_textbox_with_text(
-            presentation_id, page_id, 'Micro-CT projection', 90, 20, 10, 167, 8, 0)
-        self.plot_projection(proj[0], self.file_name_proj0)
+            presentation_id, page_id, 'Micro-CT projection', 90, 20, 10, 167, 8, 0, self.object_id('proj_label'))
+        self.plot_projection(proj[0], self.file_name_proj0, 170, 170)
         proj_url = cloud.upload(self.args, self.file_name_proj0)
         log.info('Publish microCT projection')
         self.google_slide.create_image(
-            presentation_id, page_id, proj_url, 170, 170, 0, 190)
+            presentation_id, page_id, proj_url, 170, 170, 0, 190, self.object_id('proj'))
         if len(proj) > 1:
             self.google_slide.create_textbox_with_text(
-                presentation_id, page_id, 'Frame from the IP camera in the hutch', 160, 20, 10, 290, 8, 0)
-            log.info('Plotting web camera image')
-            plt.imshow(np.fliplr(proj[1].reshape(-1,3)).reshape(proj[1].shape))
-            plt.axis('off')
-            plt.savefig(self.file_name_webcam,dpi=300)
+                presentation_id, page_id, 'Frame from the IP camera in the hutch', 160, 20, 10, 290, 8, 0, self.object_id('webcam_label'))
+            log.info('Saving web camera image')
+            # the camera stores BGR frames: PIL swaps the channels while unpacking
+            # the frame into the image, the only copy made of it
+            frame = np.ascontiguousarray(proj[1], dtype=np.uint8)
+            img = Image.frombuffer('RGB', (frame.shape[1], frame.shape[0]), frame, 'raw', 'BGR', 0, 1)
+            nbytes = utils.save_image(img, self.file_name_webcam, self.args)
+            log.info('%s: %dx%d px, %d bytes' % (
+                self.file_name_webcam, proj[1].shape[1], proj[1].shape[0], nbytes))
             webcam_url = cloud.upload(self.args, self.file_name_webcam)
             log.info('Publish web camera image')
             self.google_slide.create_image(
-                presentation_id, page_id, webcam_url, 170, 170, 0, 270)
+                presentation_id, page_id, webcam_url, 170, 170, 0, 270, self.object_id('webcam'))
         else:
             log.warning('No frame from the IP camera')
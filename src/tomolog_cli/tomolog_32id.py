@@ -66,7 +66,7 @@ __copyright__ = "Copyright (c) 2022, UChicago Argonne, LLC."
 __docformat__ = 'restructuredtext en'
 __all__ = ['TomoLog32ID', ]
 
-FILE_NAME_PROJ1 = 'projection_google1.jpg'
+FILE_NAME_PROJ1 = 'projection_google1'
 
 
 class TomoLog32ID(TomoLog):
@@ -86,7 +86,7 @@ class TomoLog32ID(TomoLog):
         self.mct_resolution = -1
         
         self.double_fov = False
-        self.file_name_proj1 = FILE_NAME_PROJ1
+        self.file_name_proj1 = FILE_NAME_PROJ1 + utils.image_ext(args)
 
     def publish_descr(self, presentation_id, page_id):
         descr = super().publish_descr(presentation_id, page_id)
@@ -97,7 +97,7 @@ class TomoLog32ID(TomoLog):
 
         descr = descr[:-1]
         self.google_slide.create_textbox_with_bullets(
-            presentation_id, page_id, descr, 240, 120, 0, 18, 8, 0)
+            presentation_id, page_id, descr, 240, 120, 0, 18, 8, 0, self.object_id('descr'))
 
     def setup_resolutions(self):
         self.nct_resolution = float(self.meta[self.resolution_key][0])/1000
@@ -106,21 +106,28 @@ class TomoLog32ID(TomoLog):
     def read_raw(self):
         log.info('Reading nanoCT projection')
         proj = []
-        with h5py.File(self.args.file_name) as fid:
-            if self.double_fov == True:
-                log.warning('Data read: Handling the data set as a double FOV')
-                image_0 = np.flip(fid['exchange/data'][0][:], axis=1)
-                image_1 = fid['exchange/data'][-1][:]
-                data = np.hstack((image_0, image_1))
+        fid = self.scan.raw
+        if self.double_fov == True:
+            log.warning('Data read: Handling the data set as a double FOV')
+            image_0 = np.flip(self.read_frame(fid, 0), axis=1)
+            image_1 = self.read_frame(fid, -1)
+            data = np.hstack((image_0, image_1))
+        else:
+            data = self.read_frame(fid, 0)
+        proj.append(data)
+        log.info('Reading CT projection')
+        if 'exchange/data2' in fid:
+            # data2 may be a single micro-CT frame or a full 3D scan: read only one frame
+            log.info('Reading microCT projection')
+            data2 = fid['exchange/data2']
+            step = self.proj_step
+            if self.double_fov == True and data2.ndim == 3:
+                log.warning('Data read: Handling the microCT data set as a double FOV')
+                image_0 = np.flip(utils.read_frame(data2, 0, step), axis=1)
+                image_1 = utils.read_frame(data2, -1, step)
+                proj.append(np.hstack((image_0, image_1)))
             else:
-                data = fid['exchange/data'][0][:]
-            proj.append(data)
-            log.info('Reading CT projection')
-            try:
-                proj.append(fid['exchange/data2'][:])
-                log.info('Reading microCT projection')
-            except:
-                pass
+                proj.append(utils.read_frame(data2, 0, step))
         return proj
 
     def read_recon(self):
@@ -130,23 +137,27 @@ class TomoLog32ID(TomoLog):
         recon = []
         try:
             if self.args.save_format == 'h5':
-                fname  = os.path.dirname(self.args.file_name)+'_rec/'+os.path.basename(self.args.file_name)[:-3]+'_rec.h5'
-                with h5py.File(fname,'r') as fid:
-                    data = fid['exchange/recon']
-                    h,w = data.shape[:2]
-                    if self.args.idz == -1:
-                        self.args.idz = int(h//2)
-                    if self.args.idy == -1:
-                        self.args.idy = int(w//2)
-                    if self.args.idx == -1:
-                        self.args.idx = int(w//2)
-                    if self.double_fov == True:
-                        binning_rec = np.log2(width//(w//2))
-                    else:
-                        binning_rec = np.log2(width//(w))
-                    x = data[:,:,self.args.idx]
-                    y = data[:,self.args.idy]
-                    z = data[self.args.idz]
+                fid = self.scan.recon
+                data = fid['exchange/recon']
+                h,w = data.shape[:2]
+                self.select_slices(lambda ids: data[ids], h)
+                if self.args.idz == -1:
+                    self.args.idz = int(h//2)
+                if self.args.idy == -1:
+                    self.args.idy = int(w//2)
+                if self.args.idx == -1:
+                    self.args.idx = int(w//2)
+                if self.double_fov == True:
+                    binning_rec = np.log2(width//(w//2))
+                else:
+                    binning_rec = np.log2(width//(w))
+                x = data[:,:,self.args.idx]
+                y = data[:,self.args.idy]
+                z = data[self.args.idz]
+                coeff_rec = self.phase_coeff()
+                if self.args.recon_projection != 'none':
+                    self.project_recon(lambda z0, z1: coeff_rec*data[z0:z1], data.shape,
+                                       data.dtype.itemsize, (data.chunks or [1])[0])
             else:                
                 basename = os.path.basename(self.args.file_name)[:-3]
                 dirname = os.path.dirname(self.args.file_name)
@@ -176,6 +187,8 @@ class TomoLog32ID(TomoLog):
                 binning_rec = 1
                 w = tmp.shape[-1]
 
+                self.select_slices(lambda ids: np.stack([utils.read_tiff(
+                    f'{top}/{rec_prefix}_{z_start+j:05}.tiff') for j in ids]), h)
 
                 if self.args.idz == -1:
                     self.args.idz = int(h//2)
@@ -200,12 +213,12 @@ class TomoLog32ID(TomoLog):
                         f'{dirname}_rec/{basename}_rec/{rec_prefix}_{j:05}.tiff')
                     y[j-z_start, :] = zz[self.args.idy]
                     x[j-z_start, :] = zz[:, self.args.idx]
-            
-            # check if inversion is needed for the phase-contrast imaging at 32id
-            phase_ring_y = float(self.meta[self.phase_ring_setup_y_key][0])
-            coeff_rec = 1
-            if abs(phase_ring_y) < 1e-2:
-                coeff_rec = -1
+
+                coeff_rec = self.phase_coeff()
+                if self.args.recon_projection != 'none':
+                    fname = f'{dirname}_rec/{basename}_rec/{rec_prefix}'
+                    self.project_recon(lambda z0, z1: coeff_rec*utils.read_tiff_block(fname, z_start+z0, z_start+z1),
+                                       (h,)+tmp.shape, tmp.dtype.itemsize)
             
             recon = [coeff_rec*x, coeff_rec*y, coeff_rec*z]
             self.binning_rec = binning_rec
@@ -220,10 +233,20 @@ class TomoLog32ID(TomoLog):
 
         return recon
 
-    def plot_projection(self, proj, fname,scalebar='nano'):
+    def phase_coeff(self):
+        # check if inversion is needed for the phase-contrast imaging at 32id
+        phase_ring_y = float(self.meta[self.phase_ring_setup_y_key][0])
+        coeff_rec = 1
+        if abs(phase_ring_y) < 1e-2:
+            coeff_rec = -1
+        return coeff_rec
+
+    def plot_projection(self, proj, fname, width=170, height=170, scalebar='nano'):
         log.info('Plot projection')
         # auto-adjust colorbar values according to a histogram
         mmin, mmax = utils.find_min_max(proj)
+        # clipped on a copy: proj may be a view of the caller's data (see publish_arrays)
+        proj = proj.copy()
         proj[proj > mmax] = mmax
         proj[proj < mmin] = mmin
 
@@ -233,23 +256,24 @@ class TomoLog32ID(TomoLog):
         im = ax.imshow(proj, cmap='gray')
         # Create scale bar
         if scalebar=='nano':
-            scalebar = ScaleBar(self.nct_resolution, "um", length_fraction=0.25)
+            scalebar = ScaleBar(self.nct_resolution*self.proj_step, "um", length_fraction=0.25)
         else:
-            scalebar = ScaleBar(self.mct_resolution, "um", length_fraction=0.25)
+            scalebar = ScaleBar(self.mct_resolution*self.proj_step, "um", length_fraction=0.25)
         ax.add_artist(scalebar)
         divider = make_axes_locatable(ax)
         cax = divider.append_axes("right", size="5%", pad=0.1)
         plt.colorbar(im, cax=cax)
         # plt.show()
         # save
-        plt.savefig(fname, bbox_inches='tight', pad_inches=0, dpi=300)
+        utils.save_figure(fig, fname, width, height, self.args, legacy_dpi=300)
         plt.cla()
         plt.close(fig)
 
-    def plot_recon(self, recon, fname):
+    def plot_recon(self, recon, fname, width=470, height=336):
         log.info('Plot reconstruction')
-        fig = plt.figure(constrained_layout=True, figsize=(14, 12))
-        grid = fig.add_gridspec(3, 3, height_ratios=[1, 1, 1])
+        nproj = len(self.recon_proj) if self.recon_proj is not None else 0
+        fig = plt.figure(constrained_layout=True, figsize=(14*(3+nproj)/3, 12))
+        grid = fig.add_gridspec(3, 3+nproj, height_ratios=[1, 1, 1])
         slices = ['x', 'y', 'z']
 
         if self.args.min == self.args.max:
@@ -272,11 +296,13 @@ class TomoLog32ID(TomoLog):
                 log.info('zoom=%d slice=%s recon0.shape=%s scalebar_length=%.4f um' % (
                     zooms[j], slices[k], str(recon0.shape),
                     recon0.shape[1] * 0.25 * self.nct_resolution * 2**self.binning_rec))
+                # a copy: the slices may be views of the volume (see publish_arrays)
+                recon0 = recon0.copy()
                 recon0[0, 0] = self.args.max
                 recon0[0, 1] = self.args.min
                 recon0[recon0 > self.args.max] = self.args.max
                 recon0[recon0 < self.args.min] = self.args.min
-                ax = fig.add_subplot(grid[3*k+j])
+                ax = fig.add_subplot(grid[k, j])
                 im = ax.imshow(recon0, cmap='gray')
                 scalebar = ScaleBar(self.nct_resolution *
                                     2**self.binning_rec, "um", length_fraction=0.25)
@@ -288,27 +314,29 @@ class TomoLog32ID(TomoLog):
                     cb.remove()
                 if j == 0:
                     ax.set_ylabel(f'slice {slices[k]}={sl[k]}', fontsize=18)
-        plt.savefig(fname, bbox_inches='tight', pad_inches=0, dpi=150)
+        if nproj > 0:
+            self.plot_recon_projections(fig, grid, 3, self.nct_resolution*2**self.binning_rec)
+        utils.save_figure(fig, fname, width, height, self.args, legacy_dpi=150)
         plt.cla()
         plt.close(fig)
 
     def publish_proj(self, presentation_id, page_id, proj):
         # 32-id datasets may include both nanoCT and microCT data as proj[0] and proj[1] respectively
         self.google_slide.create_textbox_with_text(
-            presentation_id, page_id, 'Nano-CT projection', 90, 20, 10, 155, 8, 0)
-        self.plot_projection(proj[0], self.file_name_proj0)
+            presentation_id, page_id, 'Nano-CT projection', 90, 20, 10, 155, 8, 0, self.object_id('proj_label'))
+        self.plot_projection(proj[0], self.file_name_proj0, 170, 170)
         proj_url = cloud.upload(self.args, self.file_name_proj0)
         log.info('Publish nanoCT projection')
         self.google_slide.create_image(
-            presentation_id, page_id, proj_url, 170, 170, 0, 145)
+            presentation_id, page_id, proj_url, 170, 170, 0, 145, self.object_id('proj'))
         if len(proj) > 1:
             self.google_slide.create_textbox_with_text(
-                presentation_id, page_id, 'Micro-CT projection', 90, 20, 10, 280, 8, 0)
-            self.plot_projection(proj[1], self.file_name_proj1, scalebar='micro')
+                presentation_id, page_id, 'Micro-CT projection', 90, 20, 10, 280, 8, 0, self.object_id('proj1_label'))
+            self.plot_projection(proj[1], self.file_name_proj1, 170, 170, scalebar='micro')
             proj_url = cloud.upload(self.args, self.file_name_proj1)
             log.info('Publish microCT projection')
             self.google_slide.create_image(
-                presentation_id, page_id, proj_url, 170, 170, 0, 270)
+                presentation_id, page_id, proj_url, 170, 170, 0, 270, self.object_id('proj1'))
         else:
             log.warning('No microCT data available')
 
@@ -316,13 +344,13 @@ class TomoLog32ID(TomoLog):
         if len(recon) == 3:
             # publish reconstructions
             self.google_slide.create_textbox_with_text(
-                presentation_id, page_id, f'Reconstruction                                   Zoom {self.args.zoom}', 430, 14, 270, 2, 10, 0)
-            self.plot_recon(recon, self.file_name_recon)
+                presentation_id, page_id, f'Reconstruction                                   Zoom {self.args.zoom}', 430, 14, 270, 2, 10, 0, self.object_id('recon_label'))
+            self.plot_recon(recon, self.file_name_recon, 470, 336)
             recon_url = cloud.upload(self.args, self.file_name_recon)
             log.info('Publish reconstruction')
             self.google_slide.create_image(
-                presentation_id, page_id, recon_url, 470, 336, 230, 21)
+                presentation_id, page_id, recon_url, 470, 336, 230, 21, self.object_id('recon'))
 
             rec_line = self.read_rec_line()
             self.google_slide.create_textbox_with_text(
-                presentation_id, page_id, rec_line, 710, 43, 5, 360, 6, 0)
+                presentation_id, page_id, rec_line, 710, 43, 5, 360, 6, 0, self.object_id('rec_line'))
@@ -106,30 +106,30 @@ class TomoLog7BM(TomoLog):
 
         descr = descr[:-1]
         self.google_slide.create_textbox_with_bullets(
-            presentation_id, page_id, descr, 240, 120, 0, 18, 8, 0)
+            presentation_id, page_id, descr, 240, 120, 0, 18, 8, 0, self.object_id('descr'))
 
     def read_raw(self):
         log.info('Reading microCT projection')
         proj = []
-        with h5py.File(self.args.file_name) as fid:
-            if self.double_fov == True:
-                log.warning('Data read: Handling the data set as a double FOV')
-                image_0 = np.flip(fid['exchange/data'][0][:], axis=1)
-                image_1 = fid['exchange/data'][-1][:]
-                data = np.hstack((image_0, image_1))
-            else:
-                data = fid['exchange/data'][0][:]
-            proj.append(data)
+        fid = self.scan.raw
+        if self.double_fov == True:
+            log.warning('Data read: Handling the data set as a double FOV')
+            image_0 = np.flip(self.read_frame(fid, 0), axis=1)
+            image_1 = self.read_frame(fid, -1)
+            data = np.hstack((image_0, image_1))
+        else:
+            data = self.read_frame(fid, 0)
+        proj.append(data)
         return proj
 
     def publish_proj(self, presentation_id, page_id, proj):
         # 7-bm datasets include only microCT data
         self.google_slide.create_textbox_with_text(
-            presentation_id, page_id, 'Micro-CT projection', 90, 20, 10, 155, 8, 0)
-        self.plot_projection(proj[0], self.file_name_proj0)
+            presentation_id, page_id, 'Micro-CT projection', 90, 20, 10, 155, 8, 0, self.object_id('proj_label'))
+        self.plot_projection(proj[0], self.file_name_proj0, 170, 170)
         proj_url = cloud.upload(self.args, self.file_name_proj0)
         log.info('Publish microCT projection')
         self.google_slide.create_image(
-            presentation_id, page_id, proj_url, 170, 170, 0, 145)
+            presentation_id, page_id, proj_url, 170, 170, 0, 145, self.object_id('proj'))
 
 
@@ -0,0 +1,317 @@
+# #########################################################################
+# Copyright (c) 2022, UChicago Argonne, LLC. All rights reserved.         #
+#                                                                         #
+# Copyright 2022. UChicago Argonne, LLC. This software was produced       #
+# under U.S. Government contract DE-AC02-06CH11357 for Argonne National   #
+# Laboratory (ANL), which is operated by UChicago Argonne, LLC for the    #
+# U.S. Department of Energy. The U.S. Government has rights to use,       #
+# reproduce, and distribute this software.  NEITHER THE GOVERNMENT NOR    #
+# UChicago Argonne, LLC MAKES ANY WARRANTY, EXPRESS OR IMPLIED, OR        #
+# ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If software is     #
+# modified to produce derivative works, such modified software should     #
+# be clearly marked, so as not to confuse it with the version available   #
+# from ANL.                                                               #
+#                                                                         #
+# Additionally, redistribution and use in source and binary forms, with   #
+# or without modification, are permitted provided that the following      #
+# conditions are met:                                                     #
+#                                                                         #
+#     * Redistributions of source code must retain the above copyright    #
+#       notice, this list of conditions and the following disclaimer.     #
+#                                                                         #
+#     * Redistributions in binary form must reproduce the above copyright #
+#       notice, this list of conditions and the following disclaimer in   #
+#       the documentation and/or other materials provided with the        #
+#       distribution.                                                     #
+#                                                                         #
+#     * Neither the name of UChicago Argonne, LLC, Argonne National       #
+#       Laboratory, ANL, the U.S. Government, nor the names of its        #
+#       contributors may be used to endorse or promote products derived   #
+#       from this software without specific prior written permission.     #
+#                                                                         #
+# THIS SOFTWARE IS PROVIDED BY UChicago Argonne, LLC AND CONTRIBUTORS     #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT       #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS       #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL UChicago     #
+# Argonne, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,        #
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,    #
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;        #
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER        #
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT      #
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN       #
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE         #
+# POSSIBILITY OF SUCH DAMAGE.                                             #
+# #########################################################################
+
+
+'''
+    Timing spans around the stages of a publication (reading, rendering,
+    uploads and Google Slides calls) and the run report printed at the end
+'''
+
+import os
+import json
+import time
+import resource
+import threading
+import functools
+import contextlib
+import contextvars
+
+import numpy as np
+
+from tomolog_cli import log
+
+__all__ = ['Span', 'span', 'traced', 'take', 'merge', 'subscribe', 'add', 'current_scan', 'current_stage', 'nbytes', 'stages', 'report', 'write']
+
+_spans = []
+# beyond MAX_SPANS (long running publish --spool-poll, metrics), the oldest
+# spans are dropped and kept only as statistics of their stage and scan
+MAX_SPANS = 100000
+_folded = {}
+_dropped = 0
+_lock = threading.Lock()
+_current = contextvars.ContextVar('tomolog_span', default=None)
+# functions called with each finished span (see metrics)
+_listeners = []
+_t0 = time.perf_counter()
+
+
+class Span():
+    '''Timed stage, with the bytes read and sent and the peak RSS at its end'''
+
+    def __init__(self, name, parent, scan, attrs):
+        self.name = name
+        self.parent = parent
+        self.scan = scan
+        self.attrs = attrs
+        self.thread = threading.get_ident()
+        self.start = time.perf_counter()
+        self.duration = 0.0
+        # time spent in the nested spans of the same thread
+        self.children = 0.0
+        self.bytes_read = 0
+        self.bytes_sent = 0
+        self.peak_rss = 0
+        # True when the stage raised an exception
+        self.error = False
+
+    def add(self, bytes_read=0, bytes_sent=0):
+        self.bytes_read += bytes_read
+        self.bytes_sent += bytes_sent
+
+
+def peak_rss():
+    # ru_maxrss is in KB on Linux, in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if os.uname().sysname == 'Darwin' else rss*1024
+
+
+@contextlib.contextmanager
+def span(name, scan=None, **attrs):
+    """
+    Time the enclosed block as a child of the current span. The spans are
+    attributed to the scan of their parent unless scan is given.
+    """
+    parent = _current.get()
+    if scan is None and parent is not None:
+        scan = parent.scan
+    s = Span(name, parent, scan, attrs)
+    token = _current.set(s)
+    try:
+        yield s
+    except BaseException:
+        s.error = True
+        raise
+    finally:
+        _current.reset(token)
+        s.duration = time.perf_counter() - s.start
+        s.peak_rss = peak_rss()
+        if parent is not None and parent.thread == s.thread:
+            parent.children += s.duration
+        with _lock:
+            _keep([s])
+        for listener in _listeners:
+            listener(s)
+
+
+def _keep(spans):
+    # called with _lock held
+    global _spans, _dropped
+    _spans.extend(spans)
+    if len(_spans) > MAX_SPANS:
+        old, _spans = _spans[:MAX_SPANS//2], _spans[MAX_SPANS//2:]
+        for s in old:
+            _accumulate(_folded.setdefault((s.scan, s.name), _row()), s)
+        _dropped += len(old)
+
+
+def take():
+    """Remove and return the spans recorded so far (worker processes, see workers)"""
+    global _spans
+    with _lock:
+        spans, _spans = _spans, []
+    return spans
+
+
+def merge(spans):
+    """Add the spans recorded by a worker process"""
+    with _lock:
+        _keep(spans)
+    for s in spans:
+        for listener in _listeners:
+            listener(s)
+
+
+def subscribe(listener):
+    """Call listener(span) each time a span ends"""
+    _listeners.append(listener)
+
+
+def traced(name):
+    """Decorator running the function in a span"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def add(bytes_read=0, bytes_sent=0):
+    """Count bytes in the current span"""
+    s = _current.get()
+    if s is not None:
+        s.add(bytes_read, bytes_sent)
+
+
+def current_scan():
+    """Scan of the current span, to attribute the spans of another thread"""
+    s = _current.get()
+    return None if s is None else s.scan
+
+
+def current_stage():
+    """Name of the current span"""
+    s = _current.get()
+    return None if s is None else s.name
+
+
+def nbytes(data):
+    """Size of an array or of a (nested) list of arrays"""
+    if isinstance(data, np.ndarray):
+        return data.nbytes
+    if isinstance(data, (list, tuple)):
+        return sum(nbytes(d) for d in data)
+    return 0
+
+
+def stages(spans=None, scan=None):
+    """
+    Statistics of each stage, in order of first appearance: number of calls,
+    total, self (without the nested stages), mean and max time in s, bytes
+    read and sent, peak RSS in bytes. All the spans of the run by default.
+    """
+    rows = {}
+    if spans is None:
+        with _lock:
+            spans = list(_spans)
+            folded = dict(_folded)
+        # the statistics of the dropped spans come first
+        for (old_scan, name), row in folded.items():
+            if scan is None or old_scan == scan:
+                _combine(rows.setdefault(name, _row()), row)
+    if scan is not None:
+        spans = [s for s in spans if s.scan == scan]
+    for s in sorted(spans, key=lambda s: s.start):
+        _accumulate(rows.setdefault(s.name, _row()), s)
+    for row in rows.values():
+        row['mean'] = row['total']/row['count']
+    return rows
+
+
+def _row():
+    return {'count': 0, 'total': 0.0, 'self': 0.0, 'mean': 0.0, 'max': 0.0,
+            'bytes_read': 0, 'bytes_sent': 0, 'peak_rss': 0}
+
+
+def _accumulate(row, s):
+    row['count'] += 1
+    row['total'] += s.duration
+    row['self'] += s.duration - s.children
+    row['max'] = max(row['max'], s.duration)
+    row['bytes_read'] += s.bytes_read
+    row['bytes_sent'] += s.bytes_sent
+    row['peak_rss'] = max(row['peak_rss'], s.peak_rss)
+
+
+def _combine(row, other):
+    for key in ('count', 'total', 'self', 'bytes_read', 'bytes_sent'):
+        row[key] += other[key]
+    row['max'] = max(row['max'], other['max'])
+    row['peak_rss'] = max(row['peak_rss'], other['peak_rss'])
+
+
+def table(rows):
+    lines = ['  %-20s %5s %9s %9s %9s %9s %9s' % ('stage', 'count', 'total s', 'self s', 'read MB', 'sent MB', 'RSS MB')]
+    for name, row in rows.items():
+        lines.append('  %-20s %5d %9.2f %9.2f %9.1f %9.2f %9.0f' % (
+            name, row['count'], row['total'], row['self'], row['bytes_read']/2**20,
+            row['bytes_sent']/2**20, row['peak_rss']/2**20))
+    return '\n'.join(lines)
+
+
+def report():
+    """Log the stages of each scan and of the whole run"""
+    with _lock:
+        spans = list(_spans)
+        folded = list(_folded)
+    if not spans and not folded:
+        return
+    scans = []
+    for name in [scan for scan, stage in folded] + [s.scan for s in spans]:
+        if name is not None and name not in scans:
+            scans.append(name)
+    if len(scans) > 1:
+        for name in scans:
+            log.info('Stages of %s:\n%s' % (name, table(stages(scan=name))))
+    log.info('Stages of the run (%d scans):\n%s' % (len(scans), table(stages())))
+
+
+def write(fname):
+    """
+    Save the spans to fname: a Chrome trace (chrome://tracing, Perfetto) when
+    fname ends with .json, one JSON object per line otherwise
+    """
+    with _lock:
+        spans = sorted(_spans, key=lambda s: s.start)
+    if _dropped:
+        log.warning('%s: the %d oldest spans were dropped (more than %d spans)' % (fname, _dropped, MAX_SPANS))
+    ids = {id(s): k for k, s in enumerate(spans)}
+    records = []
+    for k, s in enumerate(spans):
+        records.append({
+            'id': k,
+            'parent': ids.get(id(s.parent)),
+            'name': s.name,
+            'scan': s.scan,
+            'thread': s.thread,
+            'start': s.start - _t0,
+            'duration': s.duration,
+            'bytes_read': s.bytes_read,
+            'bytes_sent': s.bytes_sent,
+            'peak_rss': s.peak_rss,
+            **{key: str(value) for key, value in s.attrs.items()},
+        })
+    with open(fname, 'w') as f:
+        if fname.endswith('.json'):
+            events = [{'name': r['name'], 'ph': 'X', 'pid': os.getpid(), 'tid': r['thread'],
+                       'ts': r['start']*1e6, 'dur': r['duration']*1e6,
+                       'args': {key: value for key, value in r.items() if key not in ('name', 'start', 'duration', 'thread')}}
+                      for r in records]
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        else:
+            for r in records:
+                f.write(json.dumps(r) + '\n')
+    log.info('Trace saved to %s' % fname)
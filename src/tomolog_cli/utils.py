@@ -43,16 +43,27 @@
 # POSSIBILITY OF SUCH DAMAGE.                                             #
 # #########################################################################
 
+import io
 import os
 import h5py
+import time
 import datetime
 import tifffile
 
 import numpy as np
 
+from PIL import Image
 from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from tomolog_cli import log
+from tomolog_cli import trace
 
+# Slide geometry is expressed in points, 72 points per inch
+POINTS_PER_INCH = 72
+
+IMAGE_EXT = {'jpeg': '.jpg', 'png': '.png'}
+
+@trace.traced('find_min_max')
 def find_min_max(data,th=0.003):
     """Find min and max values according to histogram"""
 
@@ -64,6 +75,304 @@ def find_min_max(data,th=0.003):
     mmax = e[end+1]
     return mmin, mmax
 
+def image_ext(args):
+    """File extension matching the selected --image-format"""
+
+    return IMAGE_EXT[args.image_format]
+
+def layout_pixels(width, height, dpi):
+    """Pixel size needed to fill a slide box of width x height points at dpi"""
+
+    return (int(np.ceil(width*dpi/POINTS_PER_INCH)),
+            int(np.ceil(height*dpi/POINTS_PER_INCH)))
+
+@trace.traced('save_image')
+def save_image(img, fname, args):
+    """
+    Encode a PIL image with the --image-format/quality/progressive options.
+
+    Returns
+    -------
+    int
+        Size in bytes of the encoded file.
+    """
+
+    if args.image_format == 'jpeg':
+        img.convert('RGB').save(fname, format='JPEG', quality=args.image_quality,
+                                optimize=True, progressive=args.image_progressive)
+    else:
+        img.save(fname, format='PNG', optimize=True)
+    return os.path.getsize(fname)
+
+@trace.traced('save_figure')
+def save_figure(fig, fname, width, height, args, legacy_dpi=None):
+    """
+    Save a matplotlib figure at exactly the pixel density required to display
+    it in a slide box of width x height points at --display-dpi.
+
+    Google Slides fits the image inside the box preserving its aspect ratio,
+    so the render dpi is chosen to make the tight bounding box of the figure
+    match the box pixel size along its limiting dimension.
+    """
+
+    w_px, h_px = layout_pixels(width, height, args.display_dpi)
+    fig.draw_without_rendering()
+    bbox = fig.get_tightbbox()
+    dpi = min(w_px/bbox.width, h_px/bbox.height)
+
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', bbox_inches='tight', pad_inches=0, dpi=dpi)
+    lossless = buf.tell()
+    buf.seek(0)
+    img = Image.open(buf)
+    nbytes = save_image(img, fname, args)
+    # the legacy render is not made: only its pixel size is logged
+    msg = '%s: %dx%d px for a %dx%d pt box at %g dpi, %d bytes (%d bytes as PNG at this size)' % (
+        fname, img.width, img.height, width, height, args.display_dpi, nbytes, lossless)
+    if legacy_dpi is not None:
+        msg += ', legacy %d dpi render was %dx%d px' % (
+            legacy_dpi, bbox.width*legacy_dpi, bbox.height*legacy_dpi)
+    log.info(msg)
+    return nbytes
+
+def frame_bytes(shape, itemsize, step=1):
+    """Bytes of one (height, width) frame of a dataset of this shape read with step"""
+    h, w = shape[-2:]
+    return -(-h//step) * -(-w//step) * itemsize
+
+def fit_step(estimate, max_memory, step=1, max_step=64):
+    """Smallest read step from step up for which estimate(step) stays under max_memory bytes"""
+    while estimate(step) > max_memory and step < max_step:
+        step += 1
+    return step
+
+def read_strided(dset, nframes, step=1):
+    """
+    Read nframes evenly spaced frames of a 3D h5 dataset with a single strided
+    hyperslab selection, optionally downsampling each frame by step.
+
+    Only the chunks intersecting the selected frames are read, so the read
+    time scales with nframes and not with the number of frames in dset.
+    """
+
+    nframes = max(1, min(nframes, dset.shape[0]))
+    stride = dset.shape[0]//nframes
+    log.info('Reading %d of %d frames (stride %d, chunks %s)' % (
+        nframes, dset.shape[0], stride, dset.chunks))
+    return dset[0:stride*nframes:stride, ::step, ::step]
+
+def read_frame(dset, index=0, step=1):
+    """
+    Read one 2D frame of a 2D or 3D h5 dataset, downsampled by step at read
+    time. Only the chunks intersecting the frame are read.
+    """
+
+    if dset.ndim == 2:
+        return dset[::step, ::step]
+    index = index % dset.shape[0]
+    log.info('Reading frame %d of %d from %s (chunks %s)' % (
+        index, dset.shape[0], dset.name, dset.chunks))
+    return dset[index, ::step, ::step]
+
+def read_leading_frames(dset, nframes, step=1):
+    """
+    Read at most nframes leading frames of a 3D h5 dataset.
+
+    When the dataset is chunked along the first axis the selection is rounded
+    down to whole chunks, so no chunk is decompressed to read only part of it.
+    """
+
+    n = min(nframes, dset.shape[0])
+    if dset.chunks is not None and n >= dset.chunks[0]:
+        n = n//dset.chunks[0]*dset.chunks[0]
+    log.info('Reading %d of %d frames from %s (chunks %s)' % (
+        n, dset.shape[0], dset.name, dset.chunks))
+    return dset[0:n, ::step, ::step]
+
+def average_frames(frames, method='median'):
+    """Average a stack of frames along the first axis"""
+
+    if method == 'median':
+        return np.median(frames, axis=0).astype('float32')
+    return np.mean(frames, axis=0, dtype='float32')
+
+def flat_field(proj, flat, dark, mode='normalize'):
+    """
+    Flat/dark-field correction of a projection.
+
+    Parameters
+    ----------
+    proj : ndarray
+        Raw projection.
+    flat, dark : ndarray
+        Averaged flat and dark fields.
+    mode : str
+        'normalize' returns (proj-dark)/(flat-dark), 'log' returns its -log.
+    """
+
+    eps = 1e-6
+    proj = (proj.astype('float32')-dark)/np.maximum(flat-dark, eps)
+    if mode == 'log':
+        proj = -np.log(np.maximum(proj, eps))
+    return proj
+
+@trace.traced('project_volume')
+def project_volume(read_block, shape, itemsize, methods, max_memory, nworkers=8, chunk=1):
+    """
+    Maximum and/or mean intensity projections of a volume along x, y and z,
+    computed by streaming over blocks of z slices.
+
+    Block heights are chosen so that the blocks processed in parallel fit in
+    max_memory, so the peak memory does not depend on the volume size.
+
+    Parameters
+    ----------
+    read_block : callable
+        read_block(z0, z1) returns the (z1-z0, ny, nx) block of the volume.
+    shape : tuple
+        (nz, ny, nx) volume shape.
+    itemsize : int
+        Size in bytes of one voxel as stored.
+    methods : list of str
+        Projections to compute, 'max' and/or 'mean'.
+    max_memory : float
+        Memory cap in MB.
+    nworkers : int
+        Number of blocks read and projected in parallel.
+    chunk : int
+        Block heights are rounded down to a multiple of chunk when possible.
+
+    Returns
+    -------
+    dict
+        For each method the list [px, py, pz] of the projections along x
+        (nz, ny), y (nz, nx) and z (ny, nx).
+    """
+
+    t = time.time()
+    nz, ny, nx = shape
+    # a block is held as stored and as float32 while being projected
+    slice_bytes = ny*nx*(itemsize+4)
+    bz = int(max_memory*2**20//(nworkers*slice_bytes))
+    if bz >= chunk:
+        bz = bz//chunk*chunk
+    bz = max(1, min(bz, nz))
+
+    out = {}
+    for m in methods:
+        out[m] = [np.zeros((nz, ny), dtype='float32'),
+                  np.zeros((nz, nx), dtype='float32'),
+                  np.full((ny, nx), -np.inf if m == 'max' else 0, dtype='float32')]
+
+    def project_block(z0):
+        block = np.asarray(read_block(z0, min(z0+bz, nz)), dtype='float32')
+        res = {}
+        if 'max' in methods:
+            res['max'] = (block.max(axis=2), block.max(axis=1), block.max(axis=0))
+        if 'mean' in methods:
+            res['mean'] = (block.mean(axis=2), block.mean(axis=1), block.sum(axis=0))
+        return z0, res
+
+    def accumulate(futures):
+        for f in futures:
+            z0, res = f.result()
+            for m, (px, py, pz) in res.items():
+                out[m][0][z0:z0+len(px)] = px
+                out[m][1][z0:z0+len(py)] = py
+                if m == 'max':
+                    np.maximum(out[m][2], pz, out=out[m][2])
+                else:
+                    out[m][2] += pz
+
+    # keep at most nworkers blocks in flight
+    with ThreadPoolExecutor(nworkers) as executor:
+        pending = set()
+        for z0 in range(0, nz, bz):
+            if len(pending) >= nworkers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                accumulate(done)
+            pending.add(executor.submit(project_block, z0))
+        accumulate(pending)
+    if 'mean' in methods:
+        out['mean'][2] /= nz
+    log.info('Projected %d slices in blocks of %d with %d workers in %.2f s' % (
+        nz, bz, nworkers, time.time()-t))
+    return out
+
+def sample_planes(n, fraction=0.05, max_planes=32):
+    """
+    Evenly spaced interior plane ids covering at most fraction of n planes,
+    none when fraction of n is less than one plane.
+    """
+
+    k = min(max_planes, int(n*fraction))
+    if k == 0:
+        return np.array([], dtype='int')
+    return np.unique(np.linspace(0, n-1, k+2)[1:-1].astype('int'))
+
+def plane_scores(samples, axis, method='variance', nbins=256):
+    """
+    Score each plane of samples along axis by its variance or by the entropy
+    of its histogram, computed for all planes at once.
+    """
+
+    planes = np.moveaxis(samples, axis, 0).reshape(samples.shape[axis], -1)
+    if method == 'variance':
+        return planes.var(axis=1)
+    mmin, mmax = planes.min(), planes.max()
+    q = ((planes-mmin)*((nbins-1)/max(mmax-mmin, 1e-12))).astype('int64')
+    # one bincount over all planes, each plane offset to its own histogram
+    q += np.arange(planes.shape[0])[:, None]*nbins
+    hist = np.bincount(q.ravel(), minlength=planes.shape[0]*nbins).reshape(-1, nbins)
+    p = hist/hist.sum(axis=1, keepdims=True)
+    return -np.sum(p*np.log2(np.where(p > 0, p, 1)), axis=1)
+
+def select_slices(samples, ids, method='variance'):
+    """
+    Choose the most informative x, y and z slices from z planes sampled at ids.
+
+    Returns
+    -------
+    tuple
+        (idx, idy, idz) slice ids.
+    """
+
+    samples = np.asarray(samples, dtype='float32')
+    idz = ids[np.argmax(plane_scores(samples, 0, method))]
+    idy = np.argmax(plane_scores(samples, 1, method))
+    idx = np.argmax(plane_scores(samples, 2, method))
+    return int(idx), int(idy), int(idz)
+
+@trace.traced('save_animation')
+def save_animation(frames, fname, width, height, args):
+    """
+    Encode a sequence of frames as a GIF animation fitting a slide box of
+    width x height points at --display-dpi.
+
+    The same contrast mapping, computed from the histogram of the whole
+    sequence, is applied to every frame.
+
+    Returns
+    -------
+    int
+        Size in bytes of the encoded file.
+    """
+
+    mmin, mmax = find_min_max(frames)
+    frames = np.clip((frames-mmin)*(255/(mmax-mmin)), 0, 255).astype('uint8')
+    size = layout_pixels(width, height, args.display_dpi)
+    imgs = []
+    for frame in frames:
+        img = Image.fromarray(frame)
+        img.thumbnail(size)
+        imgs.append(img)
+    imgs[0].save(fname, format='GIF', save_all=True, append_images=imgs[1:],
+                 duration=args.animation_frame_time, loop=0, optimize=True)
+    nbytes = os.path.getsize(fname)
+    log.info('%s: %d frames of %dx%d px, %d bytes' % (
+        fname, len(imgs), imgs[0].width, imgs[0].height, nbytes))
+    return nbytes
+
 def read_tiff(fname):
     """
     Read data from tiff file.
@@ -87,6 +396,12 @@ def read_tiff(fname):
     return arr
 
 
+def read_tiff_block(fname, z0, z1):
+    """Read slices z0..z1-1 of a tiff stack named {fname}_{id:05}.tiff"""
+
+    return np.stack([read_tiff(f'{fname}_{j:05}.tiff') for j in range(z0, z1)])
+
+
 def read_tiff_chunk(x,y, fname,idx,idy, k, lchunk):
     """Read a chunk of data from tiff"""
     log.info(k,st,end)
@@ -0,0 +1,233 @@
+# #########################################################################
+# Copyright (c) 2022, UChicago Argonne, LLC. All rights reserved.         #
+#                                                                         #
+# Copyright 2022. UChicago Argonne, LLC. This software was produced       #
+# under U.S. Government contract DE-AC02-06CH11357 for Argonne National   #
+# Laboratory (ANL), which is operated by UChicago Argonne, LLC for the    #
+# U.S. Department of Energy. The U.S. Government has rights to use,       #
+# reproduce, and distribute this software.  NEITHER THE GOVERNMENT NOR    #
+# UChicago Argonne, LLC MAKES ANY WARRANTY, EXPRESS OR IMPLIED, OR        #
+# ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If software is     #
+# modified to produce derivative works, such modified software should     #
+# be clearly marked, so as not to confuse it with the version available   #
+# from ANL.                                                               #
+#                                                                         #
+# Additionally, redistribution and use in source and binary forms, with   #
+# or without modification, are permitted provided that the following      #
+# conditions are met:                                                     #
+#                                                                         #
+#     * Redistributions of source code must retain the above copyright    #
+#       notice, this list of conditions and the following disclaimer.     #
+#                                                                         #
+#     * Redistributions in binary form must reproduce the above copyright #
+#       notice, this list of conditions and the following disclaimer in   #
+#       the documentation and/or other materials provided with the        #
+#       distribution.                                                     #
+#                                                                         #
+#     * Neither the name of UChicago Argonne, LLC, Argonne National       #
+#       Laboratory, ANL, the U.S. Government, nor the names of its        #
+#       contributors may be used to endorse or promote products derived   #
+#       from this software without specific prior written permission.     #
+#                                                                         #
+# THIS SOFTWARE IS PROVIDED BY UChicago Argonne, LLC AND CONTRIBUTORS     #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT       #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS       #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL UChicago     #
+# Argonne, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,        #
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,    #
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;        #
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER        #
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT      #
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN       #
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE         #
+# POSSIBILITY OF SUCH DAMAGE.                                             #
+# #########################################################################
+
+
+'''
+    Parallel reads of HDF5 virtual datasets (--vds-read)
+
+    With --save-format h5 the reconstruction is a virtual dataset mapping the
+    volume onto one source file per chunk of slices. HDF5 reads a slice that
+    crosses all the chunks, e.g. x or y, one source file after the other. The
+    mapping is resolved here: each read is split over the source files it
+    touches, which are read concurrently by worker processes (h5py serializes
+    the reads of a process) and assembled in the order of the virtual dataset.
+'''
+
+import os
+import atexit
+import itertools
+import multiprocessing
+import concurrent.futures
+
+import h5py
+import numpy as np
+
+from tomolog_cli.volume import BlockVolume, selection
+
+__all__ = ['VirtualVolume', 'sources', 'workers', 'release', 'shutdown']
+
+# worker processes, each with its own source files (see read_block)
+_executors = []
+
+# source datasets kept open, with their chunk cache, for the current volume
+_files = {}
+_volume = None
+_volumes = itertools.count()
+
+
+def sources(dset):
+    """
+    Source blocks of the virtual dataset dset.
+
+    Returns
+    -------
+    list or None
+        (start, shape, file name, dataset name, source start) of each block,
+        None when dset is not virtual or a mapping is not a plain block.
+    """
+    if not dset.is_virtual:
+        return None
+    folder = os.path.dirname(os.path.abspath(dset.file.filename))
+    blocks = []
+    for vmap in dset.virtual_sources():
+        if vmap.vspace.get_select_type() != h5py.h5s.SEL_HYPERSLABS:
+            return None
+        start, end = vmap.vspace.get_select_bounds()
+        shape = tuple(e-s+1 for s, e in zip(start, end))
+        if vmap.vspace.get_select_npoints() != np.prod(shape):
+            return None
+        if vmap.src_space.get_select_type() == h5py.h5s.SEL_ALL:
+            # the whole source dataset maps to the block
+            src_start = (0, )*len(shape)
+        else:
+            src_start, src_end = vmap.src_space.get_select_bounds()
+            if (shape != tuple(e-s+1 for s, e in zip(src_start, src_end))
+                    or vmap.src_space.get_select_npoints() != np.prod(shape)):
+                return None
+        file_name = vmap.file_name
+        if file_name == '.':
+            file_name = dset.file.filename
+        elif not os.path.isabs(file_name):
+            # relative to the virtual file, as HDF5 resolves them
+            file_name = os.path.join(folder, file_name)
+        blocks.append((start, shape, file_name, vmap.dset_name, src_start))
+    return blocks
+
+
+def workers(nproc):
+    """Number of worker processes for --nproc, at most one per CPU"""
+    return max(1, min(nproc, os.cpu_count() or 1))
+
+
+def executors(nworkers):
+    global _executors
+    if len(_executors) != nworkers:
+        shutdown()
+        # spawned: the parent holds open HDF5 files and logging threads
+        context = multiprocessing.get_context('spawn')
+        _executors = [concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context)
+                      for k in range(nworkers)]
+    return _executors
+
+
+def shutdown():
+    global _executors
+    for executor in _executors:
+        executor.shutdown()
+    _executors = []
+
+
+atexit.register(shutdown)
+
+
+def close_files():
+    """Close the source files kept open by this process"""
+    global _volume
+    for fid, dset in _files.values():
+        fid.close()
+    _files.clear()
+    _volume = None
+
+
+def release():
+    """Close the source files kept open, here and in the worker processes"""
+    close_files()
+    for executor in _executors:
+        executor.submit(close_files)
+
+
+def _open(volume, file_name, dset_name, cache):
+    global _volume
+    if volume != _volume:
+        # a new volume, e.g. the next scan: its files replace the open ones
+        close_files()
+        _volume = volume
+    if (file_name, dset_name) not in _files:
+        # the chunk cache lives as long as the dataset is open
+        fid = h5py.File(file_name, 'r', rdcc_nbytes=cache)
+        _files[file_name, dset_name] = fid, fid[dset_name]
+    return _files[file_name, dset_name][1]
+
+
+def read_block(volume, cache, file_name, dset_name, selection):
+    """
+    Read selection (a slice or increasing ids per axis) of a source dataset.
+    The file stays open while volume is read: the following slices of a
+    source, e.g. y after x, come from its chunk cache.
+    """
+    dset = _open(volume, file_name, dset_name, cache)
+    if sum(not isinstance(s, slice) for s in selection) <= 1:
+        return dset[tuple(selection)]
+    # several lists: bounding box, then the ids
+    box = tuple(s if isinstance(s, slice) else slice(int(s[0]), int(s[-1])+1) for s in selection)
+    data = dset[box]
+    return data[np.ix_(*[np.arange(data.shape[k]) if isinstance(s, slice) else s-s[0]
+                         for k, s in enumerate(selection)])]
+
+
+class VirtualVolume(BlockVolume):
+    '''
+    Virtual dataset read from its source files, nworkers at a time. Indexed
+    as the dataset with integers, slices and increasing id lists, and returns
+    the same arrays.
+    '''
+
+    def __init__(self, dset, blocks, nworkers=8, cache=64*2**20):
+        self.dset = dset
+        self.blocks = blocks
+        self.nworkers = nworkers
+        self.shape = dset.shape
+        self.dtype = dset.dtype
+        self.attrs = dset.attrs
+        self.fillvalue = dset.fillvalue
+        # one source block along each axis, so that the reads follow the source files
+        self.chunks = blocks[0][1] if blocks else None
+        # the workers keep the source files open until the next volume
+        self.volume = '%d-%d' % (os.getpid(), next(_volumes))
+        # chunk cache of each source file: its whole block, at most cache bytes
+        self.cache = min(int(np.prod(self.chunks))*self.dtype.itemsize, cache) if blocks else cache
+
+    def block_reads(self, ids):
+        reads = []
+        for block, (start, shape, file_name, dset_name, src_start) in enumerate(self.blocks):
+            positions = []
+            selections = []
+            for i, s, n, s0 in zip(ids, start, shape, src_start):
+                inside = np.nonzero((i >= s) & (i < s+n))[0]
+                if len(inside) == 0:
+                    break
+                positions.append(inside)
+                selections.append(selection(i[inside]-s+s0))
+            else:
+                reads.append((positions, (block, (self.volume, self.cache, file_name, dset_name, selections))))
+        return reads
+
+    def read_blocks(self, reads):
+        if len(reads) > 1 and self.nworkers > 1:
+            # a source block is always read by the same worker, which keeps its file open
+            pool = executors(self.nworkers)
+            futures = [pool[block % len(pool)].submit(read_block, *read) for positions, (block, read) in reads]
+            return (future.result() for future in futures)
+        return (read_block(*read) for positions, (block, read) in reads)
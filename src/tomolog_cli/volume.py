@@ -0,0 +1,96 @@
+# #########################################################################
+# Copyright (c) 2022, UChicago Argonne, LLC. All rights reserved.         #
+#                                                                         #
+# Copyright 2022. UChicago Argonne, LLC. This software was produced       #
+# under U.S. Government contract DE-AC02-06CH11357 for Argonne National   #
+# Laboratory (ANL), which is operated by UChicago Argonne, LLC for the    #
+# U.S. Department of Energy. The U.S. Government has rights to use,       #
+# reproduce, and distribute this software.  NEITHER THE GOVERNMENT NOR    #
+# UChicago Argonne, LLC MAKES ANY WARRANTY, EXPRESS OR IMPLIED, OR        #
+# ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If software is     #
+# modified to produce derivative works, such modified software should     #
+# be clearly marked, so as not to confuse it with the version available   #
+# from ANL.                                                               #
+#                                                                         #
+# Additionally, redistribution and use in source and binary forms, with   #
+# or without modification, are permitted provided that the following      #
+# conditions are met:                                                     #
+#                                                                         #
+#     * Redistributions of source code must retain the above copyright    #
+#       notice, this list of conditions and the following disclaimer.     #
+#                                                                         #
+#     * Redistributions in binary form must reproduce the above copyright #
+#       notice, this list of conditions and the following disclaimer in   #
+#       the documentation and/or other materials provided with the        #
+#       distribution.                                                     #
+#                                                                         #
+#     * Neither the name of UChicago Argonne, LLC, Argonne National       #
+#       Laboratory, ANL, the U.S. Government, nor the names of its        #
+#       contributors may be used to endorse or promote products derived   #
+#       from this software without specific prior written permission.     #
+#                                                                         #
+# THIS SOFTWARE IS PROVIDED BY UChicago Argonne, LLC AND CONTRIBUTORS     #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT       #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS       #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL UChicago     #
+# Argonne, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,        #
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,    #
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;        #
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER        #
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT      #
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN       #
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE         #
+# POSSIBILITY OF SUCH DAMAGE.                                             #
+# #########################################################################
+
+
+'''
+    Volumes read by blocks: the reads of vds.VirtualVolume (source files of a
+    virtual dataset) and omezarr.ZarrVolume (zarr chunks) are split over the
+    blocks intersecting each selection and assembled here.
+'''
+
+import numpy as np
+
+__all__ = ['BlockVolume', 'selection']
+
+
+def selection(ids):
+    """Increasing ids of one axis as a slice when they are contiguous"""
+    if len(ids) == ids[-1]-ids[0]+1:
+        return slice(int(ids[0]), int(ids[-1])+1)
+    return ids
+
+
+class BlockVolume():
+    '''
+    Volume indexed like an h5py dataset with integers, slices and increasing
+    id lists, returning the same arrays. Subclasses set shape, dtype and
+    fillvalue, and implement block_reads(ids), the (positions, read) pairs
+    covering the ids of each axis, and read_blocks(reads), their data.
+    '''
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key, )
+        key = key + (slice(None), )*(len(self.shape)-len(key))
+        ids = []
+        for k, n in zip(key, self.shape):
+            if isinstance(k, slice):
+                ids.append(np.arange(n)[k])
+            elif isinstance(k, (int, np.integer)):
+                ids.append(np.array([k if k >= 0 else k+n]))
+            else:
+                ids.append(np.asarray(k))
+        out = np.full([len(i) for i in ids], self.fillvalue, dtype=self.dtype)
+        reads = self.block_reads(ids)
+        for (positions, read), data in zip(reads, self.read_blocks(reads)):
+            out[np.ix_(*positions)] = data
+        # integer indices drop their axis
+        return out[tuple(0 if isinstance(k, (int, np.integer)) else slice(None) for k in key)]
+
+    def block_reads(self, ids):
+        raise NotImplementedError
+
+    def read_blocks(self, reads):
+        raise NotImplementedError
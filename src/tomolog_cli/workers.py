@@ -0,0 +1,175 @@
+# #########################################################################
+# Copyright (c) 2022, UChicago Argonne, LLC. All rights reserved.         #
+#                                                                         #
+# Copyright 2022. UChicago Argonne, LLC. This software was produced       #
+# under U.S. Government contract DE-AC02-06CH11357 for Argonne National   #
+# Laboratory (ANL), which is operated by UChicago Argonne, LLC for the    #
+# U.S. Department of Energy. The U.S. Government has rights to use,       #
+# reproduce, and distribute this software.  NEITHER THE GOVERNMENT NOR    #
+# UChicago Argonne, LLC MAKES ANY WARRANTY, EXPRESS OR IMPLIED, OR        #
+# ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If software is     #
+# modified to produce derivative works, such modified software should     #
+# be clearly marked, so as not to confuse it with the version available   #
+# from ANL.                                                               #
+#                                                                         #
+# Additionally, redistribution and use in source and binary forms, with   #
+# or without modification, are permitted provided that the following      #
+# conditions are met:                                                     #
+#                                                                         #
+#     * Redistributions of source code must retain the above copyright    #
+#       notice, this list of conditions and the following disclaimer.     #
+#                                                                         #
+#     * Redistributions in binary form must reproduce the above copyright #
+#       notice, this list of conditions and the following disclaimer in   #
+#       the documentation and/or other materials provided with the        #
+#       distribution.                                                     #
+#                                                                         #
+#     * Neither the name of UChicago Argonne, LLC, Argonne National       #
+#       Laboratory, ANL, the U.S. Government, nor the names of its        #
+#       contributors may be used to endorse or promote products derived   #
+#       from this software without specific prior written permission.     #
+#                                                                         #
+# THIS SOFTWARE IS PROVIDED BY UChicago Argonne, LLC AND CONTRIBUTORS     #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT       #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS       #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL UChicago     #
+# Argonne, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,        #
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,    #
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;        #
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER        #
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT      #
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN       #
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE         #
+# POSSIBILITY OF SUCH DAMAGE.                                             #
+# #########################################################################
+
+
+'''
+    Worker process publishing the scans of a batch (--worker-max-scans)
+
+    Each scan runs in a child process started with 'spawn', which is replaced
+    after --worker-max-scans scans or when its resident memory passes
+    --worker-max-rss, so that the memory left behind by matplotlib figures and
+    h5 caches does not accumulate over a long directory run.
+'''
+
+import os
+import copy
+import traceback
+import multiprocessing
+
+from tomolog_cli import log
+from tomolog_cli import trace
+from tomolog_cli import retry
+
+__all__ = ['WorkerPool', 'current_rss']
+
+
+def current_rss():
+    """Resident memory of this process in bytes"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # peak instead of current resident memory where /proc is missing
+        return trace.peak_rss()
+
+
+def worker_main(conn, log_queue, tomolog_class):
+    log.setup_worker_logger(log_queue)
+    while True:
+        args = conn.recv()
+        if args is None:
+            break
+        # counters and spans of this scan, merged by the main process
+        retry.setup(args)
+        trace.take()
+        error = None
+        error_traceback = None
+        try:
+            tomolog_class(args).run_log()
+        except Exception as e:
+            error = str(e)
+            error_traceback = traceback.format_exc()
+        conn.send({
+            'error': error,
+            'traceback': error_traceback,
+            'presentation_url': args.presentation_url,
+            'count': args.count,
+            'spans': trace.take(),
+            'counters': retry.counters(),
+            'rss': current_rss(),
+        })
+    conn.close()
+
+
+class WorkerPool():
+    '''
+    One worker process at a time: the scans are still published in order,
+    each in a process whose memory is bounded and returned to the system.
+    '''
+
+    def __init__(self, args, tomolog_class):
+        self.max_scans = args.worker_max_scans
+        self.max_rss = args.worker_max_rss*2**20
+        self.tomolog_class = tomolog_class
+        self.context = multiprocessing.get_context('spawn')
+        self.process = None
+        self.conn = None
+        self.scans = 0
+
+    def start(self):
+        self.conn, child_conn = self.context.Pipe()
+        self.process = self.context.Process(
+            target=worker_main, args=(child_conn, log.queue(), self.tomolog_class), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.scans = 0
+        log.info('Started worker process %d' % self.process.pid)
+
+    def stop(self):
+        if self.process is None:
+            return
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(30)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.conn.close()
+        self.process = None
+
+    def publish(self, args):
+        """Publish args.file_name in the worker process, updating args like an in-process run"""
+        if self.process is None:
+            self.start()
+        # the subcommand function lives in __main__, which the spawned worker cannot import
+        worker_args = copy.copy(args)
+        vars(worker_args).pop('_func', None)
+        self.conn.send(worker_args)
+        try:
+            reply = self.conn.recv()
+        except EOFError:
+            # killed, e.g. by the out-of-memory killer: the next scan gets a new worker
+            self.process.join()
+            code = self.process.exitcode
+            self.conn.close()
+            self.process = None
+            raise RuntimeError('worker process exited with code %s' % code)
+        args.presentation_url = reply['presentation_url']
+        args.count = reply['count']
+        trace.merge(reply['spans'])
+        retry.merge(reply['counters'])
+        self.scans += 1
+        if self.scans >= self.max_scans or (self.max_rss > 0 and reply['rss'] > self.max_rss):
+            log.info('Recycling worker process %d after %d scans, RSS %.0f MB' % (
+                self.process.pid, self.scans, reply['rss']/2**20))
+            self.stop()
+        if reply['error'] is not None:
+            log.error('Worker process traceback:\n%s' % reply['traceback'].rstrip())
+            raise RuntimeError(reply['error'])
+
+    def close(self):
+        self.stop()